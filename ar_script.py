@@ -0,0 +1,442 @@
+"""
+Used for keeping track of ARTags
+"""
+import threading
+import numpy as np
+
+# detections remembered by TagTracker
+RING_SIZE = 32
+
+
+class TagTracker:
+    """
+    Tells whether the ARTag being parked at is still in view. process_ar_tags
+    reports every detection with seen(), park_step calls tick() once per control
+    tick, and the counters say how many ticks in a row the ARTag was or wasn't
+    detected. Everything is O(1) and the memory is fixed, however long parking takes.
+    """
+    def __init__(self, size=RING_SIZE):
+        # ring buffer of the last detections: ar_x and time stamp (s)
+        self.xs = np.zeros(size)
+        self.stamps = np.zeros(size)
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        """
+        - Forget everything, used when parking starts
+        :param: None
+        :return: None
+        """
+        # next slot of the ring buffer and number of detections stored
+        self.head = 0
+        self.count = 0
+        # time stamp of the newest detection, None until there is one
+        self.last_stamp = None
+        # detections since the last tick
+        self.fresh = 0
+        # ticks in a row with (streak) and without (missed) a detection
+        self.streak = 0
+        self.missed = 0
+
+    def seen(self, x, stamp):
+        """
+        - Record a detection of the ARTag
+        :param: ar_x (m), time stamp of the marker (s)
+        :return: None
+        """
+        if self.last_stamp is not None and stamp <= self.last_stamp:
+            # same message delivered again, not a new detection
+            return
+        self.xs[self.head] = x
+        self.stamps[self.head] = stamp
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.last_stamp = stamp
+        self.fresh += 1
+
+    def tick(self):
+        """
+        - Update the counters for one control tick
+        :param: None
+        :return: None
+        """
+        if self.fresh > 0:
+            self.streak += 1
+            self.missed = 0
+        else:
+            self.streak = 0
+            self.missed += 1
+        self.fresh = 0
+
+    def lost(self, max_missed):
+        """
+        - Whether the ARTag has been out of view for more than `max_missed` ticks
+        """
+        return self.missed > max_missed
+
+    def found(self, min_streak):
+        """
+        - Whether the ARTag has been in view for at least `min_streak` ticks in a row
+        """
+        return self.streak >= min_streak
+
+    def staleness(self, now):
+        """
+        - Seconds since the ARTag was last detected (inf if it never was)
+        :param: current time (s)
+        """
+        if self.last_stamp is None:
+            return float('inf')
+        return now - self.last_stamp
+
+    def history(self):
+        """
+        - The remembered detections, oldest first
+        :return: (ar_xs, stamps)
+        """
+        order = (np.arange(self.count) + self.head - self.count) % self.size
+        return self.xs[order], self.stamps[order]
+
+
+# ---- per-tag pose filter ----
+# white noise acceleration of the constant velocity model (m/s^2),
+# a parked ARTag doesn't move so this only soaks up odometry error
+ACCEL_NOISE = 0.05
+# odometry error added per meter driven (m) and per radian turned (rad)
+ODOM_POS_NOISE = 0.05
+ODOM_ROT_NOISE = 0.05
+# noise of a detection: position (m) at 0 m plus per meter away, normal angle (rad)
+MEAS_POS_NOISE = 0.01
+MEAS_POS_NOISE_PER_M = 0.01
+MEAS_ANGLE_NOISE = 0.15
+# detections further than this (squared Mahalanobis distance, 99.7% for 3 dof)
+# from the estimate are rejected, and this many rejections in a row restart the filter
+GATE = 14.2
+MAX_REJECTS = 3
+# odometry steps bigger than this (m, rad) are treated as an odometry reset
+MAX_ODOM_STEP = 0.5
+# tags not detected for this long (s) are forgotten
+FORGET_AGE = 10.0
+
+
+def wrap(angle):
+    """
+    - Wrap an angle to -pi..pi
+    """
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+
+def roll_to_off_normal(roll):
+    """
+    - Angle of the robot off the ARTag's normal from the roll of the marker
+    orientation, the way park_step reads it: |pi - |roll|| is the magnitude, and
+    the sign tells which side of the ARTag the robot is on (the mapping is its own inverse)
+    """
+    return np.copysign(np.pi - abs(roll), roll)
+
+
+def marker_normal(forward, left, roll):
+    """
+    - Heading of an ARTag's normal in the robot frame from a detection
+    :param: marker position in the robot frame (m), roll of the marker orientation (rad),
+    floats or arrays
+    :return: angle (rad)
+    """
+    return wrap(np.arctan2(-left, -forward) - roll_to_off_normal(roll))
+
+
+def camera_pose(forward, left, normal):
+    """
+    - An ARTag pose in the camera's terms, what process_ar_tags used to read off a marker
+    :param: ARTag position in the robot frame (m), heading of its normal (rad)
+    :return: (ar_x (m, right), ar_z (m, forward), ar_orientation (roll, rad))
+    """
+    off_normal = wrap(np.arctan2(-left, -forward) - normal)
+    return (-left, forward, roll_to_off_normal(off_normal))
+
+
+def robot_in_tag(forward, left, normal):
+    """
+    - The robot's pose in the ARTag's frame: x out of the ARTag along its
+    normal, y to the left of that, heading CCW from x
+    :param: ARTag position in the robot frame (m), heading of its normal (rad)
+    :return: (x (m), y (m), heading (rad))
+    """
+    c, s = np.cos(normal), np.sin(normal)
+    return (-c * forward - s * left, s * forward - c * left, wrap(-normal))
+
+
+# ids the filters have room for to begin with, grown when a bigger id shows up
+MAX_TAGS = 32
+# entries of the state a detection measures: forward, left and normal, and
+# their block of the (flattened) covariance
+MEASURED = [0, 1, 4]
+MEASURED_COV = [5 * i + j for i in MEASURED for j in MEASURED]
+# the process noise is a sum of these (flattened) covariances, each scaled by
+# one of q dt^4/4 plus the odometry position error, q dt^3/2, q dt^2 and the
+# odometry heading error, so it takes one product to build
+PROCESS_NOISE = np.zeros((4, 25))
+PROCESS_NOISE[0, [0, 6]] = 1.0
+PROCESS_NOISE[1, [2, 8, 10, 16]] = 1.0
+PROCESS_NOISE[2, [12, 18]] = 1.0
+PROCESS_NOISE[3, 24] = 1.0
+
+
+def rotations(angle):
+    """
+    - Matrices rotating vectors by -angle, the frame change to a frame turned by angle
+    :param: array of angles (rad)
+    :return: array (n, 2, 2)
+    """
+    c, s = np.cos(angle), np.sin(angle)
+    rot = np.empty((len(c), 2, 2))
+    rot[:, 0, 0], rot[:, 0, 1], rot[:, 1, 0], rot[:, 1, 1] = c, s, -s, c
+    return rot
+
+
+def measured_covariance(cov):
+    """
+    - The (forward, left, normal) block of covariances of the state
+    :param: array (n, 5, 5)
+    :return: array (n, 3, 3)
+    """
+    return cov.reshape(-1, 25)[:, MEASURED_COV].reshape(-1, 3, 3)
+
+
+class TagEstimator:
+    """
+    Constant velocity Kalman filter of every ARTag's pose in the robot frame.
+    The state of each is [forward, left, v_forward, v_left, normal]: the ARTag's
+    position (m) and velocity (m/s) seen from the robot, and the heading of its
+    normal (rad) in the robot frame. Between detections the estimates are moved
+    with the odometry, so they keep tracking while the robot turns and drives
+    with the ARTag out of view. The odometry transform is linear in the state,
+    so these are plain Kalman filters, only the normal's innovation needs wrapping.
+
+    The filters don't depend on each other, so they are kept in arrays indexed
+    by tag id and run together: process_ekf calls predict() with every pose,
+    which moves every ARTag in view, and process_ar_tags calls update() with a
+    whole AlvarMarkers message. The estimates go into a
+    landmark_script.LandmarkTable, that is what the rest of Main2 reads.
+    """
+    def __init__(self, table=None, size=MAX_TAGS):
+        """
+        :param: landmark_script.LandmarkTable the estimates are recorded in (None for
+        none), ids to make room for
+        """
+        self.table = table
+        # process_ekf and process_ar_tags run on different threads
+        self.lock = threading.RLock()
+        self.size = 0
+        self.grow(size)
+        # latest odometry pose (x, y, theta) and its time
+        self.odom = None
+        self.time = None
+
+    def grow(self, size):
+        """
+        - Make room for ids below `size`, keeping the estimates
+        :param: number of ids
+        :return: None
+        """
+        if size <= self.size:
+            return
+        size = max(size, 2 * self.size)
+
+        def extend(name, shape, dtype, fill):
+            new = np.full((size,) + shape, fill, dtype)
+            if self.size:
+                new[:self.size] = getattr(self, name)
+            setattr(self, name, new)
+        extend('state', (5,), float, 0.0)
+        extend('cov', (5, 5), float, 0.0)
+        # time stamp (s) of the newest detection used
+        extend('stamp', (), float, np.nan)
+        # time (s) and odometry pose (x, y, theta) the estimate is at
+        extend('at_time', (), float, np.nan)
+        extend('at_odom', (3,), float, np.nan)
+        # detections rejected in a row, and whether there is an estimate
+        extend('rejects', (), int, 0)
+        extend('active', (), bool, False)
+        self.size = size
+
+    def reset(self):
+        """
+        - Forget every ARTag
+        """
+        with self.lock:
+            ids = np.flatnonzero(self.active)
+            self.active[:] = False
+            if self.table is not None:
+                self.table.forget(ids)
+
+    def start(self, ids, z, r, stamps):
+        """
+        - Start the estimates from detections, with an unknown velocity
+        :param: tag ids, detections (n, 3) and their variances (n, 3), time stamps (s)
+        """
+        if len(ids) == 0:
+            return
+        state = np.zeros((len(ids), 5))
+        state[:, MEASURED] = z
+        self.state[ids] = state
+        cov = np.zeros((len(ids), 5, 5))
+        cov[:, MEASURED, MEASURED] = r
+        cov[:, 2, 2] = cov[:, 3, 3] = 0.1
+        self.cov[ids] = cov
+        self.stamp[ids] = stamps
+        self.rejects[ids] = 0
+        self.active[ids] = True
+
+    def move(self, ids, odom, now):
+        """
+        - Move estimates forward: constant velocity, then the robot's motion
+        since each one's last prediction from the odometry
+        :param: tag ids, odometry pose (x, y, theta) in the odom frame, time (s)
+        (one for all or one for each)
+        :return: the moved states (n, 5) and covariances (n, 5, 5), for the caller to store
+        """
+        n = len(ids)
+        dt = np.maximum(now - self.at_time[ids], 0.0)
+        # robot motion in the robot frame at the previous prediction
+        last = self.at_odom[ids]
+        delta = odom - last
+        step = np.matmul(rotations(last[:, 2]), delta[:, :2, None])[:, :, 0]
+        turn = wrap(delta[:, 2])
+        self.at_odom[ids], self.at_time[ids] = odom, now
+        moved = np.hypot(delta[:, 0], delta[:, 1])
+        # the odometry was reset, its jump isn't the robot's motion
+        reset = (moved > MAX_ODOM_STEP) | (np.abs(turn) > MAX_ODOM_STEP)
+        if reset.any():
+            step[reset], turn[reset], moved[reset] = 0.0, 0.0, 0.0
+
+        # constant velocity, then the frame change R(-turn) * (p - step)
+        rot = rotations(turn)
+        F = np.zeros((n, 5, 5))
+        F[:, 0:2, 0:2] = F[:, 2:4, 2:4] = rot
+        F[:, 0:2, 2:4] = rot * dt[:, None, None]
+        F[:, 4, 4] = 1.0
+        state = np.matmul(F, self.state[ids, :, None])[:, :, 0]
+        state[:, 0:2] -= np.matmul(rot, step[:, :, None])[:, :, 0]
+        state[:, 4] = wrap(state[:, 4] - turn)
+
+        q = ACCEL_NOISE**2
+        scale = np.empty((n, 4))
+        scale[:, 0:3] = dt[:, None]**[4, 3, 2] * [q / 4, q / 2, q]
+        # odometry turning error swings the ARTag's position around the robot
+        swing = ODOM_ROT_NOISE * np.abs(turn)
+        scale[:, 0] += (ODOM_POS_NOISE * moved)**2 + (swing * np.hypot(state[:, 0], state[:, 1]))**2
+        scale[:, 3] = swing**2
+        Q = np.dot(scale, PROCESS_NOISE).reshape(n, 5, 5)
+        return state, np.matmul(np.matmul(F, self.cov[ids]), F.transpose(0, 2, 1)) + Q
+
+    def predict(self, odom, now):
+        """
+        - Move every estimate with a new odometry pose, forgetting ARTags not seen for FORGET_AGE
+        :param: odometry pose (x, y, theta), time (s)
+        :return: None
+        """
+        with self.lock:
+            self.odom, self.time = odom, now
+            ids = np.flatnonzero(self.active)
+            old = now - self.stamp[ids] > FORGET_AGE
+            if old.any():
+                forgotten, ids = ids[old], ids[~old]
+                self.active[forgotten] = False
+                if self.table is not None:
+                    self.table.forget(forgotten)
+            if len(ids) == 0:
+                return
+            state, cov = self.move(ids, odom, now)
+            self.state[ids], self.cov[ids] = state, cov
+            if self.table is not None:
+                self.table.moved(ids, state[:, MEASURED], measured_covariance(cov))
+
+    def update(self, ids, x, z, roll, stamps):
+        """
+        - Fuse the detections of an AlvarMarkers message and record them in the table
+        :param: arrays of tag ids, marker positions in the camera frame (x right, z forward) (m),
+        rolls of the marker orientations (rad) and time stamps (s)
+        :return: array, False where a detection was rejected as an outlier
+        """
+        ids = np.asarray(ids, int)
+        with self.lock:
+            if len(ids) and ids.max() >= self.size:
+                self.grow(ids.max() + 1)
+            if len(set(ids.tolist())) == len(ids):
+                fused = self.fuse(ids, z, -x, roll, stamps)
+            else:
+                # an ARTag twice in one message is fused once per round, in order
+                fused = np.zeros(len(ids), bool)
+                rest = np.arange(len(ids))
+                while len(rest):
+                    first = np.unique(ids[rest], return_index=True)[1]
+                    batch = rest[first]
+                    fused[batch] = self.fuse(ids[batch], z[batch], -x[batch], roll[batch], stamps[batch])
+                    rest = np.delete(rest, first)
+            if self.table is not None:
+                self.table.record(ids, self.state[ids][:, MEASURED], self.covariance(ids), self.stamp[ids])
+            return fused
+
+    def fuse(self, ids, forward, left, roll, stamps):
+        """
+        - Fuse one detection of each of some ARTags
+        :param: tag ids (no repeats), ARTag positions in the robot frame (m), rolls
+        of the marker orientations (rad), time stamps of the detections (s)
+        :return: array, False where a detection was rejected as an outlier
+        """
+        n = len(ids)
+        z = np.empty((n, 3))
+        z[:, 0], z[:, 1], z[:, 2] = forward, left, marker_normal(forward, left, roll)
+        r = np.empty((n, 3))
+        r[:, 0:2] = ((MEAS_POS_NOISE + MEAS_POS_NOISE_PER_M * np.hypot(forward, left))**2)[:, None]
+        r[:, 2] = MEAS_ANGLE_NOISE**2
+        odom = self.odom if self.odom is not None else (0.0, 0.0, 0.0)
+        fused = np.ones(n, bool)
+
+        new = ~self.active[ids]
+        if new.any():
+            self.start(ids[new], z[new], r[new], stamps[new])
+            self.at_odom[ids[new]], self.at_time[ids[new]] = odom, stamps[new]
+            known = np.flatnonzero(~new)
+            ids, z, r, stamps = ids[known], z[known], r[known], stamps[known]
+            if len(ids) == 0:
+                return fused
+        else:
+            known = np.arange(n)
+
+        state, cov = self.move(ids, odom, stamps)
+        innovation = z - state[:, MEASURED]
+        innovation[:, 2] = wrap(innovation[:, 2])
+        S = measured_covariance(cov)
+        S[:, [0, 1, 2], [0, 1, 2]] += r
+        S_inv = np.linalg.inv(S)
+        K = np.matmul(cov[:, :, MEASURED], S_inv)
+        rejected = np.einsum('ni,nij,nj->n', innovation, S_inv, innovation) > GATE
+        any_rejected = rejected.any()
+        if any_rejected:
+            # keep the moved estimates of those
+            K[rejected] = 0.0
+        state += np.matmul(K, innovation[:, :, None])[:, :, 0]
+        state[:, 4] = wrap(state[:, 4])
+        self.state[ids] = state
+        self.cov[ids] = cov - np.matmul(K, cov[:, MEASURED, :])
+        if any_rejected:
+            self.rejects[ids[rejected]] += 1
+            # the ARTag really is somewhere else, trust the detections
+            restart = rejected & (self.rejects[ids] >= MAX_REJECTS)
+            self.start(ids[restart], z[restart], r[restart], stamps[restart])
+            fused[known[rejected & ~restart]] = False
+            ok = ~rejected
+            ids, stamps = ids[ok], stamps[ok]
+        self.stamp[ids] = stamps
+        self.rejects[ids] = 0
+        return fused
+
+    def covariance(self, ids):
+        """
+        - Covariance of (forward, left, normal) of some ARTags
+        :return: array (n, 3, 3)
+        """
+        return measured_covariance(self.cov[ids])
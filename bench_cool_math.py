@@ -0,0 +1,92 @@
+"""
+Benchmark for the batch versions of the cool_math functions
+
+Runs every scalar function in a Python loop and its batch version on the same
+random inputs (with edge cases mixed in: zero sides, obtuse and flat
+triangles, angles pi apart), checks they agree, and reports the time per
+element of each.
+
+usage: python bench_cool_math.py [points]
+"""
+import sys
+import time
+import numpy as np
+
+import cool_math as cm
+
+# how many times each version runs, the best time is reported
+REPEATS = 5
+
+
+def inputs(n, seed=189):
+    """
+    - Random arguments for every function, about one in ten an edge case
+    :param: number of elements
+    :return: dictionary of name -> (scalar argument tuples, batch arguments)
+    """
+    rng = np.random.RandomState(seed)
+    sides = rng.uniform(0, 5, (n, 3))
+    sides[rng.rand(n) < 0.05, 0] = 0
+    sides[rng.rand(n) < 0.05, 2] = 20
+    gamma = rng.uniform(-np.pi, np.pi, n)
+    # degenerate triangles: equal sides at no angle
+    flat = rng.rand(n) < 0.05
+    gamma[flat] = 0
+    sides[flat, 1] = sides[flat, 0]
+    pos = rng.uniform(-30, 30, (n, 2))
+    goal = rng.uniform(-30, 30, (n, 2))
+    same = rng.rand(n) < 0.05
+    goal[same] = pos[same]
+    pos3 = rng.uniform(-30, 30, (n, 3))
+    angles = rng.uniform(-2 * np.pi, 2 * np.pi, (n, 2))
+    opposite = rng.rand(n) < 0.05
+    angles[opposite, 1] = angles[opposite, 0] + np.pi
+
+    def rows(*arrays):
+        return zip(*[a.tolist() for a in arrays])
+
+    return {
+        'third_side': (rows(sides[:, 0], sides[:, 1], gamma), (sides[:, 0], sides[:, 1], gamma)),
+        'get_angle_ab': (rows(sides[:, 0], sides[:, 1], sides[:, 2]),
+                         (sides[:, 0], sides[:, 1], sides[:, 2])),
+        'dist': ([(tuple(p),) for p in pos3.tolist()], (pos3,)),
+        'dist_btwn': (rows(pos, goal), (pos, goal)),
+        'orient': (rows(pos, goal), (pos, goal)),
+        'angle_compare': (rows(angles[:, 0], angles[:, 1]), (angles[:, 0], angles[:, 1])),
+    }
+
+
+def scalar(function, args):
+    """
+    - Scalar function over every argument tuple, NaN where it raises ValueError
+    """
+    out = np.empty(len(args))
+    for i, arg in enumerate(args):
+        try:
+            out[i] = function(*arg)
+        except ValueError:
+            out[i] = np.nan
+    return out
+
+
+def best_time(run):
+    best = None
+    for _ in range(REPEATS):
+        start = time.time()
+        result = run()
+        took = time.time() - start
+        best = took if best is None else min(best, took)
+    return best, result
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print "%d elements" % n
+    print "%-16s %12s %12s %9s %8s" % ("function", "scalar us", "batch us", "speedup", "agree")
+    for name, (scalar_args, batch_args) in sorted(inputs(n).items()):
+        function, batch = getattr(cm, name), getattr(cm, name + '_batch')
+        scalar_time, expected = best_time(lambda: scalar(function, scalar_args))
+        batch_time, result = best_time(lambda: batch(*batch_args))
+        agree = np.allclose(result, expected, rtol=1e-9, atol=1e-9, equal_nan=True)
+        print "%-16s %12.3f %12.3f %8.0fx %8s" % (
+            name, 1e6 * scalar_time / n, 1e6 * batch_time / n, scalar_time / batch_time, agree)
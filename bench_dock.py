@@ -0,0 +1,51 @@
+"""
+Benchmark for parking: dock_script.DockPlanner against the old sequence
+
+Runs a simulated mission to every dispenser and back home with each way of
+parking (sim_script.run_mission, '--park=sequence' for the old one), with
+ARTag noise and odometry drift, over a few seeds. Reports time-to-dock (from
+the ARTag being seen close enough to the parking spot) and the true final
+lateral and heading errors off the ARTag's normal.
+
+usage: python bench_dock.py [seeds]
+"""
+import sys
+import math
+import numpy as np
+
+import sim_script
+
+DISPENSERS = [2, 3, 4, 5, 6, 7]
+# ways of parking: name -> Main2 options
+MODES = [('dock', []), ('sequence', ['--park=sequence'])]
+# sensor errors the missions run with
+MARKER_NOISE = 0.02
+ODOM_DRIFT = 0.01
+
+
+def run(options, seeds):
+    """
+    - Every parking of missions to all dispensers
+    :param: Main2 options, number of seeds
+    :return: array of (seconds, lateral error (m), heading error (rad)), missions not finished
+    """
+    docks, failed = [], 0
+    for seed in range(seeds):
+        for tag in DISPENSERS:
+            world = sim_script.SimWorld(marker_noise=MARKER_NOISE, odom_drift=ODOM_DRIFT, seed=seed)
+            result = sim_script.run_mission(tag, 1, world=world, options=options)
+            failed += not result['completed']
+            docks.extend(dock[1:4] for dock in result['docks'])
+    return np.array(docks).reshape(-1, 3), failed
+
+
+if __name__ == '__main__':
+    seeds = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    print "%-10s %6s %7s %10s %10s %12s %12s %14s" % (
+        "parking", "parks", "failed", "mean s", "p90 s", "mean lat cm", "max lat cm", "mean head deg")
+    for name, options in MODES:
+        docks, failed = run(options, seeds)
+        secs, lateral, heading = docks[:, 0], np.abs(docks[:, 1]), np.abs(docks[:, 2])
+        print "%-10s %6d %7d %10.1f %10.1f %12.1f %12.1f %14.1f" % (
+            name, len(docks), failed, secs.mean(), np.percentile(secs, 90),
+            100 * lateral.mean(), 100 * lateral.max(), math.degrees(heading.mean()))
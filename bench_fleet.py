@@ -0,0 +1,212 @@
+"""
+Benchmark for fleet_script.Coordinator
+
+Runs robots through a stream of orders on a simulated clock, each robot
+talking to the Coordinator through a LocalClient the way Main2 does: trips of
+orders from the coordinator, a claim before parking at every dispenser. Drive
+and park times vary randomly around the coordinator's model. Reports orders
+delivered per hour, time spent waiting for dispensers, and checks that no two
+robots were ever parked at the same dispenser.
+
+First, two RosClients go through the coordinator node over the sim_util ROS
+stand-ins, with messages delivered a step late and their joins lost the way
+rospy loses what is published before a subscriber connects: the second robot
+to claim a busy dispenser must not park until the first one is done, however
+long that takes.
+
+usage: python bench_fleet.py [orders]
+"""
+import sys
+import numpy as np
+
+import sim_util
+import map_script
+import route_script
+import order_script
+import fleet_script
+
+# same coordinates as Main2.AR_ids
+TAGS = {1: (0, 0), 11: (-13, -1), 2: (-2, -9), 3: (-18, -9), 4: (-31, -1),
+        5: (-23, 10), 6: (-15, 7), 7: (-9, 10)}
+HOMES = [1, 11]
+DISPENSERS = [2, 3, 4, 5, 6, 7]
+
+# simulated time step (s) and spread of the real times around the model
+DT = 1.0
+SPREAD = 0.3
+# seconds between orders, more than one robot can keep up with
+ORDER_EVERY = 5.0
+
+
+class SimRobot:
+    """
+    Main2's trip logic reduced to timings: drive, claim, park, next stop or home
+    """
+    def __init__(self, name, home, coordinator, routes, rng):
+        self.name = name
+        self.home = home
+        self.client = fleet_script.LocalClient(coordinator, name, home, 0.0)
+        self.coordinator = coordinator
+        self.orders = order_script.OrderQueue(routes.length, keep_order=True)
+        self.rng = rng
+        self.at = home
+        self.goal = None
+        # what the robot is doing until when: 'idle', 'drive', 'claim', 'park'
+        self.doing = 'idle'
+        self.until = 0.0
+        self.waited = 0.0
+        self.delivered = 0
+
+    def noisy(self, secs):
+        return secs * self.rng.uniform(1 - SPREAD, 1 + SPREAD)
+
+    def drive_to(self, tag, now):
+        self.goal = tag
+        self.doing = 'drive'
+        self.until = now + self.noisy(self.coordinator.travel(self.at, tag))
+
+    def step(self, now):
+        for tag in self.client.poll():
+            self.orders.add(tag)
+        if now < self.until:
+            return
+        if self.doing == 'idle':
+            if len(self.orders) > 0:
+                self.orders.start_trip(self.at, self.home)
+                self.drive_to(self.orders.next_stop(), now)
+        elif self.doing == 'drive':
+            self.at = self.goal
+            if self.at == self.home:
+                self.park(now, fleet_script.HOME_TIME)
+            else:
+                self.doing = 'claim'
+                self.step(now)
+        elif self.doing == 'claim':
+            start = self.client.claim(self.at, now)
+            if start is not None and start <= now:
+                self.park(now, fleet_script.PARK_TIME)
+            else:
+                self.waited += DT
+        elif self.doing == 'park':
+            if self.at == self.home:
+                self.delivered += self.orders.arrived_home()
+                self.client.at_home(now)
+                self.doing = 'idle'
+            else:
+                self.orders.picked_up(self.at)
+                self.client.done(self.at, now)
+                next_stop = self.orders.next_stop()
+                self.drive_to(next_stop if next_stop is not None else self.home, now)
+
+    def park(self, now, secs):
+        self.doing = 'park'
+        self.until = now + self.noisy(secs)
+
+
+class Bus:
+    """
+    World for the sim_util ROS stand-ins: a clock, and topics whose messages
+    are delivered on the next step
+    """
+    def __init__(self):
+        self.time = 0.0
+        self.verbose = False
+        self.subscribers = {}
+        self.queue = []
+        self.shutdown_callbacks = []
+        # topic -> how many of its next messages are lost
+        self.lost = {}
+
+    def now(self):
+        return self.time
+
+    def is_shutdown(self):
+        return False
+
+    def subscribe(self, topic, callback):
+        self.subscribers.setdefault(topic, []).append(callback)
+
+    def publish(self, topic, msg):
+        if self.lost.get(topic):
+            self.lost[topic] -= 1
+            return
+        self.queue.append((topic, msg))
+
+    def advance(self, secs):
+        self.time += secs
+        queue, self.queue = self.queue, []
+        for topic, msg in queue:
+            for callback in self.subscribers.get(topic, []):
+                callback(msg)
+
+
+def check_ros_claims(routes, dispenser=2, held=3 * fleet_script.PARK_TIME):
+    """
+    - Robot 'a' parks at a dispenser and stays there for `held` s, well past
+    its window, while robot 'b' claims the same dispenser every step. Both
+    joins are lost, and so is the coordinator's first answer to each
+    :return: seconds 'b' waited after 'a' was done
+    """
+    sim_util.install()
+    bus = Bus()
+    sim_util.set_world(bus)
+    node = fleet_script.CoordinatorNode(fleet_script.Coordinator(routes.length, TAGS))
+    bus.lost = {fleet_script.REQUEST_TOPIC: 2, 'fleet/a': 1, 'fleet/b': 1}
+    a = fleet_script.RosClient('a', HOMES[0])
+    b = fleet_script.RosClient('b', HOMES[0])
+    bus.advance(DT)
+    a_start = bus.now()
+    start = a.claim(dispenser, bus.now())
+    while start is None or start > bus.now():
+        assert bus.now() - a_start < 10 * DT, "robot a never got the free dispenser"
+        bus.advance(DT)
+        start = a.claim(dispenser, bus.now())
+    parked_until = bus.now() + held
+    b_parked = None
+    while b_parked is None:
+        start = b.claim(dispenser, bus.now())
+        if start is not None and start <= bus.now():
+            b_parked = bus.now()
+            assert b_parked >= parked_until, "robot b parked at %.0f s, robot a is there until %.0f s" % (
+                b_parked, parked_until)
+            assert node.coordinator.holders[('dispenser', dispenser)] == 'b'
+        if bus.now() >= parked_until and a is not None:
+            a.done(dispenser, bus.now())
+            a = None
+        bus.advance(DT)
+    return b_parked - parked_until
+
+
+def run(robots, orders, routes, seed=189):
+    """
+    - Serve `orders` orders arriving one every ORDER_EVERY s with `robots` robots
+    :return: (orders delivered per hour, mean wait for a dispenser per order (s),
+    most robots parked at one dispenser at once)
+    """
+    rng = np.random.RandomState(seed)
+    coordinator = fleet_script.Coordinator(routes.length, TAGS)
+    fleet = [SimRobot('robot%d' % i, HOMES[i % len(HOMES)], coordinator, routes, rng)
+             for i in range(robots)]
+    stream = [(ORDER_EVERY * i, rng.choice(DISPENSERS)) for i in range(orders)]
+    now, crowd = 0.0, 1
+    while sum(r.delivered for r in fleet) < orders:
+        while stream and stream[0][0] <= now:
+            coordinator.submit(stream.pop(0)[1], now)
+        for robot in fleet:
+            robot.step(now)
+        parked = [r.at for r in fleet if r.doing == 'park' and r.at not in HOMES]
+        if parked:
+            crowd = max(crowd, max(parked.count(tag) for tag in parked))
+        now += DT
+    return orders * 3600.0 / now, sum(r.waited for r in fleet) / orders, crowd
+
+
+if __name__ == '__main__':
+    orders = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+    routes = route_script.RouteTable(map_script.MapMaker(), TAGS)
+    routes.load_or_build()
+    print "busy dispenser over ROS: robot b parked %.0f s after robot a was done" % check_ros_claims(routes)
+    print "%-8s %14s %14s %18s" % ("robots", "orders/hour", "wait s/order", "max at dispenser")
+    for robots in [1, 2, 3, 4]:
+        rate, wait, crowd = run(robots, orders, routes)
+        print "%-8d %14.1f %14.1f %18d" % (robots, rate, wait, crowd)
@@ -0,0 +1,66 @@
+"""
+Benchmark for frame_script conversions
+
+Converts growing batches of EKF positions to my_map cells with one cached
+FrameTree transform, against the per-point conversion MapMaker used before
+(positionToMap with its calliber, then mapToGrid), and times looking a
+transform up in the FrameTree with and without its cache.
+
+usage: python bench_frames.py
+"""
+import time
+import numpy as np
+
+import frame_script
+import map_script
+
+# how many times every case runs, the best is reported
+REPEATS = 20
+LOOKUPS = 1000
+HOME = (0, 0)
+
+
+def legacy_cells(points):
+    """
+    - The old conversion, one point at a time
+    """
+    out = []
+    for x, y in points:
+        step = (int(x / map_script.world_map_ratio) + HOME[0], int(y / map_script.world_map_ratio) + HOME[1])
+        out.append((step[0] - map_script.GRID_ORIGIN[0], step[1] - map_script.GRID_ORIGIN[1]))
+    return out
+
+
+def best_time(run):
+    times = []
+    for _ in range(REPEATS):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    mapper = map_script.MapMaker()
+    mapper.set_home(HOME)
+    frames = mapper.frames
+    rng = np.random.RandomState(23)
+
+    print "%8s %12s %12s %8s" % ("points", "batched us", "loop us", "speedup")
+    for n in (1, 10, 100, 1000, 10000):
+        points = rng.uniform(-3, 3, (n, 2))
+        batched = best_time(lambda: frame_script.to_cells(*frames.convert(points[:, 0], points[:, 1],
+                                                                          'world', 'grid')))
+        loop = best_time(lambda: legacy_cells(points))
+        print "%8d %12.1f %12.1f %8.1f" % (n, 1e6 * batched, 1e6 * loop, loop / batched)
+
+    # lookups are timed LOOKUPS at a time, one is too quick for the clock
+    mapper.set_robot((1.0, 0.5), 0.3)
+    cached = best_time(lambda: [frames.get('camera', 'grid') for _ in range(LOOKUPS)])
+
+    def uncached():
+        for _ in range(LOOKUPS):
+            frames.cache.clear()
+            frames.get('camera', 'grid')
+    print "camera -> grid lookup: %.2f us cached, %.2f us composed" % (
+        1e6 * cached / LOOKUPS, 1e6 * best_time(uncached) / LOOKUPS)
@@ -0,0 +1,101 @@
+"""
+Benchmark for landmark_script.LandmarkTable
+
+Times fusing AlvarMarkers messages of growing size with
+ar_script.TagEstimator.update(), which runs the filters of the message's
+ARTags together and records them in the table with one assignment per array,
+against the same detections fused one marker at a time. Then times looking a
+place up and finding the place nearest to a point, against a plain dictionary
+and a Python loop over it.
+
+usage: python bench_landmarks.py
+"""
+import math
+import time
+import numpy as np
+
+import ar_script
+import landmark_script
+
+# same as main.AR_IDS and main.HOME_IDS
+AR_IDS = {1: [(0, 0), 0.9], 11: [(-13, -1), 1.5], 2: [(-2, -9), 1], 3: [(-18, -9), 0.8],
+          4: [(-31, -1), 1], 5: [(-23, 10), 1.5], 6: [(-15, 7), 0.9], 7: [(-9, 10), .75]}
+HOME_IDS = [1, 11]
+
+# how many times every case runs, the best is reported
+REPEATS = 5
+# every case is timed this many times over, once is too quick for the clock
+QUERIES = 1000
+# messages fused per case, one every 1/15 s like ar_track_alvar's
+MESSAGES = 200
+
+
+def messages(rng, n):
+    """
+    - A stream of detections of n ARTags standing still in front of the robot
+    :return: list of (ids, x, z, rolls, stamps) arrays
+    """
+    ids = rng.choice(landmark_script.MAX_TAGS, n, replace=False)
+    x, z = rng.uniform(-0.5, 0.5, n), rng.uniform(0.5, 2.0, n)
+    rolls = rng.uniform(2.5, 3.1, n)
+    return [(ids, x + rng.normal(0, 0.01, n), z + rng.normal(0, 0.01, n), rolls, np.full(n, i / 15.0))
+            for i in range(MESSAGES)]
+
+
+def fuse_messages(stream):
+    estimator = ar_script.TagEstimator(landmark_script.LandmarkTable())
+    for ids, x, z, rolls, stamps in stream:
+        estimator.update(ids, x, z, rolls, stamps)
+
+
+def fuse_markers(stream):
+    estimator = ar_script.TagEstimator(landmark_script.LandmarkTable())
+    for ids, x, z, rolls, stamps in stream:
+        for i in range(len(ids)):
+            estimator.update(ids[i:i + 1], x[i:i + 1], z[i:i + 1], rolls[i:i + 1], stamps[i:i + 1])
+
+
+def legacy_nearest(places, point):
+    best, best_d = None, float('inf')
+    for tag, (spot, _) in places.items():
+        d = math.hypot(spot[0] - point[0], spot[1] - point[1])
+        if d < best_d:
+            best, best_d = tag, d
+    return best
+
+
+def best_time(run):
+    times = []
+    for _ in range(REPEATS):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(25)
+    table = landmark_script.LandmarkTable(AR_IDS, HOME_IDS)
+
+    print "%8s %16s %16s" % ("markers", "message us", "per marker us")
+    for n in (1, 4, 16):
+        stream = messages(rng, n)
+        print "%8d %16.1f %16.1f" % (n, 1e6 * best_time(lambda: fuse_messages(stream)) / MESSAGES,
+                                     1e6 * best_time(lambda: fuse_markers(stream)) / MESSAGES)
+
+    # Main2.AR_ids is the table's dictionary of places itself
+    AR_ids = table.places
+    places = dict(AR_IDS)
+    point = (-10, 3)
+    print "lookup: %.2f us table, %.2f us dictionary" % (
+        1e6 * best_time(lambda: [AR_ids[4] for _ in range(QUERIES)]) / QUERIES,
+        1e6 * best_time(lambda: [places[4] for _ in range(QUERIES)]) / QUERIES)
+    print "%8s %12s %12s" % ("places", "nearest us", "loop us")
+    for n in (len(places), 100, 1000):
+        while len(places) < n:
+            tag = len(places) + 20
+            places[tag] = [tuple(rng.randint(-40, 40, 2).tolist()), 1.0]
+            table.add_place(tag, places[tag][0], 1.0)
+        print "%8d %12.2f %12.2f" % (
+            n, 1e6 * best_time(lambda: [table.nearest(point) for _ in range(QUERIES)]) / QUERIES,
+            1e6 * best_time(lambda: [legacy_nearest(places, point) for _ in range(QUERIES)]) / QUERIES)
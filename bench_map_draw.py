@@ -0,0 +1,92 @@
+"""
+Benchmark for map_util.MapDrawer rendering
+
+Times one map update (without the imshow) for a single changed cell, a small
+block and a change of every cell, for the diff renderer and for the old
+per-cell loop it replaced.
+
+usage: python bench_map_draw.py
+"""
+import time
+from math import cos, sin
+import cv2
+import numpy as np
+
+import map_util
+
+# updates timed for every case
+REPEATS = 50
+
+
+def position_to_map(position):
+    # 0.2 m cells with the origin in the middle of the grid
+    return (position[0] / 0.2 + 20, position[1] / 0.2 + 15)
+
+
+class LegacyDrawer(map_util.MapDrawer):
+    """
+    The rendering MapDrawer.UpdateMapDisplay used to do: visit every cell, one
+    cv2.rectangle per changed cell, copy the full float image and redraw markers
+    """
+    def __init__(self, positionToMap):
+        map_util.MapDrawer.__init__(self, positionToMap)
+        self.drawn_map = np.zeros((640, 480, 3))
+        self.legacy_colors = [[0, 0, 0], [1, 1, 1], [1, 0, 0]]
+
+    def RenderMap(self, new_map, position, orientation=None):
+        for ii in np.ndindex(self.map_size):
+            if self.map[ii] == int(new_map[ii]):
+                continue
+            self.map[ii] = int(new_map[ii])
+            pt1 = (int(self.draw_scale*ii[1]), int(self.draw_scale*ii[0]))
+            pt2 = (int(self.draw_scale*(ii[1] + 1)), int(self.draw_scale*(ii[0] + 1)))
+            cv2.rectangle(self.drawn_map, pt1, pt2, self.legacy_colors[self.map[ii] + 1], -1)
+        img = np.copy(self.drawn_map)
+        current_pos = self.positionToMap(position)
+        current_pos = (int(self.draw_scale*current_pos[1]), int(self.draw_scale*current_pos[0]))
+        cv2.circle(img, current_pos, self.draw_scale - 2, [0, 0, 1], -1)
+        if orientation is not None:
+            current_oriention = self.axis_orientation + orientation
+            arrow_start = (int(current_pos[0] - 10*cos(current_oriention)),
+                           int(current_pos[1] + 10*sin(current_oriention)))
+            arrow_end = (int(current_pos[0] + 10*cos(current_oriention)),
+                         int(current_pos[1] - 10*sin(current_oriention)))
+            cv2.line(img, arrow_start, arrow_end, [0, 0, 0], 1)
+        return img
+
+
+def time_updates(drawer, change):
+    """
+    - Average time of one RenderMap call where `change` flips cells of the map
+    :param: MapDrawer, function(map, i) that edits the map in place
+    :return: ms per update
+    """
+    grid = -np.ones((40, 30))
+    drawer.RenderMap(grid, (0, 0), 0)
+    total = 0.0
+    for i in range(REPEATS):
+        change(grid, i)
+        start = time.time()
+        drawer.RenderMap(grid, (0.01 * i, 0), 0.01 * i)
+        total += time.time() - start
+    return 1000 * total / REPEATS
+
+
+def one_cell(grid, i):
+    grid[i % 40, i % 30] = i % 2
+
+
+def small_block(grid, i):
+    grid[10:15, 10:15] = i % 2
+
+
+def full_map(grid, i):
+    grid[:] = i % 2
+
+
+if __name__ == '__main__':
+    print "%-12s %12s %12s" % ("change", "diff ms", "legacy ms")
+    for name, change in [("1 cell", one_cell), ("5x5 block", small_block), ("full map", full_map)]:
+        new = time_updates(map_util.MapDrawer(position_to_map), change)
+        old = time_updates(LegacyDrawer(position_to_map), change)
+        print "%-12s %12.3f %12.3f" % (name, new, old)
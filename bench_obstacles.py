@@ -0,0 +1,188 @@
+"""
+Benchmark for the obstacle detection backends in obstacle_script.py
+
+Measures per-frame latency of every backend and how often each one agrees with
+the original contour path (obstacle / no obstacle, and which side), then the
+time to get area, centroid and bounding box of every blob of a frame's mask
+with contours (contourArea, cm.centroid, boundingRect) and with blob_features.
+
+usage: python bench_obstacles.py [frames.npy | frames.npz | directory of .npy files]
+With no argument a set of synthetic depth frames is generated instead.
+"""
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+import obstacle_script
+import cool_math as cm
+
+# number of synthetic frames when no recording is given
+N_SYNTHETIC = 200
+
+# how many times every frame is run through each backend
+REPEATS = 3
+
+
+def synthetic_frames(n, seed=189):
+    """
+    - Depth frames of a wall at 2 m with NaN holes and up to two boxes in front
+    :param: number of frames
+    :return: array of shape (n, 480, 640), float32 meters
+    """
+    rng = np.random.RandomState(seed)
+    frames = np.empty((n, 480, 640), np.float32)
+    for i in range(n):
+        frame = frames[i]
+        frame[:] = 2.0 + 0.05 * rng.randn(480, 640)
+        frame[rng.rand(480, 640) < 0.02] = np.nan
+        # speckle of close returns, like the floor right in front of the camera
+        frame[rng.rand(480, 640) < 0.01] = 0.3
+        for _ in range(rng.randint(0, 3)):
+            w, h = rng.randint(5, 200), rng.randint(5, 300)
+            x, y = rng.randint(0, 640 - w), rng.randint(0, 480 - h)
+            frame[y:y + h, x:x + w] = rng.uniform(0.15, 0.9)
+    return frames
+
+
+def load_frames(path):
+    """
+    - Load recorded depth frames
+    :param: .npy / .npz file or a directory of .npy files, one frame each
+    :return: list or array of depth frames (m)
+    """
+    if os.path.isdir(path):
+        names = sorted(n for n in os.listdir(path) if n.endswith('.npy'))
+        return [np.load(os.path.join(path, n)) for n in names]
+    if path.endswith('.npz'):
+        data = np.load(path)
+        return data[data.files[0]]
+    return np.load(path, mmap_mode='r')
+
+
+def legacy_detect(frame):
+    """
+    - The depth callback as it was before obstacle_script: full frame inRange,
+    column zeroing, masked copy, contours on a copy of the mask and a full normalize
+    :param: depth frame (m)
+    :return: bounding box of the largest contour or None
+    """
+    mask = cv2.inRange(frame, 0.1, 0.5)
+    mask[:, 0:180] = 0
+    mask[:, 460:] = 0
+    im_mask = cv2.bitwise_and(frame, frame, mask=mask)
+    img = np.copy(mask)[:-250, :]
+    box = obstacle_script.largest_contour_box(img)
+    cv2.normalize(im_mask, im_mask, 0, 1, cv2.NORM_MINMAX)
+    return box
+
+
+def time_legacy(frames):
+    """
+    - Per-frame latency of legacy_detect in ms
+    """
+    latencies = np.empty(len(frames))
+    for i, frame in enumerate(frames):
+        frame = np.ascontiguousarray(frame)
+        best = None
+        for _ in range(REPEATS):
+            start = time.time()
+            legacy_detect(frame)
+            took = time.time() - start
+            best = took if best is None else min(best, took)
+        latencies[i] = best * 1000
+    return latencies
+
+
+def contour_features(mask):
+    """
+    - Area, centroid and bounding box of every contour of a mask, the way the
+    contour path gets them
+    :return: list of (area, (cx, cy), (x, y, w, h))
+    """
+    contours = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    return [(cv2.contourArea(c), cm.centroid(c), cv2.boundingRect(c)) for c in contours]
+
+
+def time_features(function, frames):
+    """
+    - Per-frame latency (ms) of a features function on the masks of the frames' rois
+    """
+    detector = obstacle_script.ContourDetector()
+    masks = [detector.mask(detector.roi(frame)) for frame in frames]
+    latencies = np.empty(len(masks))
+    for i, mask in enumerate(masks):
+        best = None
+        for _ in range(REPEATS):
+            start = time.time()
+            function(mask)
+            took = time.time() - start
+            best = took if best is None else min(best, took)
+        latencies[i] = best * 1000
+    return latencies
+
+
+def run_backend(detector, frames):
+    """
+    - Time a detector over all frames
+    :param: ObstacleDetector, depth frames
+    :return: (list of results, array of per-frame latencies in ms)
+    """
+    results = []
+    latencies = np.empty(len(frames))
+    for i, frame in enumerate(frames):
+        best = None
+        for _ in range(REPEATS):
+            start = time.time()
+            result = detector.detect(frame)
+            took = time.time() - start
+            best = took if best is None else min(best, took)
+        results.append(result)
+        latencies[i] = best * 1000
+    return results, latencies
+
+
+def agreement(results, reference):
+    """
+    - Fraction of frames where a backend agrees with the reference
+    :return: (detection agreement, side agreement when both detect)
+    """
+    same_detection = 0
+    both = 0
+    same_side = 0
+    for a, b in zip(results, reference):
+        if (a is None) == (b is None):
+            same_detection += 1
+        if a is not None and b is not None:
+            both += 1
+            same_side += a.side == b.side
+    side = float(same_side) / both if both else float('nan')
+    return float(same_detection) / len(reference), side
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        frames = load_frames(sys.argv[1])
+    else:
+        frames = synthetic_frames(N_SYNTHETIC)
+    print "%d frames" % len(frames)
+
+    reference, _ = run_backend(obstacle_script.ContourDetector(), frames)
+    print "%-10s %9s %9s %9s %10s %8s" % ("backend", "mean ms", "p50 ms", "p95 ms", "detection", "side")
+    latencies = time_legacy(frames)
+    print "%-10s %9.3f %9.3f %9.3f %10s %8s" % (
+        "legacy", latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 95), "-", "-")
+    for name in sorted(obstacle_script.BACKENDS):
+        results, latencies = run_backend(obstacle_script.make_detector(name), frames)
+        detection, side = agreement(results, reference)
+        print "%-10s %9.3f %9.3f %9.3f %9.1f%% %7.1f%%" % (
+            name, latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 95),
+            100 * detection, 100 * side)
+
+    print
+    print "%-10s %9s %9s %9s" % ("features", "mean ms", "p50 ms", "p95 ms")
+    for name, function in [("contours", contour_features), ("blobs", obstacle_script.blob_features)]:
+        latencies = time_features(function, frames)
+        print "%-10s %9.3f %9.3f %9.3f" % (
+            name, latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 95))
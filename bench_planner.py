@@ -0,0 +1,81 @@
+"""
+Benchmark for the A* planner in map_script.MapMaker
+
+Plans between every pair of ARTags in main.py's table and reports the time per
+plan, which has to stay well under one 5 Hz control tick (200 ms).
+
+Then times route_script.RouteTable.map_changed, which runs inside the depth
+callback and has to keep to map_script.FUSION_BUDGET: cells flipping far from
+every route, a wall across the map, and the same far cells right after the
+routes were loaded from disk (their footprints not built yet).
+
+usage: python bench_planner.py
+"""
+import time
+import numpy as np
+
+import map_script
+import route_script
+
+# same coordinates as Main2.AR_ids
+TAGS = {1: (0, 0), 11: (-13, -1), 2: (-2, -9), 3: (-18, -9), 4: (-31, -1),
+        5: (-23, 10), 6: (-15, 7), 7: (-9, 10)}
+
+# how many times every pair is planned
+REPEATS = 5
+# cells flipped far from every route, beyond my_map like the tiles' cells
+FAR_CELLS = [(200 + i // 10, 200 + i % 10) for i in range(80)]
+
+
+def time_change(routes, flip):
+    """
+    - Time map_changed for one change of the map
+    :param: RouteTable, function changing the map and returning the flipped cells
+    :return: (ms, number of routes dropped)
+    """
+    cells = flip()
+    start = time.time()
+    dropped = routes.map_changed(cells)
+    return 1000 * (time.time() - start), len(dropped)
+
+
+def set_outside(mapper, cells, occupied):
+    (mapper.outside.update if occupied else mapper.outside.difference_update)(cells)
+    return cells
+
+
+if __name__ == '__main__':
+    mapper = map_script.MapMaker()
+    times = []
+    for a in sorted(TAGS):
+        for b in sorted(TAGS):
+            if a == b:
+                continue
+            for _ in range(REPEATS):
+                start = time.time()
+                path = mapper.plan_path(TAGS[a], TAGS[b])
+                times.append(time.time() - start)
+            print "%2d -> %2d: %s" % (a, b, path)
+
+    times = np.array(times) * 1000
+    print "%d plans: mean %.2f ms, p95 %.2f ms, max %.2f ms" % (
+        len(times), times.mean(), np.percentile(times, 95), times.max())
+
+    mapper = map_script.MapMaker()
+    routes = route_script.RouteTable(mapper, TAGS, filename=None)
+    routes.build()
+    # the table is told about changes by hand, to time them
+    mapper.change_listeners.remove(routes.map_changed)
+    rows, cols = mapper.my_map.shape
+    wall = [(r, cols // 2) for r in range(rows)]
+    cases = [('%d far cells occupied' % len(FAR_CELLS), lambda: set_outside(mapper, FAR_CELLS, True)),
+             ('%d far cells freed' % len(FAR_CELLS), lambda: set_outside(mapper, FAR_CELLS, False)),
+             ('wall of %d cells' % len(wall), lambda: mapper.set_cells(wall, 1))]
+    print "%-28s %8s %8s   (budget %.1f ms)" % ("map change", "ms", "dropped", 1000 * map_script.FUSION_BUDGET)
+    for name, flip in cases:
+        print "%-28s %8.2f %8d" % ((name,) + time_change(routes, flip))
+    mapper.set_cells(wall, 0)
+    routes.build()
+    routes.restore(routes.key(), dict(routes.routes), dict(routes.lengths))
+    print "%-28s %8.2f %8d" % (('far cells, routes from disk',) +
+                               time_change(routes, lambda: set_outside(mapper, FAR_CELLS, True)))
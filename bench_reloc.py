@@ -0,0 +1,62 @@
+"""
+Benchmark for relocalization (reloc_script) under odometry drift
+
+A first mission to every dispenser, without drift, learns where the ARTags are
+into a world store. Missions then run with heavy odometry drift and ARTag
+noise over a few seeds, each from a fresh copy of that store, relocalizing on
+the ARTags and on the EKF pose alone ('--reloc=off'). Reports how many
+missions finished, how often parking gave up on an ARTag (the robot got to
+where it thought the ARTag was and didn't find it) and the mission times.
+
+usage: python bench_reloc.py [seeds]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+
+import sim_script
+
+DISPENSERS = [2, 3, 4, 5, 6, 7]
+# trips run under drift
+MISSIONS = [4, [3, 5, 7, 6], [2, 4]]
+# with and without relocalization: name -> Main2 options
+MODES = [('reloc', []), ('odometry', ['--reloc=off'])]
+# sensor errors the missions run with
+MARKER_NOISE = 0.01
+ODOM_DRIFT = 2.0
+
+
+def run(options, store, seeds):
+    """
+    - Every mission of MISSIONS for every seed
+    :param: Main2 options, world store to start each mission from, number of seeds
+    :return: list of (finished, parking failures, simulated seconds)
+    """
+    out = []
+    copy = store + '.run'
+    for seed in range(seeds):
+        for tags in MISSIONS:
+            shutil.copy(store, copy)
+            world = sim_script.SimWorld(marker_noise=MARKER_NOISE, odom_drift=ODOM_DRIFT, seed=seed)
+            result = sim_script.run_mission(tags, 1, world=world, options=options + ['--world=' + copy])
+            out.append((result['completed'], result['park_failures'], result['sim_time']))
+    os.remove(copy)
+    return out
+
+
+if __name__ == '__main__':
+    seeds = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    store = os.path.join(tempfile.mkdtemp(), 'world.store')
+    learned = sim_script.run_mission(DISPENSERS, 1, options=['--world=' + store])
+    print "learned the ARTags in %.1f s, drift %.1f, ARTag noise %.2f m" % (
+        learned['sim_time'], ODOM_DRIFT, MARKER_NOISE)
+    print "%-10s %9s %9s %15s %10s %10s" % (
+        "pose", "missions", "finished", "parking failed", "median s", "max s")
+    for name, options in MODES:
+        results = np.array(run(options, store, seeds))
+        print "%-10s %9d %9d %15d %10.1f %10.1f" % (
+            name, len(results), results[:, 0].sum(), results[:, 1].sum(),
+            np.median(results[:, 2]), results[:, 2].max())
+    os.remove(store)
@@ -0,0 +1,93 @@
+"""
+Benchmark for starting Main2
+
+Starts the node on the simulator (sim_util) in a fresh interpreter every run,
+so imports are paid for every time, and reports the wall clock and CPU seconds
+of importing main.py and of Main2(), the seconds (simulated) spent waiting for
+the odometry reset to show in the EKF pose (the old start spun for a full
+second) and in how many runs the background import of cv2 was done by then.
+Main2 starts with no world store (routes from the route cache or planned),
+then from a world store written by a first run.
+
+usage: python bench_startup.py [runs]
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import numpy as np
+
+# runs of every case, the median is reported
+RUNS = 5
+
+
+def child(options):
+    """
+    - Start Main2 once and print its timings as JSON, run in a fresh interpreter
+    :param: Main2 options
+    """
+    import sim_util
+    import sim_script
+    sim_util.install()
+    world = sim_script.SimWorld()
+    sim_util.set_world(world)
+
+    began, cpu = time.time(), time.clock()
+    import main
+    import lazy_util
+    imported, imported_cpu = time.time() - began, time.clock() - cpu
+
+    sys.argv = ['main.py', '-', '1'] + options
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    began, cpu = time.time(), time.clock()
+    robot = main.Main2()
+    started, started_cpu = time.time() - began, time.clock() - cpu
+    sys.stdout = stdout
+    # keep the store, as Main2.shutdown() does
+    if robot.world.dirty:
+        robot.world.save()
+    print json.dumps({'import': imported, 'import_cpu': imported_cpu, 'init': started,
+                      'init_cpu': started_cpu, 'reset': world.now(), 'reset_seen': robot.odom_reset,
+                      'cv2': lazy_util.loaded(main.cv2)})
+
+
+def run(options, runs):
+    """
+    - Timings of starting Main2 `runs` times
+    :param: Main2 options, number of runs
+    :return: list of dictionaries, see child()
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = []
+    for _ in range(runs):
+        line = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child'] + options, cwd=here)
+        out.append(json.loads(line.strip().splitlines()[-1]))
+    return out
+
+
+if __name__ == '__main__':
+    if '--child' in sys.argv:
+        child(sys.argv[sys.argv.index('--child') + 1:])
+        sys.exit(0)
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    import sim_util
+    sim_util.install()
+    import main
+    store = os.path.join(tempfile.mkdtemp(), 'world.store')
+    # the first run writes the store the second case starts from
+    run(['--world=' + store], 1)
+    print "budget %.2f s, median of %d runs" % (main.STARTUP_BUDGET, runs)
+    print "%-10s %10s %10s %10s %10s %10s %10s %10s" % (
+        "world", "import ms", "cpu ms", "init ms", "cpu ms", "reset s", "in budget", "cv2 ready")
+    for name, options in [('none', ['--world=']), ('store', ['--world=' + store])]:
+        results = run(options, runs)
+        median = dict((k, np.median([r[k] for r in results])) for k in results[0])
+        print "%-10s %10.1f %10.1f %10.1f %10.1f %10.2f %10s %10s" % (
+            name, 1000 * median['import'], 1000 * median['import_cpu'], 1000 * median['init'],
+            1000 * median['init_cpu'], median['reset'],
+            median['import'] + median['init'] <= main.STARTUP_BUDGET,
+            "%d/%d" % (sum(r['cv2'] for r in results), runs))
+    os.remove(store)
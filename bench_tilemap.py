@@ -0,0 +1,101 @@
+"""
+Benchmark for tile_script.TileMap on a floor much bigger than my_map
+
+Drives a robot down a growing number of corridors of a large floor, fusing a
+fan of depth rays every step the way MapMaker.update_from_depth does, with
+dispensers (fine points) along the corridors. After each stage it reports the
+memory of the tiles against a dense float64 grid over the same bounding box,
+the time of a frame update and of point, region and ray queries, and the time
+MapMaker.plan_path takes from inside my_map to a place between the first two
+corridors PLAN_ROWS cells further down the floor, far beyond my_map, around
+the obstacles in the tiles.
+
+usage: python bench_tilemap.py [corridors]
+"""
+import sys
+import time
+import numpy as np
+
+import map_script
+import tile_script
+
+# corridors are this long and this far apart (cells), a dispenser every DISPENSER_GAP cells
+CORRIDOR = 400
+SPACING = 60
+DISPENSER_GAP = 50
+# rays per frame (every 8th column of a 640 wide frame), their reach (cells) and field of view
+RAYS = 80
+REACH = 20
+FOV = np.radians(58)
+# cells driven between frames
+STEP = 2
+# rows beyond the middle of my_map the planner is asked to reach
+PLAN_ROWS = 200
+# how many times every query runs, the median is reported
+REPEATS = 50
+
+
+def fan(r, c, heading, rng):
+    """
+    - Traced and end cells of a fan of rays, as MapMaker.trace_rays gives them
+    :return: (free rows, free cols, occupied rows, occupied cols)
+    """
+    angles = heading + np.linspace(-FOV / 2, FOV / 2, RAYS)
+    reach = rng.uniform(0.3, 1.0, RAYS) * REACH
+    end_r = np.rint(r + reach * np.cos(angles)).astype(int)
+    end_c = np.rint(c + reach * np.sin(angles)).astype(int)
+    dr, dc = end_r - r, end_c - c
+    steps = np.maximum(np.abs(dr), np.abs(dc))
+    k = np.arange(steps.max())
+    t = k[None, :] / np.maximum(steps, 1)[:, None].astype(float)
+    keep = k[None, :] < steps[:, None]
+    free_r = np.rint(r + t * dr[:, None])[keep].astype(int)
+    free_c = np.rint(c + t * dc[:, None])[keep].astype(int)
+    return free_r, free_c, end_r, end_c
+
+
+def median_time(run):
+    times = []
+    for _ in range(REPEATS):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    return np.median(times)
+
+
+if __name__ == '__main__':
+    corridors = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    rng = np.random.RandomState(189)
+    tiles = tile_script.TileMap()
+    window = map_script.GRID_SHAPE
+    mapper = map_script.MapMaker()
+    mapper.tiles = tiles
+    start = mapper.gridToMap((window[0] // 2, window[1] // 2))
+    print "%9s %10s %12s %12s %10s %10s %10s %10s %10s %9s" % (
+        "corridors", "tiles", "tiles KB", "dense KB", "frame us", "point us", "region us", "ray us",
+        "plan ms", "waypoints")
+    for i in range(corridors):
+        # corridors run along rows, one below the other
+        c = i * SPACING
+        for r in range(0, CORRIDOR, DISPENSER_GAP):
+            tiles.add_fine_point((r, c))
+        frames = [fan(r, c, 0.0, rng) for r in range(0, CORRIDOR, STEP)]
+        began = time.time()
+        for free_r, free_c, occ_r, occ_c in frames:
+            tiles.update(free_r, free_c, occ_r, occ_c, map_script.L_FREE, map_script.L_OCC,
+                         map_script.L_MIN, map_script.L_MAX)
+        frame_time = (time.time() - began) / len(frames)
+
+        r0, c0, r1, c1 = tiles.bounds()
+        dense = (r1 - r0) * (c1 - c0) * 8
+        rows, cols = rng.randint(r0, r1, 1000), rng.randint(c0, c1, 1000)
+        point = median_time(lambda: tiles.value(rows, cols)) / len(rows)
+        region = median_time(lambda: tiles.region(CORRIDOR // 2, c, CORRIDOR // 2 + window[0], c + window[1]))
+        ray = median_time(lambda: tiles.raycast((0, c), (CORRIDOR, c), map_script.OCC_THRESH))
+        began = time.time()
+        path = mapper.plan_path(start, mapper.gridToMap((window[0] // 2 + PLAN_ROWS, SPACING // 2)))
+        plan = time.time() - began
+        print "%9d %10d %12.1f %12.1f %10.1f %10.3f %10.1f %10.1f %10.1f %9s" % (
+            i + 1, len(tiles.keys), tiles.memory() / 1024.0, dense / 1024.0,
+            1e6 * frame_time, 1e6 * point, 1e6 * region, 1e6 * ray,
+            1e3 * plan, '-' if path is None else len(path))
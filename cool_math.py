@@ -4,9 +4,12 @@ List of functions that are useful and can now be referenced more easily
 import random
 import math
 from math import radians, degrees
-import cv2
 import numpy as np
 
+import lazy_util
+
+cv2 = lazy_util.lazy('cv2')
+
 
 def third_side(a, b, gamma):
     """
@@ -60,33 +63,16 @@ def prop_k_rot(radians_left):
 def centroid(contour):
     """
     Compute the (x,y) centroid position of the counter
+    (obstacle_script.blob_features gives the centroids of every blob of a mask at once)
     :param contour: OpenCV contour
-    :return: Tuple of (x,y) centroid position
-    """
-
-    def centroid_x(c):
-        """
-        Get centroid x position
-        :param c: OpenCV contour
-        :return: x position or -1
-        """
-        M = cv2.moments(c)
-        if M['m00'] == 0:
-            return -1
-        return int(M['m10'] / M['m00'])
-
-    def centroid_y(c):
-        """
-        Get centroid y position
-        :param c: OpenCV contour
-        :return: y position or -1
-        """
-        M = cv2.moments(c)
-        if M['m00'] == 0:
-            return -1
-        return int(M['m01'] / M['m00'])
-
-    return centroid_x(contour), centroid_y(contour)
+    :return: Tuple of (x,y) centroid position, (-1, -1) for an empty contour
+    """
+
+    # one moments computation for both coordinates
+    M = cv2.moments(contour)
+    if M['m00'] == 0:
+        return -1, -1
+    return int(M['m10'] / M['m00']), int(M['m01'] / M['m00'])
 
 def dist(pos):
     """
@@ -94,7 +80,7 @@ def dist(pos):
     :param pos: Tuple of position
     :return: Float distance of position from origin
     """
-    return np.sqrt(sum([i**2 for i in pos]))
+    return math.sqrt(sum(i * i for i in pos))
 
 
 def dist_btwn(pos1, pos2):
@@ -148,4 +134,70 @@ def sign(val):
     return 0
 
 
+# ----- Batch versions: NumPy arrays in, arrays out ------------
+# Each takes arrays (or scalars) that broadcast against each other, points and
+# poses with x, y in the last axis, and matches its scalar version element by element
+
+def third_side_batch(a, b, gamma):
+    """
+    - third_side() over arrays, NaN where rounding makes the square negative
+    (where third_side() raises ValueError)
+    :param: lengths, lengths, angles in radians
+    :return: array of lengths
+    """
+    a, b = np.asarray(a, float), np.asarray(b, float)
+    with np.errstate(invalid='ignore'):
+        return np.sqrt(a**2 + b**2 - (2 * a * b * np.cos(gamma)))
+
+def get_angle_ab_batch(a, b, c):
+    """
+    - get_angle_ab() over arrays: angle in radians between a and b, -1000 where
+    a or b is 0 or the angle is not acute
+    :param: lengths, lengths, lengths
+    :return: array of angles
+    """
+    a, b, c = np.asarray(a, float), np.asarray(b, float), np.asarray(c, float)
+    top = (a**2 + b**2) - c**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        both = top / (2 * a * b)
+    valid = (a != 0) & (b != 0) & (top > 0)
+    both = np.where(valid & (np.abs(both) <= 1), both, 1)
+    return np.where(valid, np.arccos(both), -1000.0)
+
+def dist_batch(pos):
+    """
+    - dist() over arrays
+    :param: array of positions, coordinates in the last axis
+    :return: array of distances from the origin
+    """
+    pos = np.asarray(pos, float)
+    return np.sqrt(np.einsum('...i,...i->...', pos, pos))
+
+def dist_btwn_batch(pos1, pos2):
+    """
+    - dist_btwn() over arrays
+    :param: arrays of (x, y) positions
+    :return: array of distances
+    """
+    d = np.asarray(pos1, float)[..., :2] - np.asarray(pos2, float)[..., :2]
+    return np.hypot(d[..., 0], d[..., 1])
 
+def orient_batch(curr_pos, goal_pos):
+    """
+    - orient() over arrays
+    :param: arrays of (x, y) current positions and goal positions
+    :return: array of headings in radians
+    """
+    curr_pos, goal_pos = np.asarray(curr_pos, float), np.asarray(goal_pos, float)
+    return np.arctan2(goal_pos[..., 1] - curr_pos[..., 1], goal_pos[..., 0] - curr_pos[..., 0])
+
+def angle_compare_batch(curr_angle, goal_angle):
+    """
+    - angle_compare() over arrays
+    :param: current angles, goal angles, in radians
+    :return: array of differences from -pi to +pi
+    """
+    pi2 = 2 * math.pi
+    angle_diff = np.mod(np.asarray(curr_angle, float) - goal_angle, pi2)
+    angle_diff = np.mod(angle_diff + pi2, pi2)
+    return np.where(angle_diff > math.pi, angle_diff - pi2, angle_diff)
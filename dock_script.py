@@ -0,0 +1,147 @@
+"""
+Docking at an ARTag in one smooth move
+
+DockPlanner plans a cubic Bezier curve in the ARTag's frame (see
+ar_script.robot_in_tag) from where the robot is to the pre-dock spot
+PRE_DOCK in front of the ARTag, arriving along its normal, then straight in to
+DOCK_DIST. The handle lengths are the ones with the gentlest peak curvature,
+all candidates scored at once with NumPy; when even those are sharper than
+MAX_CURVATURE (the robot faces well away from the ARTag) the curve starts
+towards the pre-dock spot and the robot turns on the spot first. The plan is
+tracked with a move_script.PathFollower fed the robot's pose in the ARTag frame
+from the filtered ARTag pose every tick, so new detections keep correcting where
+the robot is while the plan itself stays put. It is only planned again when
+the robot strays REPLAN_DIST from it.
+"""
+import math
+import numpy as np
+
+import move_script
+
+# distances (m) from the ARTag of the pre-dock spot and of the parking spot,
+# same as Main2's LL_DIST and CLOSE_DIST
+PRE_DOCK = 0.5
+DOCK_DIST = 0.23
+# closer than this (m) to the pre-dock spot, and in front of the parking spot,
+# the curve goes straight for the parking spot
+MIN_CURVE = 0.1
+# the robot is parked this close (m) to the ARTag's normal, further off it
+# goes round to the pre-dock spot again
+ARRIVE_LATERAL = 0.1
+# sharpest curve (1/m) driven without turning on the spot first
+MAX_CURVATURE = 1 / 0.3
+# handle lengths tried, as fractions of the distance to the end of the curve
+HANDLES = np.linspace(0.1, 0.9, 9)
+# points the curve is sampled at, and the spacing (m) of the straight part
+CURVE_SAMPLES = 30
+STRAIGHT_STEP = 0.05
+# the straight part goes on this far (m) past the parking spot, so the robot
+# steers along the normal rather than at a point up to the end
+RUN_ON = 0.3
+# the plan is made again when the robot is this far (m) off it
+REPLAN_DIST = 0.15
+
+# tracking, slower and with a shorter lookahead than move_script's path following
+DOCK_SPEED = 0.1  # m/s
+DOCK_LOOKAHEAD = 0.2  # m
+
+
+def bezier(p0, p1, p2, p3, samples=CURVE_SAMPLES):
+    """
+    - Points and peak curvature of cubic Bezier curves, any number of handle
+    pairs at once
+    :param: end points (x, y), handles as arrays of shape (n, 2)
+    :return: points of shape (n, samples, 2), peak curvatures (1/m) of shape (n,)
+    """
+    t = np.linspace(0, 1, samples)[None, :, None]
+    p0, p3 = np.asarray(p0, float), np.asarray(p3, float)
+    p1, p2 = np.asarray(p1, float)[:, None, :], np.asarray(p2, float)[:, None, :]
+    u = 1 - t
+    points = u**3 * p0 + 3 * u**2 * t * p1 + 3 * u * t**2 * p2 + t**3 * p3
+    d1 = 3 * u**2 * (p1 - p0) + 6 * u * t * (p2 - p1) + 3 * t**2 * (p3 - p2)
+    d2 = 6 * u * (p2 - 2 * p1 + p0) + 6 * t * (p3 - 2 * p2 + p1)
+    cross = d1[:, :, 0] * d2[:, :, 1] - d1[:, :, 1] * d2[:, :, 0]
+    speed = np.maximum(np.hypot(d1[:, :, 0], d1[:, :, 1]), 1e-9)
+    return points, (np.abs(cross) / speed**3).max(axis=1)
+
+
+class DockPlanner:
+    def __init__(self, pre_dock=PRE_DOCK, dock=DOCK_DIST, max_curvature=MAX_CURVATURE):
+        """
+        :param: distances (m) from the ARTag of the pre-dock and parking spots,
+        sharpest curve (1/m) driven without turning on the spot first
+        """
+        self.pre_dock = pre_dock
+        self.dock = dock
+        self.max_curvature = max_curvature
+        self.follower = move_script.PathFollower(max_speed=DOCK_SPEED, lookahead=DOCK_LOOKAHEAD)
+        # planned path in the ARTag frame, array of shape (n, 2), None until planned
+        self.path = None
+        # peak curvature (1/m) of the planned curve and whether the robot turns on the spot first
+        self.curvature = 0.0
+        self.turn_first = False
+
+    def reset(self):
+        """
+        - Forget the plan, used when parking starts
+        """
+        self.path = None
+        self.follower.last_time = None
+
+    def plan(self, pose):
+        """
+        - Plan the path to the parking spot from a pose in the ARTag frame
+        :param: (x, y, heading) of the robot in the ARTag frame
+        :return: path as an array of (x, y) points, ARTag frame
+        """
+        x, y, heading = pose
+        straight = np.arange(self.pre_dock - STRAIGHT_STEP, self.dock - RUN_ON, -STRAIGHT_STEP)
+        end = (self.pre_dock, 0.0)
+        if x < self.pre_dock + MIN_CURVE and abs(y) <= x - self.dock:
+            # already close, curve straight into the parking spot
+            end, straight = (self.dock, 0.0), straight[straight < self.dock]
+        chord = math.hypot(end[0] - x, end[1] - y)
+        direction = math.atan2(end[1] - y, end[0] - x)
+        # facing well away from the pre-dock spot: turn to it first
+        starts = [direction] if math.cos(heading - direction) < 0 else [heading, direction]
+        for start_heading in starts:
+            a, b = np.meshgrid(HANDLES * chord, HANDLES * chord)
+            a, b = a.ravel(), b.ravel()
+            p1 = np.column_stack((x + a * math.cos(start_heading), y + a * math.sin(start_heading)))
+            # arrive heading straight at the ARTag, i.e. along -x
+            p2 = np.column_stack((end[0] + b, np.full(len(b), end[1])))
+            points, curvature = bezier((x, y), p1, p2, end)
+            best = int(np.argmin(curvature))
+            if curvature[best] <= self.max_curvature:
+                break
+        self.turn_first = start_heading != heading
+        self.curvature = float(curvature[best])
+        tail = np.column_stack((straight, np.zeros(len(straight))))
+        self.path = np.concatenate((points[best][1:], tail))
+        self.follower.set_path((x, y), [tuple(p) for p in self.path])
+        return self.path
+
+    def off_path(self, pose):
+        """
+        - Distance (m) from the robot to the planned path
+        """
+        d = self.path - np.asarray(pose[:2], float)
+        return math.sqrt(np.einsum('ij,ij->i', d, d).min())
+
+    def arrived(self, pose):
+        """
+        - Whether the robot is at the parking spot
+        """
+        return pose[0] <= self.dock and abs(pose[1]) <= ARRIVE_LATERAL
+
+    def command(self, pose, now):
+        """
+        - Velocities for this tick, planning first when there is no plan or the
+        robot strayed from it
+        :param: (x, y, heading) of the robot in the ARTag frame, time (s)
+        :return: (linear m/s, angular rad/s)
+        """
+        if self.path is None or self.off_path(pose) > REPLAN_DIST:
+            self.plan(pose)
+        return self.follower.command(pose[:2], pose[2], now)
+
@@ -0,0 +1,237 @@
+"""
+Dynamic Window Approach local planner on the depth camera
+
+Depth frames become obstacle points (the closest return in every few columns
+of the horizon band), kept in the odometry frame for a few seconds so
+obstacles that leave the camera's narrow view while the robot turns past them
+are still avoided. Every control tick the planner samples (v, w) pairs
+reachable within the acceleration limits, rolls each out as an arc over
+HORIZON seconds, all at once with NumPy, drops the ones that come within
+ROBOT_RADIUS + SAFETY of an obstacle point, and picks the best by heading to
+the goal, clearance and speed, preferring any that keep moving. When the path
+follower's own command is clear enough, or brings the robot no closer to
+anything, it is used as is, so the planner only changes what the robot does
+near obstacles. When nothing is admissible the robot turns on the spot towards
+the more open side instead of stopping. Bumps leave points of their own, for
+the obstacles the camera never saw.
+"""
+import math
+import numpy as np
+
+import map_script
+import frame_script
+
+# robot footprint (m) and the clearance every trajectory must keep on top of
+# it, generous as the camera only sees the near face of things
+ROBOT_RADIUS = 0.18
+SAFETY = 0.05
+# the path follower's command is taken as is when it stays this clear (m)
+FOLLOW_CLEARANCE = 0.4
+
+# limits, same as move_script.PathFollower's
+MAX_SPEED = 0.2  # m/s
+MAX_ROT_SPEED = math.radians(45)  # rad/s
+ACCEL = 0.3  # m/s^2
+ROT_ACCEL = math.radians(120)  # rad/s^2
+PERIOD = 0.2  # s, control tick: the dynamic window is what one tick can reach
+
+# samples of the dynamic window, and steps and duration of every rollout
+V_SAMPLES = 11
+W_SAMPLES = 31
+STEPS = 10
+HORIZON = 2.0  # s
+
+# score = HEADING_WEIGHT * heading + CLEARANCE_WEIGHT * clearance + SPEED_WEIGHT * speed,
+# each term from 0 to 1 (clearance counts up to CLEARANCE_CAP m, further is as good)
+HEADING_WEIGHT = 1.0
+CLEARANCE_WEIGHT = 0.6
+SPEED_WEIGHT = 0.4
+CLEARANCE_CAP = 0.25
+# how far along the path (m) the point the candidates head for is, beyond
+# obstacles on the path
+GOAL_LOOKAHEAD = 0.6
+
+# depth to obstacle points: every POINT_STRIDE-th column of the horizon band,
+# returns closer than POINT_RANGE (m), kept MEMORY s and merged to POINT_CELL (m)
+POINT_STRIDE = 8
+POINT_RANGE = 2.0
+MEMORY = 3.0
+POINT_CELL = 0.05
+# bumps leave points across the front of the robot for BUMP_MEMORY s
+BUMP_MEMORY = 30.0
+BUMP_WIDTH = math.radians(60)
+# s without a command() call after which the robot is assumed stopped
+RESTART_GAP = 0.5
+
+
+def depth_points(depth, position, orientation, stride=POINT_STRIDE, max_range=POINT_RANGE):
+    """
+    - Obstacle points of a depth frame in the odometry frame: the closest
+    return in every `stride`th column of the horizon band
+    :param: depth image (m), EKF position (m) and orientation (rad) when it was taken
+    :return: array of shape (n, 2)
+    """
+    band = depth[map_script.FUSION_ROWS[0]:map_script.FUSION_ROWS[1], ::stride]
+    # fmin skips the NaNs the camera gives for no return
+    z = np.fmin.reduce(band, axis=0)
+    u = np.arange(0, depth.shape[1], stride, dtype=float)
+    with np.errstate(invalid='ignore'):
+        valid = (z > 0) & (z <= max_range)
+    forward = z[valid]
+    left = forward * (map_script.DEPTH_CX - u[valid]) / map_script.DEPTH_FX
+    to_world = frame_script.pose(position, orientation) * frame_script.pose(*map_script.CAMERA_POSE)
+    return to_world.apply_points(np.column_stack((forward, left)))
+
+
+def rollout(v, w, steps=STEPS, horizon=HORIZON):
+    """
+    - Poses along constant (v, w) arcs from the robot, all candidates at once
+    :param: arrays of linear (m/s) and angular (rad/s) velocities
+    :return: (x, y, heading) arrays of shape (candidates, steps), robot frame
+    """
+    t = np.linspace(horizon / steps, horizon, steps)[None, :]
+    v, w = v[:, None], w[:, None]
+    heading = w * t
+    straight = np.abs(w) < 1e-6
+    safe_w = np.where(straight, 1.0, w)
+    x = np.where(straight, v * t, v / safe_w * np.sin(heading))
+    y = np.where(straight, 0.0, v / safe_w * (1 - np.cos(heading)))
+    return x, y, heading
+
+
+class DWAPlanner:
+    def __init__(self, max_speed=MAX_SPEED, max_rot_speed=MAX_ROT_SPEED, accel=ACCEL,
+                 rot_accel=ROT_ACCEL, period=PERIOD):
+        """
+        :param: speed limits (m/s, rad/s), acceleration limits (m/s^2, rad/s^2),
+        control tick (s)
+        """
+        self.max_speed = max_speed
+        self.max_rot_speed = max_rot_speed
+        self.accel = accel
+        self.rot_accel = rot_accel
+        self.period = period
+        # (time to forget them, points in the odometry frame) of recent depth frames and bumps
+        self.frames = []
+        # last command and when
+        self.v = 0.0
+        self.w = 0.0
+        self.last_time = None
+        # whether the last command was the planner's own rather than the follower's
+        self.steering = False
+
+    def add_frame(self, depth, position, orientation, now):
+        """
+        - Remember the obstacles of a depth frame, forget old frames
+        :param: depth image (m), EKF position and orientation, time (s)
+        :return: None
+        """
+        self.frames.append((now + MEMORY, depth_points(depth, position, orientation)))
+        self.frames = [(t, p) for t, p in self.frames if t >= now]
+
+    def add_bump(self, position, orientation, now):
+        """
+        - Remember an obstacle the bumper found (the camera may never have seen it)
+        :param: EKF position and orientation, time (s)
+        :return: None
+        """
+        angles = orientation + np.linspace(-BUMP_WIDTH / 2, BUMP_WIDTH / 2, 5)
+        points = np.column_stack((position[0] + ROBOT_RADIUS * np.cos(angles),
+                                  position[1] + ROBOT_RADIUS * np.sin(angles)))
+        self.frames.append((now + BUMP_MEMORY, points))
+
+    def points(self, position, orientation, reach):
+        """
+        - Remembered obstacle points within `reach` of the robot, in its frame
+        (x ahead, y to the left), merged to POINT_CELL
+        :return: array of shape (n, 2)
+        """
+        if not self.frames:
+            return np.zeros((0, 2))
+        points = np.concatenate([p for _, p in self.frames])
+        local = frame_script.pose(position, orientation).inverse().apply_points(points)
+        local = local[np.einsum('ij,ij->i', local, local) <= reach * reach]
+        if len(local) == 0:
+            return local
+        return np.unique(np.round(local / POINT_CELL), axis=0) * POINT_CELL
+
+    def window(self):
+        """
+        - The (v, w) samples reachable within one control tick
+        :return: (v, w) arrays, one entry per candidate
+        """
+        dt = self.period
+        vs = np.linspace(max(0.0, self.v - self.accel * dt), min(self.max_speed, self.v + self.accel * dt), V_SAMPLES)
+        ws = np.linspace(max(-self.max_rot_speed, self.w - self.rot_accel * dt),
+                         min(self.max_rot_speed, self.w + self.rot_accel * dt), W_SAMPLES)
+        v, w = np.meshgrid(vs, ws)
+        return v.ravel(), w.ravel()
+
+    def clearance(self, v, w, points):
+        """
+        - Closest any obstacle point comes to the robot's centre along each rollout
+        :return: array of distances (m), inf without points
+        """
+        if len(points) == 0:
+            return np.full(len(v), np.inf)
+        x, y, _ = rollout(v, w)
+        dx = x[:, :, None] - points[:, 0]
+        dy = y[:, :, None] - points[:, 1]
+        return np.sqrt((dx * dx + dy * dy).min(axis=(1, 2)))
+
+    def score(self, v, w, goal, clearance):
+        """
+        - DWA objective of every candidate, -inf for the inadmissible ones
+        :param: candidate velocities, goal in the robot frame, their clearances
+        :return: array of scores
+        """
+        x, y, heading = rollout(v, w)
+        to_goal = np.arctan2(goal[1] - y[:, -1], goal[0] - x[:, -1])
+        error = np.abs((to_goal - heading[:, -1] + math.pi) % (2 * math.pi) - math.pi)
+        scores = HEADING_WEIGHT * (1 - error / math.pi) + \
+            CLEARANCE_WEIGHT * np.minimum(clearance - ROBOT_RADIUS, CLEARANCE_CAP) / CLEARANCE_CAP + \
+            SPEED_WEIGHT * v / self.max_speed
+        return np.where(clearance > ROBOT_RADIUS + SAFETY, scores, -np.inf)
+
+    def command(self, position, orientation, preferred, goal, now):
+        """
+        - Velocities for this tick: the path follower's when they keep clear of
+        obstacles, the best DWA candidate otherwise
+        :param: EKF position and orientation, follower's (v, w), point to head
+        for (GOAL_LOOKAHEAD along the path, odometry frame, m), time (s)
+        :return: (linear m/s, angular rad/s)
+        """
+        if self.last_time is None or now - self.last_time > RESTART_GAP:
+            self.v, self.w = 0.0, 0.0
+        self.last_time = now
+
+        reach = self.max_speed * HORIZON + ROBOT_RADIUS + CLEARANCE_CAP
+        points = self.points(position, orientation, reach)
+        v0, w0 = preferred
+        # the follower's command is fine when it stays clear or at least takes
+        # the robot no closer to anything than it is (turning on the spot)
+        now_clear = np.sqrt(np.einsum('ij,ij->i', points, points).min()) if len(points) else np.inf
+        follow_clear = self.clearance(np.array([v0]), np.array([w0]), points)[0]
+        if follow_clear >= FOLLOW_CLEARANCE or \
+                (follow_clear >= now_clear and follow_clear > ROBOT_RADIUS + SAFETY):
+            self.steering = False
+            self.v, self.w = v0, w0
+            return v0, w0
+
+        local_goal = frame_script.pose(position, orientation).inverse()(goal)
+        v, w = self.window()
+        scores = self.score(v, w, local_goal, self.clearance(v, w, points))
+        # standing still always looks good next to an obstacle: keep moving
+        # while any admissible candidate does
+        moving = v > 0
+        if np.isfinite(scores[moving]).any():
+            scores[~moving] = -np.inf
+        self.steering = True
+        best = int(np.argmax(scores))
+        if np.isfinite(scores[best]):
+            self.v, self.w = float(v[best]), float(w[best])
+        else:
+            # boxed in: turn on the spot towards the side with fewer points
+            side = 1 if (points[:, 1] > 0).sum() < (points[:, 1] < 0).sum() else -1
+            self.v, self.w = 0.0, side * self.max_rot_speed
+        return self.v, self.w
@@ -0,0 +1,449 @@
+"""
+Coordinator for several robots fetching from the same dispensers
+
+The Coordinator assigns every order to the robot that can finish it first and
+books the dispenser, and the corridor leading to it, for a time window, so two
+robots are never sent to park at the same place at the same time. Each robot
+gets its orders in ETA order and, once it is at a dispenser, claims it before
+parking: the claim is granted when the robot's window has come and nobody else
+is still parked there, otherwise the robot waits (or is booked again if it is late).
+
+Robots talk to the Coordinator through a client with the same interface
+either way: LocalClient calls it in the same process (for the simulator and
+tests), RosClient goes through the coordinator node (python fleet_script.py)
+over std_msgs/String topics carrying JSON.
+
+usage: python fleet_script.py
+"""
+import json
+
+import map_script
+import order_script
+
+# ---- timing model used for ETAs and windows ----
+# average speed driving between ARTags (m/s)
+DRIVE_SPEED = 0.1
+# time from reaching a dispenser to having backed out of it (s)
+PARK_TIME = 30.0
+# time from reaching home to having parked there (s)
+HOME_TIME = 20.0
+# the corridor to a dispenser is booked this long before its window (s)
+APPROACH_TIME = 10.0
+# dispensers whose parking spots are this close (map cells) share a corridor
+CORRIDOR_CELLS = 4
+
+# how often (s) a RosClient repeats a claim that hasn't been granted, or a
+# join the coordinator hasn't answered
+CLAIM_RETRY = 1.0
+
+REQUEST_TOPIC = 'fleet/requests'
+ORDER_TOPIC = 'fleet/orders'
+
+
+def corridor_groups(places, cells=CORRIDOR_CELLS):
+    """
+    - Group dispensers whose parking spots are close enough to share an approach
+    :param: dictionary of tag id -> map coordinates, distance in map cells
+    :return: dictionary of tag id -> corridor id (the smallest tag id in its group)
+    """
+    group = dict((tag, tag) for tag in places)
+
+    def find(tag):
+        while group[tag] != tag:
+            tag = group[tag]
+        return tag
+
+    tags = sorted(places)
+    for i, a in enumerate(tags):
+        for b in tags[i + 1:]:
+            (ax, ay), (bx, by) = places[a], places[b]
+            if max(abs(ax - bx), abs(ay - by)) <= cells:
+                ra, rb = find(a), find(b)
+                group[max(ra, rb)] = min(ra, rb)
+    return dict((tag, find(tag)) for tag in tags)
+
+
+class Robot:
+    """
+    What the Coordinator knows about one robot
+    """
+    def __init__(self, name, home, now):
+        self.name = name
+        self.home = home
+        # where the robot was last reported and when it was free there
+        self.at = home
+        self.free_at = now
+        # stops assigned and not done yet, ETA ordered: [tag, start, end]
+        self.plan = []
+        # tags assigned since the robot last polled
+        self.new = []
+        # dispenser the robot holds (claimed, not done), None if none
+        self.holding = None
+
+
+class Coordinator:
+    def __init__(self, cost, places, trip_stops=None, drive_time=None):
+        """
+        :param: function(a, b) giving the route length from ARTag a to b in map
+        cells (RouteTable.length), dictionary of tag id -> map coordinates,
+        dispensers a robot visits per trip (order_script.TRIP_STOPS by default),
+        function(m) giving the seconds to drive a route that long (DRIVE_SPEED
+        on average by default, the coordinator node uses move_script.move_time)
+        """
+        self.cost = cost
+        self.drive_time = drive_time or (lambda meters: meters / DRIVE_SPEED)
+        self.trip_stops = trip_stops or order_script.TRIP_STOPS
+        self.corridor = corridor_groups(places)
+        # name -> Robot
+        self.robots = {}
+        # resource -> list of (start, end, robot name, tag) booked windows, where
+        # a resource is ('dispenser', tag) or ('corridor', corridor id)
+        self.windows = {}
+        # resource -> name of the robot parked there (claimed, not done)
+        self.holders = {}
+
+    # ---- time model ----
+    def travel(self, a, b):
+        """
+        - Seconds to drive from ARTag a to ARTag b
+        """
+        return self.drive_time(self.cost(a, b) * map_script.world_map_ratio)
+
+    def resources(self, tag):
+        return [('dispenser', tag), ('corridor', self.corridor.get(tag, tag))]
+
+    def booked(self, tag, start, end, robot):
+        """
+        - First time after `start` a window clashing with [start, end] at the
+        dispenser or its corridor leaves free, None if the time is free. Corridor
+        windows start APPROACH_TIME before the dispenser window
+        """
+        for resource in self.resources(tag):
+            lead = APPROACH_TIME if resource[0] == 'corridor' else 0.0
+            for w_start, w_end, name, _ in self.windows.get(resource, []):
+                if name != robot and w_start - lead < end and start < w_end + lead:
+                    return w_end + lead
+        return None
+
+    def earliest_slot(self, tag, arrive, robot):
+        """
+        - Earliest window start at or after `arrive` that's free for the robot
+        :return: start time (s)
+        """
+        start = arrive
+        while True:
+            clash = self.booked(tag, start, start + PARK_TIME, robot)
+            if clash is None:
+                return start
+            start = clash
+
+    def book(self, robot, tag, start):
+        for resource in self.resources(tag):
+            self.windows.setdefault(resource, []).append((start, start + PARK_TIME, robot, tag))
+
+    def unbook(self, robot, tag):
+        for resource in self.resources(tag):
+            self.windows[resource] = [w for w in self.windows.get(resource, [])
+                                      if not (w[2] == robot and w[3] == tag)]
+
+    def next_free(self, robot, now):
+        """
+        - Where and when the robot will be able to start a new stop, following its
+        plan: trips of up to trip_stops dispensers, going home in between
+        :return: (tag, time (s), dispensers on the trip so far)
+        """
+        at, t = robot.at, max(robot.free_at, now)
+        on_trip = 0 if at == robot.home else 1
+        for tag, start, end in robot.plan:
+            at, t = tag, max(t, end)
+            on_trip += 1
+            if on_trip == self.trip_stops:
+                t += self.travel(at, robot.home) + HOME_TIME
+                at, on_trip = robot.home, 0
+        return at, t, on_trip
+
+    # ---- orders ----
+    def add_robot(self, name, home, now):
+        self.robots[name] = Robot(name, home, now)
+
+    def submit(self, tag, now):
+        """
+        - Assign an order to the robot that can finish it first and book its window
+        :param: ARTag of the dispenser, current time (s)
+        :return: (robot name, window start), None if there are no robots
+        """
+        best = None
+        for name in sorted(self.robots):
+            robot = self.robots[name]
+            booked = [stop[1] for stop in robot.plan if stop[0] == tag]
+            if booked:
+                # picked up at a stop the robot already makes
+                if best is None or booked[0] < best[1]:
+                    best = (name, booked[0])
+                continue
+            at, t, on_trip = self.next_free(robot, now)
+            if on_trip == 0 and at != robot.home:
+                # idle robots go home before starting a trip
+                t += self.travel(at, robot.home) + HOME_TIME
+                at = robot.home
+            start = self.earliest_slot(tag, t + self.travel(at, tag), name)
+            if best is None or start < best[1]:
+                best = (name, start)
+        if best is None:
+            return None
+        name, start = best
+        robot = self.robots[name]
+        robot.new.append(tag)
+        if not any(stop[0] == tag for stop in robot.plan):
+            robot.plan.append([tag, start, start + PARK_TIME])
+            robot.plan.sort(key=lambda stop: stop[1])
+            self.book(name, tag, start)
+        return best
+
+    def take(self, name):
+        """
+        - Orders assigned to a robot since it last asked, in ETA order
+        :return: list of ARTags
+        """
+        robot = self.robots[name]
+        eta = dict((stop[0], stop[1]) for stop in robot.plan)
+        new = sorted(robot.new, key=lambda tag: eta.get(tag, 0))
+        robot.new = []
+        return new
+
+    def queue(self, name):
+        """
+        - A robot's assigned stops, ETA ordered
+        :return: list of (tag, window start, window end)
+        """
+        return [tuple(stop) for stop in self.robots[name].plan]
+
+    # ---- at the dispenser ----
+    def claim(self, name, tag, now):
+        """
+        - A robot is at a dispenser and wants to park
+        - granted (returns a time <= now) when its window has started and nobody
+        else is parked at the dispenser or in its corridor; a robot that missed
+        its window is booked into the next free one, and an early robot moves its
+        window forward when nobody else needs the dispenser until then
+        :return: time (s) the robot may start parking
+        """
+        robot = self.robots[name]
+        stop = next((s for s in robot.plan if s[0] == tag), None)
+        if stop is None or stop[2] < now or \
+                (stop[1] > now and self.booked(tag, now, now + PARK_TIME, name) is None):
+            # not booked, late or early: take the next free window
+            if stop is not None:
+                robot.plan.remove(stop)
+                self.unbook(name, tag)
+            start = self.earliest_slot(tag, now, name)
+            stop = [tag, start, start + PARK_TIME]
+            robot.plan.append(stop)
+            robot.plan.sort(key=lambda s: s[1])
+            self.book(name, tag, start)
+        for resource in self.resources(tag):
+            holder = self.holders.get(resource)
+            if holder is not None and holder != name:
+                return max(stop[1], now + 1.0)
+        if stop[1] > now:
+            return stop[1]
+        for resource in self.resources(tag):
+            self.holders[resource] = name
+        robot.holding = tag
+        return now
+
+    def done(self, name, tag, now):
+        """
+        - A robot has backed out of a dispenser, free it and its corridor
+        """
+        robot = self.robots[name]
+        robot.plan = [s for s in robot.plan if s[0] != tag]
+        robot.at, robot.free_at = tag, now
+        robot.holding = None
+        self.unbook(name, tag)
+        for resource in self.resources(tag):
+            if self.holders.get(resource) == name:
+                del self.holders[resource]
+
+    def at_home(self, name, now):
+        """
+        - A robot is back home
+        """
+        robot = self.robots[name]
+        robot.at, robot.free_at = robot.home, now
+
+
+class LocalClient:
+    """
+    In-process stand-in for the coordinator node, what Main2 talks to
+    """
+    def __init__(self, coordinator, name, home, now):
+        self.coordinator = coordinator
+        self.name = name
+        coordinator.add_robot(name, home, now)
+
+    def poll(self):
+        """
+        - New orders for this robot, ETA ordered
+        """
+        return self.coordinator.take(self.name)
+
+    def claim(self, tag, now):
+        """
+        - Time the robot may park at the dispenser, <= now means go, None if unknown yet
+        """
+        return self.coordinator.claim(self.name, tag, now)
+
+    def done(self, tag, now):
+        self.coordinator.done(self.name, tag, now)
+
+    def at_home(self, now):
+        self.coordinator.at_home(self.name, now)
+
+
+class RosClient:
+    """
+    Talks to the coordinator node, answers arrive asynchronously. A claim is
+    only granted when the coordinator says so: a reply with a later start is a
+    reservation, and the claim is sent again until the coordinator grants it
+    (by then whoever held the dispenser may still be there). The join is sent
+    the same way until the coordinator answers it: rospy drops what is
+    published before the subscriber is connected, and the coordinator ignores
+    every request of a robot that hasn't joined
+    """
+    def __init__(self, name, home):
+        import rospy
+        from std_msgs.msg import String
+        self.rospy = rospy
+        self.String = String
+        self.name = name
+        self.orders = []
+        # tag -> (window start, whether the coordinator granted it) of its last
+        # reply, and tag -> when the coordinator was last asked
+        self.grants = {}
+        self.asked = {}
+        # home base sent with the join, whether the coordinator answered it and
+        # when it was last sent
+        self.home = home
+        self.joined = False
+        self.join_sent = None
+        self.requests = rospy.Publisher(REQUEST_TOPIC, String, queue_size=10)
+        rospy.Subscriber('fleet/' + name, String, self.process_reply)
+        self.join(rospy.get_time())
+
+    def send(self, op, **fields):
+        fields.update(op=op, robot=self.name, time=self.rospy.get_time())
+        self.requests.publish(self.String(data=json.dumps(fields)))
+
+    def join(self, now):
+        """
+        - Send the join again every CLAIM_RETRY until the coordinator answers it
+        :param: current time (s)
+        :return: whether the coordinator knows this robot
+        """
+        if not self.joined and (self.join_sent is None or now - self.join_sent >= CLAIM_RETRY):
+            self.join_sent = now
+            self.send('join', home=self.home)
+        return self.joined
+
+    def process_reply(self, msg):
+        reply = json.loads(msg.data)
+        if reply['op'] == 'joined':
+            self.joined = True
+        elif reply['op'] == 'orders':
+            self.orders.extend(reply['tags'])
+        elif reply['op'] == 'grant':
+            self.grants[reply['tag']] = (reply['start'], reply['granted'])
+
+    def poll(self):
+        self.join(self.rospy.get_time())
+        orders, self.orders = self.orders, []
+        return orders
+
+    def claim(self, tag, now):
+        """
+        - Time the robot may park at the dispenser, <= now means go, None if unknown yet
+        """
+        if not self.join(now):
+            return None
+        start, granted = self.grants.get(tag, (None, False))
+        if granted:
+            # a grant is used once, the next claim asks again
+            del self.grants[tag]
+            self.asked.pop(tag, None)
+            return start
+        if now - self.asked.get(tag, -float('inf')) >= CLAIM_RETRY:
+            self.asked[tag] = now
+            self.send('claim', tag=tag)
+        if start is None or start <= now:
+            # the reservation's time has come, but only the coordinator can grant it
+            return None
+        return start
+
+    def done(self, tag, now):
+        self.grants.pop(tag, None)
+        self.asked.pop(tag, None)
+        self.send('done', tag=tag)
+
+    def at_home(self, now):
+        self.send('home')
+
+
+class CoordinatorNode:
+    """
+    ROS node running the Coordinator for the fleet
+    """
+    def __init__(self, coordinator):
+        import rospy
+        from std_msgs.msg import String, Int32
+        self.rospy = rospy
+        self.String = String
+        self.coordinator = coordinator
+        # robot name -> publisher of its replies
+        self.replies = {}
+        rospy.init_node('fleet_coordinator', anonymous=False)
+        rospy.Subscriber(REQUEST_TOPIC, String, self.process_request)
+        rospy.Subscriber(ORDER_TOPIC, Int32, self.process_order)
+
+    def reply(self, name, **fields):
+        self.replies[name].publish(self.String(data=json.dumps(fields)))
+
+    def process_order(self, msg):
+        assigned = self.coordinator.submit(msg.data, self.rospy.get_time())
+        if assigned is None:
+            self.rospy.logwarn("no robots to fetch from ar tag %d", msg.data)
+            return
+        name = assigned[0]
+        self.reply(name, op='orders', tags=self.coordinator.take(name))
+
+    def process_request(self, msg):
+        request = json.loads(msg.data)
+        name, op, now = request['robot'], request['op'], self.rospy.get_time()
+        if op == 'join':
+            # joins are repeated until answered, a robot already known keeps its
+            # orders and bookings
+            if name not in self.coordinator.robots:
+                self.replies[name] = self.rospy.Publisher('fleet/' + name, self.String, queue_size=10)
+                self.coordinator.add_robot(name, request['home'], now)
+            self.reply(name, op='joined')
+        elif name not in self.coordinator.robots:
+            self.rospy.logwarn("request from unknown robot %s", name)
+        elif op == 'claim':
+            start = self.coordinator.claim(name, request['tag'], now)
+            self.reply(name, op='grant', tag=request['tag'], start=start, granted=start <= now)
+        elif op == 'done':
+            self.coordinator.done(name, request['tag'], now)
+        elif op == 'home':
+            self.coordinator.at_home(name, now)
+
+
+if __name__ == '__main__':
+    import rospy
+    import route_script
+    import move_script
+    import main
+    places = dict((k, v[0]) for k, v in main.AR_IDS.items())
+    routes = route_script.RouteTable(map_script.MapMaker(), places)
+    routes.load_or_build()
+    CoordinatorNode(Coordinator(routes.length, places, drive_time=move_script.move_time))
+    rospy.spin()
@@ -0,0 +1,180 @@
+"""
+Frames of the floor and the transforms between them
+
+A Transform is a planar rigid motion with a scale, p' = scale * R(theta) p + t,
+so one type covers the rigid frames (world, robot, camera, ARTags) and the
+scaled ones (map coordinates are world_map_ratio m, grid cells are map
+coordinates shifted by GRID_ORIGIN). Transforms compose with * and convert a
+single point, (x, y) arrays or an (n, 2) array of points with a few NumPy
+operations, no Python loop.
+
+FrameTree names the frames and the transform from each to its parent:
+    map                 map coordinates, the frame of Main2.AR_ids (the root)
+    grid                (r, c) cells of MapMaker.my_map
+    world               EKF odometry (m), reset at the home base
+    robot               x ahead, y to the left (m), at the EKF pose
+    camera              depth camera, x forward, y to the left (m)
+    ('tag', id)         ARTag id, x along its normal
+and gives the transform between any two of them, cached until a frame on the
+way from one to the other is set again. The map, grid, world and camera frames
+don't move while the robot runs, so converting between them costs one cached
+lookup.
+"""
+import math
+import numpy as np
+
+
+def to_cells(r, c):
+    """
+    - Nearest cells (or map coordinates) of fractional ones, a cell is centred
+    on its integer coordinates
+    :param: rows and cols, scalars or arrays
+    :return: (rows, cols), ints or int arrays
+    """
+    if np.isscalar(r) and np.isscalar(c):
+        return int(math.floor(r + 0.5)), int(math.floor(c + 0.5))
+    r = np.floor(np.asarray(r, float) + 0.5).astype(int)
+    c = np.floor(np.asarray(c, float) + 0.5).astype(int)
+    return r, c
+
+
+class Transform:
+    def __init__(self, x=0.0, y=0.0, theta=0.0, scale=1.0):
+        """
+        :param: translation, rotation (rad, CCW +) and scale of p' = scale * R(theta) p + t
+        """
+        self.x = float(x)
+        self.y = float(y)
+        self.theta = float(theta)
+        self.scale = float(scale)
+        # scaled rotation, used by every conversion
+        self.a = self.scale * math.cos(self.theta)
+        self.b = self.scale * math.sin(self.theta)
+
+    def __mul__(self, other):
+        """
+        - self * other: first other, then self
+        """
+        x, y = self.apply(other.x, other.y)
+        return Transform(x, y, self.theta + other.theta, self.scale * other.scale)
+
+    def __repr__(self):
+        return "Transform(%g, %g, %g, %g)" % (self.x, self.y, self.theta, self.scale)
+
+    def inverse(self):
+        """
+        - The transform undoing this one
+        """
+        scale = 1.0 / self.scale
+        c, s = math.cos(-self.theta), math.sin(-self.theta)
+        return Transform(-scale * (c * self.x - s * self.y), -scale * (s * self.x + c * self.y),
+                         -self.theta, scale)
+
+    def apply(self, x, y):
+        """
+        - Convert points given as x and y
+        :param: scalars or arrays of the same shape
+        :return: (x, y) in the target frame, floats or arrays
+        """
+        if np.isscalar(x) and np.isscalar(y):
+            # plain floats for a single point, NumPy would cost more than the arithmetic
+            return (float(self.a * x - self.b * y + self.x), float(self.b * x + self.a * y + self.y))
+        x, y = np.asarray(x, float), np.asarray(y, float)
+        return self.a * x - self.b * y + self.x, self.b * x + self.a * y + self.y
+
+    def __call__(self, point):
+        """
+        - Convert one (x, y) point, or a pair of x and y arrays
+        """
+        return self.apply(point[0], point[1])
+
+    def apply_points(self, points):
+        """
+        - Convert an (n, 2) array (or list of pairs) of points
+        :return: array of shape (n, 2)
+        """
+        points = np.asarray(points, float).reshape(-1, 2)
+        out = np.empty_like(points)
+        out[:, 0] = self.a * points[:, 0] - self.b * points[:, 1] + self.x
+        out[:, 1] = self.b * points[:, 0] + self.a * points[:, 1] + self.y
+        return out
+
+    def apply_pose(self, x, y, heading):
+        """
+        - Convert poses: positions and headings (rad)
+        :return: (x, y, heading), headings not wrapped
+        """
+        x, y = self.apply(x, y)
+        heading = np.asarray(heading, float) + self.theta
+        return x, y, float(heading) if heading.ndim == 0 else heading
+
+
+def pose(position, orientation):
+    """
+    - Transform from a frame at a pose (robot, camera, ARTag) to the frame the pose is in
+    :param: (x, y), heading (rad)
+    """
+    return Transform(position[0], position[1], orientation)
+
+
+class FrameTree:
+    def __init__(self, root='map'):
+        """
+        :param: name of the root frame
+        """
+        self.root = root
+        # frame -> (parent, transform from the frame to its parent)
+        self.parents = {}
+        # (source, target) -> (frames on the way, transform), see get()
+        self.cache = {}
+
+    def set(self, frame, parent, transform):
+        """
+        - Add a frame, or move one, forgetting the cached transforms it was part of
+        :param: frame name, parent frame name, Transform from the frame to the parent
+        :return: None
+        """
+        self.parents[frame] = (parent, transform)
+        stale = [k for k, (frames, _) in self.cache.items() if frame in frames]
+        for k in stale:
+            del self.cache[k]
+
+    def has(self, frame):
+        """
+        - Whether a frame is known
+        """
+        return frame == self.root or frame in self.parents
+
+    def to_root(self, frame):
+        """
+        - Transform from a frame to the root, and the frames on the way
+        """
+        transform, frames = Transform(), []
+        while frame != self.root:
+            if frame not in self.parents:
+                raise KeyError("unknown frame %r" % (frame,))
+            frames.append(frame)
+            parent, step = self.parents[frame]
+            transform = step * transform
+            frame = parent
+        return transform, frames
+
+    def get(self, source, target):
+        """
+        - Transform converting coordinates in `source` to coordinates in `target`
+        :param: frame names
+        :return: Transform
+        """
+        key = (source, target)
+        if key not in self.cache:
+            up, up_frames = self.to_root(source)
+            down, down_frames = self.to_root(target)
+            self.cache[key] = (set(up_frames + down_frames), down.inverse() * up)
+        return self.cache[key][1]
+
+    def convert(self, x, y, source, target):
+        """
+        - Convert points (scalars or arrays of x and y) between frames
+        :return: (x, y) in `target`
+        """
+        return self.get(source, target).apply(x, y)
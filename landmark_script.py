@@ -0,0 +1,265 @@
+"""
+Registry of every ARTag the robot knows of
+
+LandmarkTable.places is the plain dictionary of tag id -> (map coordinates,
+reach) that Main2.AR_ids always was, so looking a place up costs a dictionary
+lookup, and the table keeps what else is known of each ARTag in arrays indexed
+by its id, preallocated for MAX_TAGS ids (and grown if a bigger id shows up):
+    the place       parking spot, reach and whether it is a home base
+    the ARTag       map coordinates of the ARTag itself with their variance and
+                    the heading of its normal, once reloc_script learned them
+                    (NaN until then)
+    in view         the filtered pose of the ARTag seen from the robot, its
+                    covariance and the time stamp of the newest detection in it
+                    (NaN while it isn't tracked), and how many detections there were
+nearest() finds the places (or ARTags) closest to a point with one vectorized
+distance computation.
+
+It is the one table of ARTags: Main2.landmarks is the table world_script.WorldStore
+loads and saves, reloc_script.Relocalizer learns into it, and
+ar_script.TagEstimator records every AlvarMarkers message and odometry step in it.
+"""
+import numpy as np
+
+import ar_script
+
+# ids the arrays have room for to begin with, ar_track_alvar's ids are small
+MAX_TAGS = 32
+
+
+class LandmarkTable:
+    def __init__(self, places=None, homes=(), size=MAX_TAGS):
+        """
+        :param: dictionary of tag id -> [map coordinates, reach] (main.AR_IDS),
+        ids of the home bases, ids to make room for
+        """
+        # tag id -> (map coordinates, reach) of every place, Main2.AR_ids
+        self.places = {}
+        self.size = 0
+        self.grow(size)
+        # ids and spots (as floats) of the places for nearest(), rebuilt after a place changes
+        self.place_arrays = None
+        # functions called with the tag id when a place or ARTag pose changes
+        # (the ARTags in view aren't, they change too often)
+        self.change_listeners = []
+        for tag, (spot, reach) in sorted((places or {}).items()):
+            self.add_place(tag, spot, reach, tag in homes)
+
+    def grow(self, size):
+        """
+        - Make room for ids below `size`, keeping what is known
+        :param: number of ids
+        :return: None
+        """
+        if size <= self.size:
+            return
+        size = max(size, 2 * self.size)
+
+        def extend(name, shape, dtype, fill):
+            new = np.full((size,) + shape, fill, dtype)
+            if self.size:
+                new[:self.size] = getattr(self, name)
+            setattr(self, name, new)
+        # places
+        extend('placed', (), bool, False)
+        extend('spot', (2,), int, 0)
+        extend('reach', (), float, np.nan)
+        extend('home', (), bool, False)
+        # ARTags learned by reloc_script
+        extend('marker', (2,), float, np.nan)
+        extend('marker_var', (), float, np.nan)
+        extend('heading', (), float, np.nan)
+        # ARTags in view, from ar_script.TagEstimator: (forward, left, normal) in
+        # the robot frame, see ar_script.camera_pose and robot_in_tag
+        extend('pose', (3,), float, np.nan)
+        extend('cov', (3, 3), float, np.nan)
+        extend('stamp', (), float, np.nan)
+        extend('count', (), int, 0)
+        self.size = size
+
+    def clear(self):
+        """
+        - Forget every ARTag, keeping the room made for them
+        """
+        self.places.clear()
+        size, self.size = self.size, 0
+        self.grow(size)
+        self.place_arrays = None
+
+    def restore(self, tags, spots, reach, home, heading, marker, marker_var):
+        """
+        - Use a table kept from an earlier run (world_script), in place of this one
+        :param: arrays of tag ids, parking spots (n, 2), reach, home flags, headings,
+        ARTag map coordinates (n, 2) and their variances, NaN where not learned
+        :return: None
+        """
+        self.clear()
+        tags = np.asarray(tags, int)
+        if len(tags) == 0:
+            return
+        self.grow(int(tags.max()) + 1)
+        self.placed[tags] = True
+        self.spot[tags] = spots
+        self.reach[tags] = reach
+        self.home[tags] = home
+        self.heading[tags] = heading
+        self.marker[tags] = marker
+        self.marker_var[tags] = marker_var
+        for tag, spot, r in zip(tags.tolist(), self.spot[tags].tolist(), self.reach[tags].tolist()):
+            self.places[tag] = (tuple(spot), r)
+
+    def changed(self, tag):
+        for listener in self.change_listeners:
+            listener(tag)
+
+    # ---- places ----
+    def add_place(self, tag, spot, reach, home=False):
+        """
+        - Add (or move) the parking spot of an ARTag
+        :param: tag id, map coordinates, how close (m) the robot needs to get, whether it is a home base
+        :return: None
+        """
+        self.grow(tag + 1)
+        self.placed[tag] = True
+        self.spot[tag] = spot
+        self.reach[tag] = reach
+        self.home[tag] = home
+        self.places[tag] = (tuple(self.spot[tag].tolist()), float(reach))
+        self.place_arrays = None
+        self.changed(tag)
+
+    def set_home(self, tag):
+        """
+        - Make an ARTag a home base
+        """
+        if tag in self.places and not self.home[tag]:
+            self.home[tag] = True
+            self.changed(tag)
+
+    def homes(self):
+        """
+        - Ids of the home bases
+        """
+        return np.flatnonzero(self.placed & self.home).tolist()
+
+    # ---- ARTags learned by reloc_script ----
+    def learned(self, tag):
+        """
+        - Whether the pose of an ARTag is known
+        """
+        return 0 <= tag < self.size and not np.isnan(self.marker_var[tag])
+
+    def learned_ids(self):
+        return np.flatnonzero(~np.isnan(self.marker_var)).tolist()
+
+    def set_marker(self, tag, position, heading, var):
+        """
+        - Know where an ARTag is
+        :param: tag id, map coordinates, heading of its normal in the map (rad), variance (m^2)
+        :return: None
+        """
+        self.grow(tag + 1)
+        self.marker[tag] = position
+        self.heading[tag] = heading
+        self.marker_var[tag] = var
+        self.changed(tag)
+
+    # ---- ARTags in view, from ar_script.TagEstimator ----
+    def record(self, tags, pose, cov, stamp):
+        """
+        - Record the detections of an AlvarMarkers message, one assignment per array
+        :param: array of tag ids (repeats allowed), their filtered poses (n, 3),
+        covariances (n, 3, 3) and time stamps of the newest detection in them (s)
+        :return: None
+        """
+        if len(tags) and tags.max() >= self.size:
+            self.grow(tags.max() + 1)
+        self.pose[tags] = pose
+        self.cov[tags] = cov
+        self.stamp[tags] = stamp
+        np.add.at(self.count, tags, 1)
+
+    def moved(self, tags, pose, cov):
+        """
+        - The filtered poses of ARTags moved with the odometry
+        :param: array of tag ids, their poses (n, 3) and covariances (n, 3, 3)
+        :return: None
+        """
+        self.pose[tags] = pose
+        self.cov[tags] = cov
+
+    def forget(self, tags):
+        """
+        - ARTags no longer tracked
+        :param: array of tag ids
+        :return: None
+        """
+        self.pose[tags] = np.nan
+        self.cov[tags] = np.nan
+        self.stamp[tags] = np.nan
+
+    def tracked(self, tag):
+        """
+        - Whether there is a filtered pose of an ARTag
+        """
+        return 0 <= tag < self.size and not np.isnan(self.pose[tag, 0])
+
+    def detected(self, tag):
+        """
+        - Whether an ARTag was ever detected
+        """
+        return 0 <= tag < self.size and self.count[tag] > 0
+
+    def camera_pose(self, tag):
+        """
+        - Filtered (ar_x, ar_z, ar_orientation) of an ARTag, None if it isn't tracked
+        """
+        if not self.tracked(tag):
+            return None
+        return ar_script.camera_pose(*self.pose[tag])
+
+    def robot_pose(self, tag):
+        """
+        - The robot's pose in an ARTag's frame (see ar_script.robot_in_tag), None if it isn't tracked
+        """
+        if not self.tracked(tag):
+            return None
+        return ar_script.robot_in_tag(*self.pose[tag])
+
+    def age(self, tag, now):
+        """
+        - Seconds since the newest detection in an ARTag's pose (inf if it isn't tracked)
+        :param: tag id, current time (s)
+        """
+        if not self.tracked(tag):
+            return float('inf')
+        return now - self.stamp[tag]
+
+    # ---- queries ----
+    def nearest(self, point, k=1, learned=False, exclude=()):
+        """
+        - The places (or learned ARTags) closest to a point
+        :param: map coordinates, how many, whether to look at the learned ARTags
+        instead of the parking spots, ids to leave out
+        :return: (list of tag ids, array of distances in map coordinates), closest first
+        """
+        if learned:
+            ids = np.flatnonzero(~np.isnan(self.marker_var))
+            coords = self.marker[ids]
+        else:
+            if self.place_arrays is None:
+                ids = np.flatnonzero(self.placed)
+                self.place_arrays = (ids, self.spot[ids].astype(float))
+            ids, coords = self.place_arrays
+        if exclude:
+            keep = ~np.in1d(ids, list(exclude))
+            ids, coords = ids[keep], coords[keep]
+        d = np.hypot(coords[:, 0] - point[0], coords[:, 1] - point[1])
+        if k == 1 and len(ids):
+            i = d.argmin()
+            return [int(ids[i])], d[i:i + 1]
+        if k < len(ids):
+            part = np.argpartition(d, k)[:k]
+            ids, d = ids[part], d[part]
+        order = np.argsort(d, kind='mergesort')
+        return ids[order].tolist(), d[order]
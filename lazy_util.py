@@ -0,0 +1,80 @@
+"""
+Lazy imports for the heavy modules (cv2, tf, cv_bridge)
+
+lazy(name) gives a stand-in for a module that is only imported the first time
+one of its attributes is used, so importing main.py doesn't pay for OpenCV and
+the ROS Python packages before the node is even up. preload() imports them on
+a background thread once the node is started, so they are usually there by the
+time the first depth frame or pose needs them; a callback that gets there first
+just imports it itself (the import lock makes it wait for the preload rather
+than import twice).
+"""
+import sys
+import threading
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module that imports the real one on first attribute access and then
+    forwards everything to it
+    """
+    def __init__(self, name):
+        types.ModuleType.__init__(self, name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def loaded(self):
+        """
+        - Whether the real module has been imported yet
+        """
+        return self.__dict__['_module'] is not None
+
+
+def lazy(name):
+    """
+    - A module imported on first use, or the module itself if it already is imported
+    :param: dotted module name
+    :return: module or LazyModule
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
+
+
+def loaded(module):
+    """
+    - Whether a module given by lazy() has really been imported
+    """
+    return not isinstance(module, LazyModule) or module.loaded()
+
+
+def preload(modules):
+    """
+    - Import lazy modules on a background thread
+    :param: list of modules given by lazy()
+    :return: the thread, not a daemon: an import cut off by the interpreter 
+    exiting can take the process down with it
+    """
+    def load():
+        for module in modules:
+            if isinstance(module, LazyModule):
+                try:
+                    module._load()
+                except ImportError:
+                    # the callback that needs it will raise it
+                    pass
+    thread = threading.Thread(target=load, name='preload')
+    thread.start()
+    return thread
@@ -1,6 +1,6 @@
 """
 Program to allow a robot to "Fetch Candy" from Dispensers when the ARTag number and base location are passed in 
-:param: ARTag number, Base Station Number
+:param: ARTag number (or several, comma separated), Base Station Number, robot name when in a fleet
 :return: None
 
 Julia Pearl, Juliet Nwagw Ume-Ezeoke
@@ -10,39 +10,126 @@ Julia Pearl, Juliet Nwagw Ume-Ezeoke
 import random 
 import math
 from math import radians, degrees
-import cv2
 import numpy as np
 import sys
+import time
 
 #imports for rospy
 import rospy
 from geometry_msgs.msg import Twist
-import tf
 from kobuki_msgs.msg import BumperEvent, CliffEvent, WheelDropEvent, Sound
 from geometry_msgs.msg import PoseWithCovarianceStamped, Point, Quaternion, PointStamped
 from sensor_msgs.msg import Image
-from cv_bridge import CvBridge, CvBridgeError
-from std_msgs.msg import Empty
+from std_msgs.msg import Empty, Int32
 from ar_track_alvar_msgs.msg import AlvarMarkers
 
 # imports for other functions
 import map_script
 import move_script
+import obstacle_script
+import dwa_script
+import dock_script
+import route_script
+import ar_script
+import order_script
+import fleet_script
+import profile_script
+import record_script
+import world_script
+import reloc_script
 import cool_math as cm 
+import lazy_util
 
-# used for determining last number of 
-# seen ARTags that are the same
-from itertools import groupby
+# heavy modules, imported on a background thread once Main2 starts (see lazy_util.py)
+cv2 = lazy_util.lazy('cv2')
+tf = lazy_util.lazy('tf')
+cv_bridge = lazy_util.lazy('cv_bridge')
 
 # valid ids for AR Tags
 VALID_IDS = range(18)
 
 # values for initializing home
 Home = 1
+# ARTags of the home bases
+HOME_IDS = [1, 11]
+
+# dictionary for ar ids and coordinates, second number how close robot needs to be from ar tag
+AR_IDS = {
+    1: [(0, 0), 0.9],
+    11: [(-13, -1), 1.5],
+    2: [(-2, -9), 1,],
+    3: [(-18, -9), 0.8],
+    4: [(-31, -1), 1],
+    5: [(-23, 10), 1.5],
+    6: [(-15, 7), 0.9],
+    7: [(-9, 10), .75]}
 LEFT = -1
 RIGHT = 1
 
-# states in self.park(); i.e. descriptions for self.state2
+# map cells from the last ARTag within which its precomputed routes are used
+ROUTE_DIST = 2
+
+# seconds between plans while the local planner steers around something on the path
+REPLAN_PERIOD = 2.0
+
+# states that interrupt the others, see self.start_event()
+EVENT_STATES = ("bumped", "avoid_obstacle")
+
+# seconds to wait after a bump or obstacle, depending on how close the ARTag is
+BUMP_WAIT = 5
+BUMP_CLOSE_WAIT = 15
+AVOID_WAIT = 2
+OBSTACLE_CLOSE_WAIT = 5
+# ticks spent turning away from an obstacle before driving past it
+AVOID_TURN_TICKS = 2
+
+# ---- parking parameters, see self.park_step() ----
+# goal distance between robot and ARTag before perfect parking 
+LL_DIST = 0.5 # m
+# distance between ARTag and robot when robot is almost touching it 
+CLOSE_DIST = 0.23 # m
+# desired accuracy when zeroing in on ARTag 
+X_ACC = 0.07 # m
+# distance from the ARTag the robot backs out to after parking
+BACK_OUT_DIST = CLOSE_DIST * 3 # m
+
+# how long should the robot sleep under the dispenser
+SLEEP_TIME = 10 # seconds
+# used to have to the robot oscillate when it is lost 
+OSC_LIM = 20
+
+# theshold (control ticks) for losing and finding the ARTag
+MAX_LOST_TAGS = 10
+MIN_FOUND_TAGS = 3
+# how long the ARTag can be lost before parking is given up
+LOST_TIME = 5 # seconds
+# how long the robot steers by the filtered ARTag pose alone 
+# (moved with the odometry) before the ARTag counts as lost
+TRUST_TIME = 2 # seconds
+# same while following the path into the parking spot, which can turn 
+# the ARTag out of view on the way to the pre-dock spot
+DOCK_TRUST_TIME = 10 # seconds
+
+# sigma (m) of where the robot is once docked: the ARTag's parking spot in AR_ids, 
+# the position the relocalizer is given then
+DOCK_FIX_STD = 0.05
+
+# constants of proportionaly for setting speeds in self.park_step() only
+K_LIN = 0.25
+
+# --world=<file> keeps the map, ARTags and routes in another file than 
+# world_script.DEFAULT_FILE between runs, --world= keeps nothing
+WORLD_OPTION = '--world='
+
+# --park=sequence parks the old way: zero ar_x, turn alpha, move alpha_dist,
+# zero ar_x again and creep in, instead of following dock_script.DockPlanner's path
+PARK_SEQUENCE = '--park=sequence'
+
+# --reloc=off drives on the EKF pose alone, as before reloc_script, and 
+# doesn't learn where the ARTags are
+RELOC_OFF = '--reloc=off'
+
+# states in self.park_step(); i.e. descriptions for self.state2
 SEARCHING = 0
 ZERO_X = 1
 TURN_ALPHA = 2
@@ -51,10 +138,36 @@ MOVE_PERF  = 4
 SLEEPING = 5
 BACK_OUT = 6
 DONE_PARKING = 7
+DOCKING = 8
 SEARCHING_2 = -1
+# names of the park_step() states for the profiler
+PARK_STATE_NAMES = {SEARCHING: 'searching', ZERO_X: 'zero_x', TURN_ALPHA: 'turn_alpha',
+                    MOVE_ALPHA: 'move_alpha', MOVE_PERF: 'move_perf', SLEEPING: 'sleeping',
+                    BACK_OUT: 'back_out', DONE_PARKING: 'done_parking', SEARCHING_2: 'searching_2',
+                    DOCKING: 'docking'}
+
+# ---- startup, see self.reset_odometry() ----
+# seconds between odometry reset requests while waiting for the EKF to show the reset
+RESET_PERIOD = 0.05
+# the odometry is reset once the EKF pose is this close (m, rad) to the origin
+RESET_DIST = 0.02
+RESET_ANGLE = radians(2)
+# seconds to wait for that before starting anyway
+RESET_TIMEOUT = 3.0
+# seconds Main2() should take to start, a warning is logged when it takes longer
+STARTUP_BUDGET = 0.5
+
+# ---- profiling, see profile_script.py ----
+# period of the control loop (s), self.rate
+CONTROL_PERIOD = 0.2
+# time (s) one control tick may spend in a state, others get profile_script.DEFAULT_BUDGET
+STATE_BUDGETS = {'go_to_pos': 0.05}
 
 class Main2:
     def __init__(self):
+        began = time.time()
+        lazy_util.preload([cv2, tf, cv_bridge])
+
         # information about the robot's current position 
         # and orientation relative to start
         self.position = [0, 0]
@@ -67,6 +180,16 @@ class Main2:
 
         # move commands come from imported module 
         self.mover = move_script.MoveMaker()
+        # plans and tracks the path into the parking spot, unless parking the old way
+        self.docker = dock_script.DockPlanner(LL_DIST, CLOSE_DIST)
+        self.park_sequence = PARK_SEQUENCE in sys.argv
+        # every parking: ARTag, time it got there, seconds from first seeing the ARTag close 
+        # enough to the parking spot and lateral error (m, off the ARTag's normal, from the 
+        # filtered ARTag pose), and when parking at the current ARTag was first tried
+        self.docks = []
+        self.park_start = None
+        # times parking gave up on the ARTag and went back to go_to_pos
+        self.park_failures = 0
 
         # for obstacle handling 
         self.obstacle = False
@@ -75,13 +198,27 @@ class Main2:
         # obstacle is on 
         self.obs_side = 0 # left -1, right 1
 
+        # finds obstacles in depth frames, see obstacle_script.BACKENDS
+        self.detector = obstacle_script.make_detector(obstacle_script.DEFAULT_BACKEND)
+        # steers around obstacles in the depth frames while following a path
+        self.local_planner = dwa_script.DWAPlanner(period=CONTROL_PERIOD)
+
         # states: wait, go_to_pos, go_to_AR, handle_AR
         self.state = 'wait'
         self.prev_state = 'wait'
 
-        # used in park() to decrease confusion, see descriptions above
+        # used in park_step() to decrease confusion, see descriptions above
         self.state2 = None 
 
+        # end of the current wait, used instead of sleeping (see start_timer)
+        self.timer_end = None
+
+        # handling of bumps and obstacles, see handle_event: whether the 
+        # event still needs a reaction, moves left to play and seconds to wait after
+        self.event_new = False
+        self.event_moves = []
+        self.event_wait = 0
+
         # depth image for getting obstacles
         self.depth_image = []
 
@@ -92,21 +229,57 @@ class Main2:
         # key of AR_TAG we are seeking
         self.AR_curr = -1
 
-        # dictionary that stores information about current ARTag
-        self.markers = {}
-
-        # dictionary for ar ids and coordinates, second number how close robot needs to be from ar tag
-        self.AR_ids = {
-            1: [(0, 0), 0.9],
-            11: [(-13, -1), 1.5],
-            2: [(-2, -9), 1,],
-            3: [(-18, -9), 0.8],
-            4: [(-31, -1), 1],
-            51: [(-30, 1), 1.5], #fake location to get around table
-            5: [(-23, 10), 1.5],
-            61: [(-31, 8), 1.5], #fake location to get around table
-            6: [(-15, 7), 0.9],
-            7: [(-9, 10), .75]}
+        # waypoints (map coordinates) from the planner to reach AR_curr, 
+        # and the ARTag they were planned for
+        self.path = []
+        self.path_goal = None
+        self.path_time = None
+
+        # detections of the ARTag being parked at, to tell when it is lost
+        self.tag_tracker = ar_script.TagTracker()
+
+        # the map, ARTags and routes of earlier runs, memory-mapped into self.mapper
+        world_file = world_script.DEFAULT_FILE
+        for arg in sys.argv[1:]:
+            if arg.startswith(WORLD_OPTION):
+                world_file = arg[len(WORLD_OPTION):] or None
+        self.world = world_script.WorldStore(self.mapper, AR_IDS, HOME_IDS, world_file)
+        self.world.load()
+
+        # every ARTag: its parking spot and reach (see AR_IDS, the stored ones when 
+        # there is a store), where it is once learned and its filtered pose while 
+        # in view, a landmark_script.LandmarkTable
+        self.landmarks = self.world.tags
+        # tag id -> (map coordinates, reach) of every ARTag, its plain dictionary of places
+        self.AR_ids = self.landmarks.places
+        # the map is at full resolution around the ARTags, where the robot parks
+        for coords, _ in self.AR_ids.values():
+            self.mapper.add_fine_point(coords)
+
+        # corrects the EKF pose with every ARTag seen whose pose is known, the 
+        # ones learned in earlier runs to begin with
+        self.reloc = reloc_script.Relocalizer(self.mapper, self.landmarks)
+        self.relocalize = RELOC_OFF not in sys.argv
+
+        # routes between every pair of ARTags, planned once and kept in the store 
+        # (or cached on disk without one)
+        self.routes = route_script.RouteTable(self.mapper, dict((k, v[0]) for k, v in self.AR_ids.items()))
+        if not self.world.use_routes(self.routes):
+            self.routes.load_or_build()
+
+        # fetch orders waiting to be served, several are picked up per trip
+        self.orders = order_script.OrderQueue(self.routes.length)
+
+        # client of the fleet coordinator (see fleet_script.py) when 
+        # several robots share the dispensers, None when working alone
+        self.fleet = None
+
+        # ARTag the robot last parked at, routes start from there
+        self.AR_last = None
+
+        # ARTag of the home base, the map is calibrated to it
+        self.home = Home
+        self.mapper.set_home(self.AR_ids[self.home][0])
 
 
         # vector orientation of ARTag relative to robot 
@@ -120,6 +293,11 @@ class Main2:
         # distance between robot and ARTag 
         self.ar_z = 0 # m
 
+        # filters of every ARTag in view, moved with the odometry between 
+        # detections; they record the poses in self.landmarks, ar_x, ar_z and 
+        # ar_orientation come from there
+        self.tag_estimator = ar_script.TagEstimator(self.landmarks)
+
         # if there's an obstacle and we are really 
         # close to the ar_tag, it's probably another robot
         self.close = False 
@@ -132,484 +310,707 @@ class Main2:
         # Initialize the node
         rospy.init_node('Main2', anonymous=False)
 
+        # times every callback and control tick, dumped to profile_script.PROFILE_FILE
+        self.profiler = profile_script.Profiler(CONTROL_PERIOD, STATE_BUDGETS, clock=rospy.get_time)
+        timed = self.profiler.timed
+
+        # --record=<file> records the sensor streams, replayed with record_script,
+        # --compress zlibs the depth frames
+        self.recorder = None
+        for arg in sys.argv[1:]:
+            if arg.startswith('--record='):
+                self.recorder = record_script.Recorder(arg[len('--record='):], cv_bridge.CvBridge().imgmsg_to_cv2,
+                                                       compress='--compress' in sys.argv)
+        recorded = self.recorded
+
         # Tell user how to stop TurtleBot
         rospy.loginfo("To stop TurtleBot CTRL + C")
         # What function to call when you ctrl + c    
         rospy.on_shutdown(self.shutdown)
 
         # Subscribe to topic for AR tags
-        rospy.Subscriber('/ar_pose_marker', AlvarMarkers, self.process_ar_tags)
+        rospy.Subscriber('/ar_pose_marker', AlvarMarkers, timed('process_ar_tags', recorded(record_script.MARKERS, self.process_ar_tags)))
 
         # Create a publisher which can "talk" to TurtleBot wheels and tell it to move
         self.cmd_vel = rospy.Publisher('wanderer_velocity_smoother/raw_cmd_vel',Twist, queue_size=10)
 
         # Subscribe to robot_pose_ekf for odometry/position information
-        rospy.Subscriber('/robot_pose_ekf/odom_combined', PoseWithCovarianceStamped, self.process_ekf)
+        rospy.Subscriber('/robot_pose_ekf/odom_combined', PoseWithCovarianceStamped, timed('process_ekf', recorded(record_script.EKF, self.process_ekf)))
 
         # Set up the odometry reset publisher (publishing Empty messages here will reset odom)
-        reset_odom = rospy.Publisher('/mobile_base/commands/reset_odometry', Empty, queue_size=1)
-        # Reset odometry (these messages take about a second to get through)
+        self.reset_odom = rospy.Publisher('/mobile_base/commands/reset_odometry', Empty, queue_size=1)
+        # whether a reset was asked for, and whether the EKF has shown it since
+        self.resetting = False
+        self.odom_reset = False
         self.state_change_time = rospy.Time.now()
-        timer = rospy.Time.now()
-        while rospy.Time.now() - timer < rospy.Duration(1) or self.position is None:
-            reset_odom.publish(Empty())
+        if not self.reset_odometry():
+            rospy.logwarn("no EKF pose at the origin %.1f s after resetting the odometry" % RESET_TIMEOUT)
 
-        # Use a CvBridge to convert ROS image type to CV Image (Mat)
-        self.bridge = CvBridge()
+        # Use a CvBridge to convert ROS image type to CV Image (Mat), made with the first depth image
+        self.bridge = None
         # Subscribe to depth topic
-        rospy.Subscriber('/camera/depth/image', Image, self.process_depth_image, queue_size=1, buff_size=2 ** 24)
+        rospy.Subscriber('/camera/depth/image', Image, timed('process_depth_image', recorded(record_script.DEPTH, self.process_depth_image)),
+                         queue_size=1, buff_size=2 ** 24)
 
         # Subscribe to queues for receiving sensory data, primarily for bumps 
-        rospy.Subscriber('mobile_base/events/bumper', BumperEvent, self.process_bump_sensing)
+        rospy.Subscriber('mobile_base/events/bumper', BumperEvent, timed('process_bump_sensing', recorded(record_script.BUMP, self.process_bump_sensing)))
         self.sounds = rospy.Publisher('mobile_base/commands/sound', Sound, queue_size=10)
 
+        # Subscribe to new fetch orders and cancellations
+        rospy.Subscriber('fetch_candy/order', Int32, timed('process_order', self.process_order))
+        rospy.Subscriber('fetch_candy/cancel', Empty, timed('process_cancel', self.process_cancel))
+
         # TurtleBot will stop if we don't keep telling it to move.  How often should we tell it to move? 5 Hz
-        self.rate = rospy.Rate(5)
+        self.rate = rospy.Rate(1 / CONTROL_PERIOD)
+
+        # seconds (wall clock) Main2() took
+        self.startup_time = time.time() - began
+        if self.startup_time > STARTUP_BUDGET:
+            rospy.logwarn("startup took %.2f s, budget %.2f s" % (self.startup_time, STARTUP_BUDGET))
+        else:
+            rospy.loginfo("started in %.3f s" % self.startup_time)
 
         
    
+    def reset_odometry(self):
+        """
+        - Reset the odometry and wait for the EKF to show it: a pose near the 
+        origin after the first request. The request is sent again every 
+        RESET_PERIOD (they take a moment to get through) until then, or until RESET_TIMEOUT
+        :param: None
+        :return: True if the reset was seen
+        """
+        self.odom_reset = False
+        self.resetting = True
+        began = rospy.get_time()
+        while not self.odom_reset and rospy.get_time() - began < RESET_TIMEOUT:
+            self.reset_odom.publish(Empty())
+            rospy.sleep(RESET_PERIOD)
+        self.resetting = False
+        # the robot is at the home base, where the world frame starts
+        self.reloc.reset()
+        return self.odom_reset
+
     def execute_command(self, my_move):
         """
         - Just a function to decrease repetion when executing move commands
+        - only publishes, run() sleeps once per control tick
         :param: a move command with linear and angular velocity set, see move_scipt.py
         :return: None
         """
-        if (self.state is not "bumped" or self.state is not "avoid_obstacle"):
-            move_cmd = my_move
-            self.cmd_vel.publish(move_cmd)
-            self.rate.sleep()
-    
+        self.cmd_vel.publish(my_move)
+
+    def start_timer(self, secs):
+        """
+        - Start the timer used instead of sleeping, see timer_done
+        :param: seconds
+        :return: None
+        """
+        self.timer_end = rospy.Time.now() + rospy.Duration(secs)
+
+    def timer_done(self):
+        """
+        - Whether the timer from start_timer has run out
+        :return: boolean
+        """
+        return self.timer_end is not None and rospy.Time.now() > self.timer_end
+
+    def start_event(self, event):
+        """
+        - Interrupt whatever the robot is doing with a bump or an obstacle,
+        handled from the next control tick on (see handle_event)
+        - a second event of the same kind while one is being handled is ignored
+        :param: 'bumped' or 'avoid_obstacle'
+        :return: None
+        """
+        if self.state == event:
+            return
+        if self.state not in EVENT_STATES:
+            self.prev_state = self.state
+        self.state = event
+        self.event_new = True
+
     def run(self):
         """
         - Control the state that the robot is currently in 
-        - Run until Ctrl+C pressed
+        - Run until Ctrl+C pressed, one step per control tick
         :return: None
         """
 
-        # get ar_tag desired from argument
-        self.AR_curr = int(sys.argv[1])
-        Home = int(sys.argv[2])
-        
-        
-        # treat obstacle cases 5 and 6
-        if (self.AR_curr == 5 or self.AR_curr == 6):
-            self.AR_curr = self.AR_curr*10 + 1
+        # get ar_tags desired from argument, options (--record=...) aside
+        args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+        self.home = int(args[1])
+        self.mapper.set_home(self.AR_ids[self.home][0])
+        self.AR_last = self.home
+        self.landmarks.set_home(self.home)
+        # '-' for none, e.g. for a robot that takes its orders from the fleet
+        for tag in args[0].split(','):
+            if tag not in ('', '-'):
+                self.add_order(int(tag))
+
+        # a robot name joins the fleet, orders then come from the coordinator
+        if len(args) > 2:
+            self.fleet = fleet_script.RosClient(args[2], self.home)
+            self.orders.keep_order = True
 
         while not rospy.is_shutdown():
-            move_cmd = Twist()
-
-            #bumped or obstacle scenarios:
-            if (self.state is "bumped" or self.state is "avoid_obstacle"):
-                self.sounds.publish(Sound.ON)
-                sec = 0
-
-                # bumped when not very close to ar_tag
-                if (self.state == "bumped" and not self.close_VERY):
-                    print "bump when not very close to ar_tag"
-                    sec = 5
-
-                # bump when very close to ar_tag
-                elif (self.state == "bumped" and self.close_VERY):
-                    print "obstacle when very close to ar_tag!!"
-                    sec = 15
-
-                # obstacle while ar_tag not spotted: while there is obs, turn then move forwards
-                elif (self.state == "avoid_obstacle" and self.close == False):
-                    while(self.obs_side is not 0):
-                        for i in range (2):
-                            self.execute_command(self.mover.avoid_obstacle(self.obs_side))
-                        obs_side = 0
-                    self.execute_command(self.mover.go_forward())
-                    sec = 2
-                    self.prev_state = 'avoid_obstacle'
-                    self.state = "go_to_pos"
-
-                # obstacle at point ar_tag spotted
-                else:
-                    print "obstacle, moderately close to ar tag"
-                    sec = 5
-                rospy.sleep(sec)
-                self.prev_state = 'avoid_obstacle'
-                self.state = "go_to_pos"
-                
-
-            # wait stage (beginning and end)
-            if (self.state == 'wait'):
-                # just wait around 
-                self.close_VERY = True
-                move_cmd = self.mover.wait()
-                if (self.AR_curr != -1):
-                    print "changing state to go_to_pos"
-                    self.prev_state = 'wait'
-                    self.state = 'go_to_pos'
-
-            # go to ekf position
-            if (self.state == 'go_to_pos'):
-                orienting = True 
+            state = self.profile_state()
+            began = time.time()
+            self.step()
+            self.profiler.tick(state, began, time.time())
+            # keep what was learnt about the map
+            self.world.save_if_changed(rospy.get_time())
+            self.rate.sleep()
 
-                # orienting stage 
-                if (not(self.AR_seen) or self.ar_z >= self.AR_ids[self.AR_curr][1]):
-            
-                    # adjust angle to face EKF position
-                    if (orienting):
-                        pos = self.AR_ids[self.AR_curr][0]
-                        dest_orientation = cm.orient(self.mapper.positionToMap(self.position, self.AR_ids[Home][0]), pos)
-                        angle_dif = cm.angle_compare(self.orientation, dest_orientation)
-                        if (abs(float(angle_dif)) < abs(math.radians(5)) and self.state is not "bumped"):
-                            self.close_VERY = False  
-                            move_cmd = self.mover.go_to_pos("forward", self.position, self.orientation)
-                            orienting = False
-                            time = 3
-                            if (self.AR_seen):
-                                time = 1
-                            for i in range (time):
-                                self.execute_command(move_cmd)
-                        else:
-                            
-                            # Turn in the relevant direction
-                            if angle_dif < 0:
-                                move_cmd = self.mover.go_to_pos("left", self.position, self.orientation) 
-                            else:
-                                move_cmd = self.mover.go_to_pos("right", self.position, self.orientation)
-                                
-                            self.execute_command(move_cmd)
-                            
-                    if (not orienting):
-                        # big ar tag means edge case: 5/6 going to or returning from ar_tag
-                        if ((self.AR_curr > 10)):
-                            print "big ar tag"
-                            travel_time = 100
-                            issue = False
-                            if (self.AR_curr == (Home*10) + 1):
-                                travel_time = 20 
-                            for i in range(travel_time):
-                                if (self.state is not "bumped" or self.state is not "avoid_obstacle"):  
-                                    move_cmd = self.mover.go_to_pos("forward", self.position, self.orientation)
-                                    self.execute_command(move_cmd)
-                                else:
-                                    issue = True
-                                    break
-                            if (not issue):
-                                self.AR_curr = (self.AR_curr - 1) / 10
-                                orienting = True
-            
-                # when ar is seen and robot is close enough, change states
-                if (self.AR_seen and self.ar_z < self.AR_ids[self.AR_curr][1]):
-                    print "see AR"
-                    self.sounds.publish(Sound.ON)
-                    self.prev_state = 'go_to_pos'
-                    self.state = 'go_to_AR'
-            
-            # go to the ARTag
-            if (self.state == "go_to_AR"): 
+    def recorded(self, kind, callback):
+        """
+        - Wrap a subscriber callback so its messages are recorded first, when recording
+        :param: record_script stream kind, function(msg)
+        :return: function(msg)
+        """
+        if self.recorder is None:
+            return callback
+        recorder = self.recorder
 
-                # set parameters for obstacle avoidance during parking 
-                self.close = False
-                self.close_VERY = True
+        def record(msg):
+            recorder.add(kind, msg, rospy.get_time())
+            return callback(msg)
+        return record
 
-                # set the initial state for the parking sequence and call park
-                self.state2 = SEARCHING
-                park_check = self.park()
+    def profile_state(self):
+        """
+        - Name of the state for the profiler, parking states get their own
+        :return: string
+        """
+        if (self.state == 'go_to_AR'):
+            return 'go_to_AR:' + PARK_STATE_NAMES.get(self.state2, str(self.state2))
+        return self.state
 
-                # only continue with main run sequence if parking was succesful
-                if park_check == -1:
-                    print "parking unsuccesful - going back to go to pos"
-                    self.AR_seen = False
+    def step(self):
+        """
+        - Advance the robot's state machine by one control tick, publishing at 
+        most one move command. Never blocks, so bumps, obstacles and 
+        cancellations are acted on at the next tick
+        :return: None
+        """
+        # orders the fleet coordinator assigned to this robot
+        if (self.fleet is not None):
+            for tag in self.fleet.poll():
+                self.add_order(tag)
+
+        #bumped or obstacle scenarios:
+        if (self.state in EVENT_STATES):
+            self.handle_event()
+
+        # wait stage (beginning and end)
+        elif (self.state == 'wait'):
+            # just wait around 
+            self.close_VERY = True
+            self.execute_command(self.mover.wait())
+
+            # start a trip when there are orders
+            if (self.AR_curr == -1 and len(self.orders) > 0):
+                start = self.AR_last if self.AR_last is not None else self.home
+                print "trip to ar tags " + str(self.orders.start_trip(start, self.home))
+                self.AR_curr = self.orders.next_stop()
+
+            if (self.AR_curr != -1):
+                print "changing state to go_to_pos"
+                self.prev_state = 'wait'
+                self.state = 'go_to_pos'
+
+        # go to ekf position
+        elif (self.state == 'go_to_pos'):
+            self.travel_step()
+
+        # go to the ARTag
+        elif (self.state == "go_to_AR"): 
+            park_check = self.park_step()
+
+            # only continue with main run sequence if parking was succesful
+            if park_check == -1:
+                print "parking unsuccesful - going back to go to pos"
+                self.park_failures += 1
+                self.AR_seen = False
+                self.state = 'go_to_pos'
+            elif park_check == 0:
+                # return from handle ar!
+                print "parking succesful"
+                self.AR_seen = False
+                self.AR_last = self.AR_curr
+                self.prev_state = 'go_to_AR'
+                
+                if (self.AR_curr != self.home):
+                    # go to the next dispenser of the trip, or home
+                    self.orders.picked_up(self.AR_curr)
+                    if (self.fleet is not None):
+                        self.fleet.done(self.AR_curr, rospy.get_time())
+                    next_stop = self.orders.next_stop()
+                    self.AR_curr = next_stop if next_stop is not None else self.home
                     self.state = 'go_to_pos'
+        
+                # already home
                 else:
-                    # return from handle ar!
-                    print "parking succesful"
-                    self.AR_seen = False
-                    
-                    
-                    if (self.AR_curr is not Home):
-                        # edge cases:
-                        if (self.AR_curr == 6 or self.AR_curr == 5):
-                            self.AR_curr = (Home * 10) + 1
-                        else:
-                        # go home
-                            self.AR_curr = Home
-                        self.prev_state = 'go_to_AR'
-                        self.state = 'go_to_pos'
-            
-                    # already home
-                    else:
-                        self.AR_curr = -1
-                        self.prev_state = 'go_to_AR'
-                        self.state = 'wait'
-                    self.cmd_vel.publish(move_cmd)
-                    self.rate.sleep()
-
+                    print "delivered %d orders" % self.orders.arrived_home()
+                    if (self.fleet is not None):
+                        self.fleet.at_home(rospy.get_time())
+                    self.AR_curr = -1
+                    self.state = 'wait'
 
-
-    def park(self):
+    def handle_event(self):
         """
-        - Control the parking that the robot does, has secondary control of the robot's state 
+        - One tick of dealing with a bump or an obstacle: pick a reaction when 
+        the event is new, play its moves one per tick, then wait on the timer 
+        before going back to go_to_pos
         :return: None
         """
+        if (self.event_new):
+            self.event_new = False
+            self.sounds.publish(Sound.ON)
+            self.event_moves = []
+            sec = 0
+
+            # bumped when not very close to ar_tag
+            if (self.state == "bumped" and not self.close_VERY):
+                print "bump when not very close to ar_tag"
+                sec = BUMP_WAIT
+
+            # bump when very close to ar_tag
+            elif (self.state == "bumped" and self.close_VERY):
+                print "obstacle when very close to ar_tag!!"
+                sec = BUMP_CLOSE_WAIT
+
+            # obstacle while ar_tag not spotted: turn away then move forwards
+            elif (self.state == "avoid_obstacle" and self.close == False):
+                side = self.obs_side
+                self.event_moves = [lambda: self.mover.avoid_obstacle(side)] * AVOID_TURN_TICKS + \
+                    [self.mover.go_forward]
+                sec = AVOID_WAIT
+
+            # obstacle at point ar_tag spotted
+            else:
+                print "obstacle, moderately close to ar tag"
+                sec = OBSTACLE_CLOSE_WAIT
+            self.event_wait = sec
+            self.timer_end = None
+
+        # moves are played one per tick
+        if (len(self.event_moves) > 0):
+            self.execute_command(self.event_moves.pop(0)())
+            return
+
+        if (self.timer_end is None):
+            self.start_timer(self.event_wait)
+        if (not self.timer_done()):
+            self.execute_command(self.mover.wait())
+            return
+
+        self.obs_side = 0
+        self.prev_state = self.state
+        self.state = "go_to_pos"
+        # robot has been pushed off its path, plan again from where it is
+        self.path_goal = None
+
+    def travel_step(self):
+        """
+        - One tick of go_to_pos: follow the planned path (move_script.PathFollower)
+        until the ARTag is seen close enough to park
+        :return: None
+        """
+        # orienting stage 
+        if (not(self.AR_seen) or self.ar_z >= self.AR_ids[self.AR_curr][1]):
+            # where the robot is in map coordinates, not rounded to a cell (the 
+            # planner does that) so it is compared with the ARTags as it is
+            my_pos = self.mapper.frames.convert(self.position[0], self.position[1], 'world', 'map')
+
+            # plan a path around known obstacles whenever the target changes, 
+            # and again while something the camera sees is in the way
+            now = rospy.get_time()
+            if (self.path_goal != self.AR_curr or 
+                    (self.local_planner.steering and now - self.path_time > REPLAN_PERIOD)):
+                self.plan_path(my_pos)
+    
+            # drive along the path, turning on the way
+            self.close_VERY = False
+            move_cmd = self.mover.follow_path(self.position, self.orientation, now, self.local_planner)
+            self.execute_command(move_cmd)
+    
+        # another robot has the dispenser booked or is parked there, wait for our turn
+        elif (not self.dispenser_granted()):
+            rospy.loginfo_throttle(5, "waiting for dispenser %d" % self.AR_curr)
+            self.execute_command(self.mover.wait())
+
+        # when ar is seen and robot is close enough, change states
+        else:
+            print "see AR"
+            self.sounds.publish(Sound.ON)
+            self.prev_state = 'go_to_pos'
+            self.state = 'go_to_AR'
+            self.start_parking()
+            self.execute_command(self.mover.wait())
+
+    def dispenser_granted(self):
+        """
+        - Whether the robot may park at AR_curr: always when working alone, 
+        when the fleet coordinator grants the claim otherwise
+        :return: boolean
+        """
+        if (self.fleet is None or self.AR_curr == self.home):
+            return True
+        now = rospy.get_time()
+        start = self.fleet.claim(self.AR_curr, now)
+        return start is not None and start <= now
 
-        # goal distance between robot and ARTag before perfect parking 
-        LL_DIST = 0.5 # m
-        # distance between ARTag and robot when robot is almost touching it 
-        CLOSE_DIST = 0.23 # m
-        # desired accuracy when zeroing in on ARTag 
-        X_ACC = 0.07 # m
-        # parameters for limiting robots movement
-        ALPHA_DIST_CLOSE = 0.01 # m
-        ALPHA_RAD_CLOSE = radians(0.8) # radians
-
-        # how long should the robot sleep under the dispenser
-        SLEEP_TIME = 10
-        # used to have to the robot oscillate when it is lost 
-        OSC_LIM = 20
+    def plan_path(self, my_pos):
+        """
+        - Plan waypoints from the robot to the ARTag being sought, 
+        falls back on driving straight at the ARTag if there is no path
+        - uses the precomputed route when the robot is still at the last ARTag
+        :param: robot position in map coordinates
+        :return: None
+        """
+        goal = self.AR_ids[self.AR_curr][0]
+        if (self.AR_last is not None and cm.dist_btwn(my_pos, self.AR_ids[self.AR_last][0]) <= ROUTE_DIST):
+            path = self.routes.lookup(self.AR_last, self.AR_curr)
+        else:
+            path = self.mapper.plan_path(my_pos, goal)
+        if path is None:
+            print "no path found to ar tag " + str(self.AR_curr)
+            path = [goal]
+        self.path = path
+        self.path_goal = self.AR_curr
+        self.path_time = rospy.get_time()
+        self.mover.set_path(self.position, self.mapper.frames.get('map', 'world').apply_points(path).tolist())
+
+    def start_parking(self):
+        """
+        - Reset everything park_step keeps between ticks and begin parking
+        :return: None
+        """
+        # set parameters for obstacle avoidance during parking 
+        self.close = False
+        self.close_VERY = True
 
-        # theshold for losing and finding the ARTag
-        MAX_LOST_TAGS = 10
-        MIN_FOUND_TAGS = 3
+        # set the initial state for the parking sequence
+        self.state2 = SEARCHING
 
-        # constants of proportionaly for setting speeds in self.park() only
-        K_LIN = 0.25
+        # used to decide what side of the robot the ARTag is on
+        self.theta_org = 0
+        # magnitude of the small angle between the robot and ARTag
+        self.beta = 0
 
         # distance between robot and parfet spot to park from 
-        alpha_dist = 0 # m
+        self.alpha_dist = 0 # m
         # radians between robot and angle to move 'alpha_dist'
-        alpha = 0 # radians
+        self.alpha = 0 # radians
 
-        # used to determine how long to sleep 
-        sleep_count = 0
         # determine robot velocity when lost
-        osc_count = 0 
+        self.osc_count = 0 
         # keep track of how long robot has been lost 
-        lost_timer = None # seconds
+        self.lost_timer = None # seconds
 
         # boolean to move straight to ARTag at certain points
-        almost_perfet = False
+        self.almost_perfet = False
 
-        # arrays to save information about robot's history 
-        past_orr = []
-        past_pos = []
-        past_xs = []
+        # orientation when the robot started turning alpha, position when 
+        # it started moving alpha_dist and ar_z when it started backing out
+        self.turn_start = None
+        self.move_start = None
+        self.back_start = None
 
+        # counts the ticks the ARTag has been in or out of view
+        self.tag_tracker.reset()
+
+        # path into the parking spot is planned on the first DOCKING tick
+        self.docker.reset()
+        # time-to-dock counts from the first try at this ARTag
+        if self.park_start is None:
+            self.park_start = rospy.get_time()
+
+    def park_step(self):
+        """
+        - One tick of the parking that the robot does, has secondary control of the robot's state 
+        :return: None while parking, 0 when parked and backed out, -1 if the ARTag was lost
+        """
         # just used for easier reading 
         ang_velocity = 0
 
-        while not rospy.is_shutdown(): 
-            while self.state is not "bumped" or self.state is not "avoid_obstacle":
+        # was the ARTag detected since the last tick
+        self.tag_tracker.tick()
+
+        # use the filtered ARTag pose, it keeps up with the robot's 
+        # motion between detections
+        tag_pose = self.landmarks.camera_pose(self.AR_curr)
+        if tag_pose is not None:
+            self.ar_x, self.ar_z, self.ar_orientation = tag_pose
+        tag_age = self.landmarks.age(self.AR_curr, rospy.Time.now().to_sec())
+        
+        # only begin parking when the ARTag has been located
+        if self.state2 is SEARCHING:
+            if not self.landmarks.detected(self.AR_curr):
+                self.execute_command(self.mover.wait())
+                return None
+            print "in SEARCHING"
+
+            # used to decide what side of the robot the ARTag is on
+            self.theta_org = self.ar_orientation
+
+            # using the magnitude of the small angle 
+            # between the robot and ARTag, beta, for most calculations 
+            self.beta = abs(radians(180) - abs(self.theta_org))   
+            self.state2 = ZERO_X if self.park_sequence else DOCKING
+
+
+        # handle event of ARTag being lost during the parking sequence
+        # this has high priority over other states
+        elif self.state2 is SEARCHING_2:
+            print "in SEARCHING 2 - ar tag lost"
+
+            self.turn_start = None # forget the turn in progress
+
+            # if the ARTag has been detected for a few ticks in a row, 
+            # it has been found, return to parking
+            if self.tag_tracker.found(MIN_FOUND_TAGS):
+                print "found tag again!"
+                self.osc_count = 0 # clear counter for oscillations
+                self.state2 = ZERO_X if self.park_sequence else DOCKING
+            
+            # if the ARTag has been lost for too long, 
+            # return that parking was unsuccesful
+            if rospy.Time.now() - self.lost_timer > rospy.Duration(LOST_TIME):
+                print "cant find tag, going to return!"
+                self.execute_command(self.mover.wait())
+                return -1
+
+            # oscillate while looking for ARTag to 
+            # maximize chances of finding it again
+            if self.state2 is SEARCHING_2:
+                self.osc_count+=1 
+                self.osc_count = self.osc_count % OSC_LIM
+                if self.osc_count < OSC_LIM * 0.5:  
+                    self.execute_command(self.mover.twist(radians(-30)))
+                else:
+                    self.execute_command(self.mover.twist(radians(30)))
+                return None
+
+
+        # follow a smooth path from where the robot is into the parking spot
+        if self.state2 == DOCKING:
+            print "in docking"
+            robot_pose = self.landmarks.robot_pose(self.AR_curr)
+
+            # lost for longer than the filtered pose can be trusted
+            if robot_pose is None or (self.tag_tracker.lost(MAX_LOST_TAGS) and tag_age > DOCK_TRUST_TIME):
+                self.lost_timer = rospy.Time.now() # track how long the ARTag has been lost 
+                self.state2 = SEARCHING_2
+                self.execute_command(self.mover.wait())
+
+            elif self.docker.arrived(robot_pose):
+                self.docked()
+
+            else:
+                v, w = self.docker.command(robot_pose, rospy.get_time())
+                self.execute_command(self.mover.drive(v, w))
+
+        # turn to face the ARTag 
+        elif self.state2 is ZERO_X:
+            print "in zero x"
+
+            # keep track of whether the ARTag is still in view or is lost, 
+            # for a short while the filtered pose is good enough to turn back to it
+            if self.tag_tracker.lost(MAX_LOST_TAGS) and tag_age > TRUST_TIME:
+                self.lost_timer = rospy.Time.now() # track how long the ARTag has been lost 
+                self.state2 = SEARCHING_2
+                self.execute_command(self.mover.wait())
+                
+            
+            # turn until ar_x is almost 0
+            elif abs(self.ar_x) > X_ACC:
+                ang_velocity = self.ar_x * cm.prop_k_rot(self.ar_x)
+                self.execute_command(self.mover.twist(-ang_velocity))
+            
+            # triangulate distances and angles to guide 
+            # robot's parking and move to next state
+            else: 
+                # only want to move to the ARTag if parking sequence is almost complete
+                if self.almost_perfet == True:
+                    self.almost_perfet = False
+                    self.state2 = MOVE_PERF
+                else:    
+                    self.alpha_dist = cm.third_side(self.ar_z, LL_DIST, self.beta) # meters
+                    self.alpha = cm.get_angle_ab(self.ar_z, self.alpha_dist, LL_DIST) # radians
+                    self.state2 = TURN_ALPHA
+                self.execute_command(self.mover.wait())
+
+
+        # turn away from AR_TAG by a small angle alpha
+        elif self.state2 is TURN_ALPHA:
+            print "in turn alpha"
+
+            # if robot is already close to ARTag, it should just park  
+            if self.ar_z <= CLOSE_DIST * 2.5: 
+                print "dont need to turn - z distance is low"
+                self.state2 = MOVE_PERF
+                self.execute_command(self.mover.wait())
+
+            # alpha will be exceptionally high when LL_DIST 
+            # is much greater than ar_z + alpha_dist - only need to park
+            elif abs(self.alpha) > 100:
+                print "dont need to turn - alpha is invalid"
+                self.state2 = MOVE_PERF
+                self.execute_command(self.mover.wait())
+            
+            # regular operation of just turning alpha
+            else: 
+                # turn away from the ARTag, as fast as the base allows 
+                # without overshooting (move_script.Profile)
+                now = rospy.get_time()
+                if self.turn_start is None:
+                    self.turn_start = self.orientation
+                    # robot on left side of ARTag turns right
+                    self.mover.start_turn(-abs(self.alpha) if self.theta_org < 0 else abs(self.alpha), now)
+                turned = cm.angle_compare(self.orientation, self.turn_start)
+
+                if not self.mover.profile_done(turned, now):
+                    self.execute_command(self.mover.profile_step(turned, now))
+                else:
+                    self.turn_start = None # forget the finished turn
+                    self.execute_command(self.mover.wait())
+                    self.state2 = MOVE_ALPHA
+
+
+        # move to a position that makes parking convenient
+        elif self.state2 == MOVE_ALPHA:
+            print "in move alpha"
+            # keep track of how far robot has moved since it entered 'MOVE_ALPHA'
+            now = rospy.get_time()
+            if self.move_start is None:
+                self.move_start = self.position
+                self.mover.start_move(abs(self.alpha_dist), now)
+            dist_traveled =  cm.dist_btwn(self.position, self.move_start)
+
+            # dont need to move ALPHA_DIST anymore, robot is right up against AR_TAG
+            if self.ar_z < CLOSE_DIST*2.5:
+                self.move_start = None
+                self.state2 = MOVE_PERF
+                self.execute_command(self.mover.wait())
+
+            # travel until the alpha_dist has been moved - need this to be very accurate
+            elif not self.mover.profile_done(dist_traveled, now):
+                self.execute_command(self.mover.profile_step(dist_traveled, now))
+                print "dist2go in move alpha " + str(abs(self.alpha_dist) - dist_traveled)
+
+            # turn to face ARTag before moving directly to it 
+            else: 
+                self.move_start = None # forget the finished move
                 
-                # only begin parking when the ARTag has been 
-                # located and saved in markers dictionary
-                if self.state2 is SEARCHING and len(self.markers) > 0:
-                    print "in SEARCHING"
+                # check if the ARTag data is valid before zeroing x
+                if self.tag_tracker.lost(MAX_LOST_TAGS*2):
+                    self.lost_timer = rospy.Time.now() # track how long the ARTag has been lost 
+                    self.state2 = SEARCHING_2
+                # now zero ar_x 
+                elif abs(self.ar_x) > X_ACC:
+                    self.state2 = ZERO_X
+                    self.almost_perfet = True
+                else:
+                    self.state2 = MOVE_PERF
+                self.execute_command(self.mover.wait())
 
-                    # used to decide what side of the robot the ARTag is on
-                    theta_org = self.ar_orientation
+        # move in a straight line to the ar tag 
+        elif self.state2 == MOVE_PERF:
+            print "in move perf"
 
-                    # using the magnitude of the small angle 
-                    # between the robot and ARTag, beta, for most calculations 
-                    beta = abs(radians(180) - abs(theta_org))   
+            if self.ar_z < CLOSE_DIST * 3 and self.ar_z > CLOSE_DIST * 2:
+                print "ar_x" + str(self.ar_x)
+                if abs(self.ar_x) > X_ACC:
                     self.state2 = ZERO_X
+                    self.almost_perfet = True
 
+            # the ARTag went out of view to the side, turn back to it
+            elif self.tag_tracker.lost(MAX_LOST_TAGS) and abs(self.ar_x) > X_ACC:
+                self.state2 = ZERO_X
+                self.almost_perfet = True
 
-                # handle event of ARTag being lost during the parking sequence
-                # this has high priority over other states
-                elif self.state2 is SEARCHING_2:
-                    print "in SEARCHING 2 - ar tag lost"
-
-                    # keep track of ar_x, which would only 
-                    # be updated when ARTag is in view
-                    del past_orr [:] # clear list of past positions
-                    past_xs.append(self.ar_x) 
-
-                    # if ar_x is being updated, then ARTag has been found, 
-                    # return to parking
-                    if len(past_xs) > MIN_FOUND_TAGS:
-                        if not any(sum(1 for _ in g) > MAX_LOST_TAGS*0.5 for _, g in groupby(past_xs)):
-                            print "found tag again!"
-                            osc_count = 0 # clear counter for oscillations
-                            del past_xs [:] # clear list of past ar_xs
-                            self.state2 = ZERO_X
-                    
-                    # if the ARTag has been lost for too long, 
-                    # return that parking was unsuccesful
-                    if rospy.Time.now() - lost_timer > rospy.Duration(5):
-                        print "cant find tag, going to return!"
-                        return -1
-
-                    # oscillate while looking for ARTag to 
-                    # maximize chances of finding it again
-                    osc_count+=1 
-                    osc_count = osc_count % OSC_LIM
-                    if osc_count < OSC_LIM * 0.5:  
-                        self.execute_command(self.mover.twist(radians(-30)))
-                    else:
-                        self.execute_command(self.mover.twist(radians(30)))
-
-
-                # turn to face the ARTag 
-                if self.state2 is ZERO_X:
-                    print "in zero x"
-
-                    # keep track of whether the ARTag is still in view or is lost
-                    past_xs.append(self.ar_x)
-                    if any(sum(1 for _ in g) > MAX_LOST_TAGS for _, g in groupby(past_xs)):
-                        lost_timer = rospy.Time.now() # track how long the ARTag has been lost 
-                        self.state2 = SEARCHING_2
-                        
-                    
-                    # turn until ar_x is almost 0
-                    elif abs(self.ar_x) > X_ACC:
-                        ang_velocity = self.ar_x * cm.prop_k_rot(self.ar_x)
-                        self.execute_command(self.mover.twist(-ang_velocity))
-                    
-                    # triangulate distances and angles to guide 
-                    # robot's parking and move to next state
-                    else: 
-                        # only want to move to the ARTag if parking sequence is almost complete
-                        if almost_perfet == True:
-                            almost_perfet = False
-                            self.state2 = MOVE_PERF
-                        else:    
-                            alpha_dist = cm.third_side(self.ar_z, LL_DIST, beta) # meters
-                            alpha = cm.get_angle_ab(self.ar_z, alpha_dist, LL_DIST) # radians
-                            self.state2 = TURN_ALPHA
-
-
-                # turn away from AR_TAG by a small angle alpha
-                elif self.state2 is TURN_ALPHA:
-                    print "in turn alpha"
-
-                    # if robot is already close to ARTag, it should just park  
-                    if self.ar_z <= CLOSE_DIST * 2.5: 
-                        print "dont need to turn - z distance is low"
-                        self.state2 = MOVE_PERF
-
-                    # alpha will be exceptionally high when LL_DIST 
-                    # is much greater than ar_z + alpha_dist - only need to park
-                    elif abs(alpha) > 100:
-                        print "dont need to turn - alpha is invalid"
-                        self.state2 = MOVE_PERF
-                    
-                    # regular operation of just turning alpha
-                    else: 
-                        # keep track of how much robot has turned 
-                        # since it entered 'alpha' state
-                        past_orr.append(self.orientation)
-                        dif =  cm.angle_compare(self.orientation,past_orr[0])
-                        rad2go = abs(alpha) - abs(dif)
-
-                        # want to always turn away from the ARTag until 
-                        # robot has almost turned alpha
-                        if rad2go > ALPHA_RAD_CLOSE: 
-                            if theta_org < 0: # robot on left side of ARTag 
-                                rad2go = rad2go * -1
-                            # cm.prop_k_rot() helps the robot turn significantly 
-                            # faster when rad2go is very small
-                            ang_velocity = rad2go * cm.prop_k_rot(rad2go)
-                            self.execute_command(self.mover.twist(ang_velocity)) 
-                       
-                        else:
-                          del past_orr [:] # clear list of past orientations
-                          self.execute_command(self.mover.wait())
-                          self.state2 = MOVE_ALPHA
-
-
-                # move to a position that makes parking convenient
-                elif self.state2 == MOVE_ALPHA:
-                    print "in move alpha"
-                    # store info about ar_x as robot moves
-                    past_xs.append(self.ar_x)
-
-                    # keep track of how far robot has moved since it entered 'MOVE_ALPHA'
-                    past_pos.append(self.position)
-                    dist_traveled =  cm.dist_btwn(self.position, past_pos[0])
-                    dist2go = abs(alpha_dist) - abs(dist_traveled)
-
-                    # travel until the alpha_dist has been moved - need this to be very accurate
-                    if dist2go > ALPHA_DIST_CLOSE and dist2go > CLOSE_DIST*2.5:
-                        self.execute_command(self.mover.go_forward_K(K_LIN*alpha_dist))
-                        print "dist2go in move alpha " + str(dist2go)
-                    # dont need to move ALPHA_DIST anymore, robot is right up against AR_TAG
-                    elif self.ar_z < CLOSE_DIST*2.5:
-                         self.state2 = MOVE_PERF
-
-                    # turn to face ARTag before moving directly to it 
-                    else: 
-                        del past_pos [:] # clear list of past positions
-                        
-                        # check if the ARTag data is valid before zeroing x
-                        if any(sum(1 for _ in g) > MAX_LOST_TAGS*2 for _, g in groupby(past_xs)):
-                            lost_timer = rospy.Time.now() # track how long the ARTag has been lost 
-                            self.state2 = SEARCHING_2
-                        # now zero ar_x 
-                        elif abs(self.ar_x) > X_ACC:
-                            self.state2 = ZERO_X
-                            almost_perfet = True
-                        else:
-                            self.state2 = MOVE_PERF
-
-                # move in a straight line to the ar tag 
-                elif self.state2 == MOVE_PERF:
-                    print "in move perf"
-
-                    if self.ar_z < CLOSE_DIST * 3 and self.ar_z > CLOSE_DIST * 2:
-                        print "ar_x" + str(self.ar_x)
-                        if abs(self.ar_x) > X_ACC:
-                            self.state2 = ZERO_X
-                            almost_perfet = True
-
-                    # move to the ARTag     
-                    if self.ar_z > CLOSE_DIST:
-                        self.execute_command(self.mover.go_forward_K(K_LIN*self.ar_z))
-                    else:
-                        # set parameters for avoiding obstacles
-                        self.close = False
-                        self.close_VERY = True
-
-                        # don't need to sleep if at the home base
-                        if (self.AR_curr is Home):
-                            self.state = DONE_PARKING
-                        else:
-                            self.state2 = SLEEPING
-
-
-                # wait to recieve package 
-                elif self.state2 == SLEEPING:
-                    print "in sleeping"
-
-                    # use a counter to decide how long to sleep
-                    sleep_count+=1
-                    rospy.sleep(1)
-                    if sleep_count > SLEEP_TIME:
-                        self.state2 = BACK_OUT
-
-
-                # back out from the ARTag
-                elif self.state2 == BACK_OUT:  
-                    print "in back out"
-
-                    # reset EKF position using the ARTag 
-                    self.position = self.mapper.positionFromMap(self.AR_ids[self.AR_curr][0], self.AR_ids[Home][0])
-                    
-                    # move backwards for a specific distance 
-                    self.execute_command(self.mover.back_out())
-                    if self.ar_z > CLOSE_DIST*3:
-                        # set parameters for avoiding obstacles
-                        self.close_VERY = False
-                        self.state2 = DONE_PARKING
-
-
-                # done with the parking sequence!
-                elif self.state2 == DONE_PARKING:
-                    print "in done parking"
+            # move to the ARTag     
+            if self.ar_z > CLOSE_DIST:
+                self.execute_command(self.mover.go_forward_K(K_LIN*self.ar_z))
+            else:
+                self.docked()
 
-                    self.execute_command(self.mover.wait())
-                    # return succesful parking 
-                    return 0
 
-                self.rate.sleep()
+        # wait to recieve package 
+        elif self.state2 == SLEEPING:
+            print "in sleeping"
+
+            self.execute_command(self.mover.wait())
+            if self.timer_done():
+                self.state2 = BACK_OUT
+
+
+        # back out from the ARTag
+        elif self.state2 == BACK_OUT:  
+            print "in back out"
+
+            # move backwards for a specific distance, measured by the filtered ARTag pose
+            now = rospy.get_time()
+            if self.back_start is None:
+                self.back_start = self.ar_z
+                self.mover.start_move(-(BACK_OUT_DIST - self.ar_z), now)
+            backed = self.back_start - self.ar_z
+
+            if self.ar_z > BACK_OUT_DIST or self.mover.profile_done(backed, now):
+                # set parameters for avoiding obstacles
+                self.back_start = None
+                self.close_VERY = False
+                self.state2 = DONE_PARKING
+                self.execute_command(self.mover.wait())
+            else:
+                self.execute_command(self.mover.profile_step(backed, now))
+
+
+        # done with the parking sequence!
+        elif self.state2 == DONE_PARKING:
+            print "in done parking"
+
+            self.execute_command(self.mover.wait())
+            # return succesful parking 
+            return 0
+
+        return None
 
 
 
+    def docked(self):
+        """
+        - The robot reached the parking spot: log how long it took and how far 
+        off the ARTag's normal it ended up, stop, then sleep under the dispenser
+        :return: None
+        """
+        robot_pose = self.landmarks.robot_pose(self.AR_curr)
+        lateral = robot_pose[1] if robot_pose is not None else float('nan')
+        now = rospy.get_time()
+        secs = now - self.park_start
+        self.park_start = None
+        self.docks.append((self.AR_curr, now, secs, lateral))
+        print "docked at %d in %.1f s, %.3f m off the normal" % (self.AR_curr, secs, lateral)
+
+        # the robot is at the parking spot: correct the pose with it
+        if self.relocalize:
+            self.reloc.fix(self.mapper.positionFromMap(self.AR_ids[self.AR_curr][0]), DOCK_FIX_STD ** 2)
+            rospy.loginfo("relocalized at %d: sigma %.3f m, %d ARTag detections fused, %d rejected" % (
+                self.AR_curr, self.reloc.position_std(), self.reloc.fused, self.reloc.rejected))
+
+        # set parameters for avoiding obstacles
+        self.close = False
+        self.close_VERY = True
+        self.execute_command(self.mover.wait())
+
+        # don't need to sleep if at the home base
+        if (self.AR_curr == self.home):
+            self.state2 = DONE_PARKING
+        else:
+            self.state2 = SLEEPING
+            self.start_timer(SLEEP_TIME)
 
     # ------------------ Functions reporting the robots interaction with the world ---------------- 
     def process_ar_tags(self, data):
@@ -618,22 +1019,34 @@ class Main2:
         :param data: AlvarMarkers message telling you where multiple individual AR tags are
         :return: None
         """
-        for marker in data.markers:
-            if (marker.id == self.AR_curr):
-                self.AR_seen = True
-                self.close = True
-                pos = marker.pose.pose.position # what is this relative to -- robot at that time - who is the origin 
-
-                distance = cm.dist((pos.x, pos.y, pos.z))
-
-                self.ar_x = pos.x
-                # print "X DIST TO AR TAG %0.2f" % self.ar_x
-                self.ar_z = pos.z
-
-                orientation = marker.pose.pose.orientation
-                list_orientation = [orientation.x, orientation.y, orientation.z, orientation.w]
-                self.ar_orientation = tf.transformations.euler_from_quaternion(list_orientation)[0]
-                self.markers[marker.id] = distance
+        markers = data.markers
+        if not markers:
+            return
+        # the whole message as arrays: ids, positions relative to the camera 
+        # (x right, z forward), rolls and time stamps, markers without one count as seen now
+        ids = np.array([marker.id for marker in markers])
+        poses = [marker.pose.pose for marker in markers]
+        x = np.array([pose.position.x for pose in poses])
+        z = np.array([pose.position.z for pose in poses])
+        rolls = np.array([tf.transformations.euler_from_quaternion(
+            [pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w])[0]
+            for pose in poses])
+        stamps = np.array([marker.header.stamp.to_sec() for marker in markers])
+        stamps[stamps == 0] = rospy.Time.now().to_sec()
+
+        # the ARTag filters fuse it and record it in self.landmarks
+        self.tag_estimator.update(ids, x, z, rolls, stamps)
+        # every ARTag with a known pose tells where the robot is
+        if self.relocalize and not self.resetting:
+            self.reloc.observe_all(ids, z, -x, rolls)
+
+        current = np.flatnonzero(ids == self.AR_curr)
+        if len(current):
+            self.AR_seen = True
+            self.close = True
+            self.ar_x, self.ar_z, self.ar_orientation = self.landmarks.camera_pose(self.AR_curr)
+            for i in current:
+                self.tag_tracker.seen(x[i], stamps[i])
         
 
     def process_ekf(self, data):
@@ -655,95 +1068,116 @@ class Main2:
         extra_or = 0
 
 
-        self.position = (pos.x + extra_pos[0], pos.y + extra_pos[1])
+        odom = (pos.x + extra_pos[0], pos.y + extra_pos[1])
         orientation = data.pose.pose.orientation
         list_orientation = [orientation.x, orientation.y, orientation.z, orientation.w]
-        self.orientation = tf.transformations.euler_from_quaternion(list_orientation)[-1] + extra_or
-
-
-    #   OBSTACLE TWEAKING: the range of obstacle depth detected, the width of camera, area of obstacle      
+        odom_orientation = tf.transformations.euler_from_quaternion(list_orientation)[-1] + extra_or
+        if (self.resetting and math.hypot(pos.x, pos.y) <= RESET_DIST and 
+                abs(cm.angle_compare(odom_orientation, 0)) <= RESET_ANGLE):
+            self.odom_reset = True
+
+        # the odometry drifts, the relocalizer's pose is kept in line by the ARTags
+        if self.resetting or not self.relocalize:
+            self.position, self.orientation = odom, odom_orientation
+        else:
+            self.reloc.predict(odom + (odom_orientation,), (x_var, y_var, rot_var))
+            self.position, self.orientation = self.reloc.position()
+        self.mapper.set_robot(self.position, self.orientation)
+
+        # move the ARTag estimates with the robot, they only need the odometry
+        stamp = data.header.stamp.to_sec() or rospy.Time.now().to_sec()
+        self.tag_estimator.predict(odom + (odom_orientation,), stamp)
+
+
+    #   OBSTACLE TWEAKING: the range of obstacle depth detected, the width of camera, area of obstacle
+    #   now live in obstacle_script.py
     def bound_object(self, img_in):
         """
-        - Draws a bounding box around the largest object in the scene and returns
+        - Finds the largest object in front of the robot with the obstacle detector
         - Lets us know when obstacles have been seen
         - Lets us know when to avoid obstacles
-        :param: Image described by an array
-        :return: Image with bounding box 
-        """
-        img = np.copy(img_in)
-        img = img[:-250, :]
-        middle_seg = False
-        img_height, img_width = img.shape[:2] # (480, 640) 
-
-        # Get contours
-        contours, _ = cv2.findContours(img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        if len(contours) > 0:
-            # Find the largest contour
-            areas = [cv2.contourArea(c) for c in contours]
-            max_index = np.argmax(areas)
-            max_contour = contours[max_index]
-            new_obstacle_pos = cm.centroid(max_contour)
-
-            # show where largest obstacle is 
-            cv2.drawContours(img, max_contour, -1, color=(0, 255, 0), thickness=3)
-       
-            # Draw rectangle bounding box on image
-            x, y, w, h = cv2.boundingRect(max_contour)
-
-            # obstacle must be even larger to get the state to be switched 
-            if (w*h > 400):
-                if (self.close_VERY == False):
-                    if (x < 220):
-                        self.obs_side = LEFT
-                    else:
-                        self.obs_side = RIGHT
-                    print "avoiding obstacle"
-                    self.prev_state = self.state
-                    self.state = 'avoid_obstacle'
-        return img
+        :param: depth image described by an array (m)
+        :return: Obstacle found by the detector, or None
+        """
+        obstacle = self.detector.detect(img_in)
+
+        # obstacle must be large enough to get the state to be switched,
+        # the local planner steers around obstacles while following a path
+        if obstacle is not None and self.close_VERY == False and self.state != 'go_to_pos':
+            if self.state != 'avoid_obstacle':
+                self.obs_side = obstacle.side
+                print "avoiding obstacle"
+            self.start_event('avoid_obstacle')
+        return obstacle
 
     def process_depth_image(self, data):
         """ 
         - Use bridge to convert to CV::Mat type. (i.e., convert image from ROS format to OpenCV format)
-        - Displays thresholded depth image 
         - Calls bound_object function on depth image
+        - Fuses the depth image into the map
         :param: Data from depth camera
         :return: None
         """
         try:
+            if self.bridge is None:
+                self.bridge = cv_bridge.CvBridge()
             cv_image = self.bridge.imgmsg_to_cv2(data)
-            
-            # create mask for range 0.1 - 0.5 meters, restricting image to be directly in front
-            mask = cv2.inRange(cv_image, 0.1, 0.5)
-            mask[:, 0:180] = 0
-            mask[:, 460:] = 0
-            # create a mask to restrict the depth that can be seen 
-            im_mask = cv2.bitwise_and(cv_image, cv_image, mask=mask)
-            self.depth_image = im_mask
-
-            # bound the largest object within this masked image 
-            dst2 = self.bound_object(mask)
-
-            # Normalize values to range between 0 and 1 for displaying
-            norm_img = im_mask
-            cv2.normalize(norm_img, norm_img, 0, 1, cv2.NORM_MINMAX)
-
-            # Displays thresholded depth image   
-            # cv2.imshow('Depth Image', norm_img)    
-            # cv2.waitKey(3)
-
-        except CvBridgeError, err:
+            self.depth_image = cv_image
+
+            # bound the largest object directly in front of the robot
+            self.bound_object(cv_image)
+            self.local_planner.add_frame(cv_image, self.position, self.orientation, rospy.get_time())
+
+            # remember everything the camera sees in the map
+            self.mapper.update_from_depth(cv_image, self.position, self.orientation)
+            rospy.loginfo_throttle(10, "map fusion %.1f ms per frame, every %d columns" % (
+                1000 * self.mapper.fusion_cost, self.mapper.fusion_stride))
+
+        except cv_bridge.CvBridgeError, err:
             rospy.loginfo(err)
 
     def process_bump_sensing(self, data):
         """
         Simply sets state to bump and lets other functions handle it
+        - bumps while parking are expected (the robot docks against the dispenser)
         :param data: Raw message data from bump sensor 
         :return: None
         """
-        if (data.state == BumperEvent.PRESSED):
-            self.prev_state = self.state
-            self.state = 'bumped'
+        if (data.state == BumperEvent.PRESSED and self.state != 'go_to_AR'):
+            self.local_planner.add_bump(self.position, self.orientation, rospy.get_time())
+            self.start_event('bumped')
+
+    def add_order(self, tag):
+        """
+        Queue a fetch from a dispenser, served on the next trip that has room
+        :param tag: ARTag of the dispenser
+        :return: None
+        """
+        if (tag not in self.AR_ids or tag == self.home):
+            rospy.logwarn("no dispenser with ar tag %d, order ignored", tag)
+            return
+        self.orders.add(tag)
+
+    def process_order(self, data):
+        """
+        Take a new fetch order
+        :param data: Int32 message with the ARTag of the dispenser
+        :return: None
+        """
+        self.add_order(data.data)
+
+    def process_cancel(self, data):
+        """
+        Drop every fetch, the robot stops and waits from the next tick on
+        :param data: Empty message
+        :return: None
+        """
+        print "fetch cancelled"
+        self.orders.cancel()
+        self.AR_curr = -1
+        self.AR_seen = False
+        self.prev_state = self.state
+        self.state = 'wait'
 
     def shutdown(self):
         """
@@ -752,6 +1186,14 @@ class Main2:
         """
         # Close CV Image windows
         cv2.destroyAllWindows()
+        # keep the timings of the run, and the map
+        self.profiler.dump()
+        if self.world.dirty:
+            self.world.save()
+        # finish the recording
+        if self.recorder is not None:
+            self.recorder.close()
+            rospy.loginfo("Recorded %d messages, dropped %d" % (self.recorder.written, self.recorder.dropped))
         # stop turtlebot
         rospy.loginfo("Stop TurtleBot")
         # a default Twist has linear.x of 0 and angular.z of 0.  So it'll stop TurtleBot
@@ -760,10 +1202,10 @@ class Main2:
         rospy.sleep(1)
 
 if __name__ == '__main__':
-    # try:
-    robot = Main2()
-    robot.run()
-    print "success"
+    try:
+        robot = Main2()
+        robot.run()
+        print "success"
 
     # gives cleaner error descriptions
     except Exception, err:
@@ -7,42 +7,207 @@ import math
 from math import radians, degrees
 import numpy as np
 import time 
+import heapq
+
+import tile_script
+import frame_script
 
 # ratio of world meters to map coordinates 
 world_map_ratio = 0.2
 
+# map coordinates (same frame as Main2.AR_ids) of grid cell (0, 0), 
+# puts every ARTag inside the grid
+GRID_ORIGIN = (-35, -15)
+# cells of my_map, the window of the map kept as a dense grid (the map 
+# itself, MapMaker.tiles, goes on as far as the robot sees)
+GRID_SHAPE = (40, 30)
+# cells around the start and goal the planner searches when one of them is 
+# beyond my_map, the obstacles there come from the tiles
+PLAN_MARGIN = 10
+
+# obstacles we know about before the robot sees anything, as map coordinate 
+# rectangles (x_min, y_min, x_max, y_max), inclusive. The table sits between 
+# home and dispensers 5 and 6, it is what the old fake waypoints 51 and 61 drove around
+KNOWN_OBSTACLES = [(-14, 4, -8, 6)]
+
+# cells around an obstacle the robot can't drive through (robot radius ~ 1 cell)
+INFLATE_CELLS = 1
+
+# step costs for the 8 neighbours of a cell: (dx, dy, cost)
+SQRT2 = math.sqrt(2)
+NEIGHBOURS = [(1, 0, 1.0), (-1, 0, 1.0), (0, 1, 1.0), (0, -1, 1.0),
+              (1, 1, SQRT2), (1, -1, SQRT2), (-1, 1, SQRT2), (-1, -1, SQRT2)]
+
+
+# ---- depth camera fusion ----
+# depth camera intrinsics (Kinect, 640x480) 
+DEPTH_FX = 570.3
+DEPTH_CX = 319.5
+# pose of the depth camera on the robot (x ahead, y to the left in m, heading 
+# in rad), the frame_script 'camera' frame
+CAMERA_POSE = ((0.0, 0.0), 0.0)
+# rows of the depth image used for mapping, a band around the horizon
+FUSION_ROWS = (200, 280)
+# depths (m) the camera can be trusted between, no return is unknown
+MIN_RANGE = 0.45
+MAX_RANGE = 4.0
+
+# log-odds added to a cell per frame a ray passes through it or ends in it
+L_FREE = -0.4
+L_OCC = 0.85
+# log-odds are clamped so the map can still change its mind
+L_MIN = -2.0
+L_MAX = 3.5
+# log-odds beyond which a cell is drawn as free or occupied
+FREE_THRESH = -0.8
+OCC_THRESH = 1.2
+
+# time (s) a depth frame is allowed to take, the column stride adapts to it
+FUSION_BUDGET = 0.005
+MIN_STRIDE = 2
+MAX_STRIDE = 32
+
+
+def octile(a, b):
+    """
+    - Octile distance between two cells, the exact path length on an empty 
+    8-connected grid so it never overestimates (admissible for A*)
+    :param: cell, cell
+    :return: distance in cells
+    """
+    dx = abs(a[0] - b[0])
+    dy = abs(a[1] - b[1])
+    return max(dx, dy) + (SQRT2 - 1) * min(dx, dy)
+
 class MapMaker:
     def __init__(self):
         # initialize MapDrawer object
         print "map initialized"
-        # self.mapObj = mp.MapDrawer(self.positionToMap)
+        # MapDrawer, created by showMap when the map is first displayed
+        self.mapObj = None
+        # map coordinates of the home base, where the EKF odometry starts, see set_home
         self.calliber = [0, 17]
         # create blank array of negative ones to represent blank map 
-        self.my_map = -np.ones((40,30))
+        self.my_map = -np.ones(GRID_SHAPE)
         self.position  = [0,0]
         self.obstacle_depth = [-1, -1] # depth, segment (segment for map fun)
 
-    def positionToMap(self, position, calliber):
+        # functions called with the list of cells that became occupied or free
+        self.change_listeners = []
+
+        # occupancy of every cell seen in log-odds, fused from depth frames, 
+        # my_map is drawn from it
+        self.tiles = tile_script.TileMap()
+        # cells fusion may not change (obstacles known ahead of time)
+        self.pinned = np.zeros(self.my_map.shape, bool)
+        # occupied cells beyond my_map, as the tiles have them
+        self.outside = set()
+        # column stride of the depth image, and the seconds the last frame took
+        self.fusion_stride = 8
+        self.fusion_cost = 0.0
+
+        # frames of the floor (see frame_script), the grid and camera frames never move
+        self.frames = frame_script.FrameTree('map')
+        self.frames.set('grid', 'map', frame_script.Transform(GRID_ORIGIN[0], GRID_ORIGIN[1]))
+        self.frames.set('robot', 'world', frame_script.Transform())
+        self.frames.set('camera', 'robot', frame_script.pose(*CAMERA_POSE))
+        self.set_home(self.calliber)
+
+        for rect in KNOWN_OBSTACLES:
+            self.mark_obstacle(rect)
+
+    def set_home(self, calliber):
         """
-        turn EKF position in meters into map position in coordinates
-        (r, c) -> (x, y)
+        - Place the world frame (EKF odometry, reset at the home base) in the map
+        :param: map coordinates of the home base
+        :return: None
+        """
+        self.calliber = list(calliber)
+        self.frames.set('world', 'map', frame_script.Transform(calliber[0], calliber[1], 0.0,
+                                                               1.0 / world_map_ratio))
+
+    def set_robot(self, position, orientation):
+        """
+        - Move the robot frame to the EKF pose
+        :param: EKF position and orientation
+        :return: None
+        """
+        self.frames.set('robot', 'world', frame_script.pose(position, orientation))
+
+    def set_tag(self, tag, position, heading=0.0):
         """
+        - Place the frame of an ARTag, ('tag', id), in the map
+        :param: tag id, map coordinates, heading of its normal (rad)
+        :return: None
+        """
+        self.frames.set(('tag', tag), 'map', frame_script.Transform(position[0], position[1], heading,
+                                                                   1.0 / world_map_ratio))
+
+    def restore(self, my_map, pools, keys, pinned):
+        """
+        - Use the map kept from an earlier run (see world_script.WorldStore) 
+        instead of a blank one, the known obstacles are marked again on top
+        :param: my_map, tile pools and keys (see tile_script.TileMap.load), 
+        pinned cells as an array the shape of my_map
+        :return: None
+        """
+        self.my_map = my_map
+        self.tiles.load(pools, keys)
+        self.pinned = pinned
+        self.outside = self.outside_obstacles()
+        for rect in KNOWN_OBSTACLES:
+            self.mark_obstacle(rect)
 
-        step_x = int(position[0]/world_map_ratio)
-        step_y = int(position[1]/world_map_ratio)
-        
-        return (step_x + calliber[0], step_y + calliber[1])
+    def outside_obstacles(self):
+        """
+        - Occupied cells of the tiles beyond my_map
+        :return: set of (r, c) cells
+        """
+        rows, cols = self.my_map.shape
+        out = set()
+        for tr, tc in self.tiles.keys:
+            r0, c0 = tr * tile_script.TILE, tc * tile_script.TILE
+            r, c = np.nonzero(self.tiles.region(r0, c0, r0 + tile_script.TILE, c0 + tile_script.TILE) > OCC_THRESH)
+            r, c = r + r0, c + c0
+            beyond = (r < 0) | (r >= rows) | (c < 0) | (c >= cols)
+            out.update(zip(r[beyond].tolist(), c[beyond].tolist()))
+        return out
 
-    def positionFromMap(self, position, calliber):
+    def occupied(self, cell):
         """
-        turn map positions back to EKF for display purposes
-        (x, y) -> (r c)
+        - Whether a cell is an obstacle, in my_map or beyond it
+        :param: (r, c) cell
+        :return: boolean
         """
+        r, c = cell
+        rows, cols = self.my_map.shape
+        if 0 <= r < rows and 0 <= c < cols:
+            return self.my_map[r, c] >= 1
+        return (r, c) in self.outside
 
-        step_x = (position[0] - calliber[0]) * world_map_ratio
-        step_y = (position[1] - calliber[1]) * world_map_ratio
-        
-        return (step_x, step_y)
+    def add_fine_point(self, position):
+        """
+        - Map the surroundings of a place (a dispenser or home base) at full resolution
+        :param: map coordinates
+        :return: None
+        """
+        self.tiles.add_fine_point(self.mapToGrid(position))
+
+    def positionToMap(self, position):
+        """
+        turn EKF position in meters into the nearest map coordinates, takes a 
+        single (x, y) or arrays of x and y
+        (x, y) -> (x, y)
+        """
+        return frame_script.to_cells(*self.frames.convert(position[0], position[1], 'world', 'map'))
+
+    def positionFromMap(self, position):
+        """
+        turn map positions back to EKF positions in meters, takes a single 
+        (x, y) or arrays of x and y
+        (x, y) -> (x, y)
+        """
+        return self.frames.convert(position[0], position[1], 'map', 'world')
 
     def initializeMap(self):
         print "initialized map fun called"
@@ -53,4 +218,293 @@ class MapMaker:
         # show map for this amount of time 
         time.sleep(0.001)
 
-    
\ No newline at end of file
+    def mapToGrid(self, position):
+        """
+        turn map coordinates (the frame of Main2.AR_ids) into the nearest cell of my_map
+        (x, y) -> (r, c)
+        """
+        return frame_script.to_cells(*self.frames.convert(position[0], position[1], 'map', 'grid'))
+
+    def gridToMap(self, cell):
+        """
+        turn a cell of my_map back into map coordinates
+        (r, c) -> (x, y)
+        """
+        return frame_script.to_cells(*self.frames.convert(cell[0], cell[1], 'grid', 'map'))
+
+    def mark_obstacle(self, rect):
+        """
+        - Mark a rectangle of map coordinates as occupied
+        :param: (x_min, y_min, x_max, y_max) inclusive, map coordinates
+        :return: None
+        """
+        r0, c0 = self.mapToGrid(rect[:2])
+        r1, c1 = self.mapToGrid(rect[2:])
+        rows, cols = np.mgrid[max(r0, 0):r1 + 1, max(c0, 0):c1 + 1]
+        self.pinned[rows, cols] = True
+        self.set_cells(zip(rows.ravel(), cols.ravel()), 1)
+
+    def set_cells(self, cells, value):
+        """
+        - Change cells of my_map and tell the listeners about the ones that 
+        went from free to occupied or back (unknown counts as free)
+        :param: list of (r, c) cells, new value (-1 unknown, 0 free, 1 occupied)
+        :return: list of the cells that flipped
+        """
+        flipped = [cell for cell in cells if (self.my_map[cell] >= 1) != (value >= 1)]
+        for cell in cells:
+            self.my_map[cell] = value
+        if flipped:
+            for listener in self.change_listeners:
+                listener(flipped)
+        return flipped
+
+    def blocked_cells(self, box=None):
+        """
+        - Cells the robot can't drive through: occupied cells grown by INFLATE_CELLS. 
+        Unknown cells (-1) are treated as free
+        :param: (r0, c0, r1, c1) rectangle of cells, r1 and c1 exclusive, my_map 
+        by default; beyond my_map the cells come from the tiles
+        :return: boolean array of shape (r1 - r0, c1 - c0)
+        """
+        rows, cols = self.my_map.shape
+        if box is None or tuple(box) == (0, 0, rows, cols):
+            occupied = self.my_map >= 1
+        else:
+            r0, c0, r1, c1 = box
+            occupied = self.tiles.region(r0, c0, r1, c1) > OCC_THRESH
+            # the part of my_map in the box, the known obstacles are only there
+            wr0, wc0, wr1, wc1 = max(r0, 0), max(c0, 0), min(r1, rows), min(c1, cols)
+            if wr0 < wr1 and wc0 < wc1:
+                occupied[wr0 - r0:wr1 - r0, wc0 - c0:wc1 - c0] = self.my_map[wr0:wr1, wc0:wc1] >= 1
+        blocked = occupied.copy()
+        rows, cols = occupied.shape
+        for dr in range(-INFLATE_CELLS, INFLATE_CELLS + 1):
+            for dc in range(-INFLATE_CELLS, INFLATE_CELLS + 1):
+                blocked[max(dr, 0):rows + min(dr, 0), max(dc, 0):cols + min(dc, 0)] |= \
+                    occupied[max(-dr, 0):rows + min(-dr, 0), max(-dc, 0):cols + min(-dc, 0)]
+        return blocked
+
+    def plan_path(self, start, goal):
+        """
+        - A* over my_map from start to goal, 8-connected without cutting corners
+        - when the start or goal is beyond my_map the search takes in the cells 
+        up to PLAN_MARGIN around them too, read from the tiles
+        - the start and goal cells are always allowed, the robot parks right 
+        next to things and may be inside an inflated obstacle
+        :param: start and goal in map coordinates
+        :return: list of waypoints in map coordinates ending at goal, without 
+        the start, or None if there is no path
+        """
+        start = self.mapToGrid(start)
+        goal = self.mapToGrid(goal)
+        r0, c0 = 0, 0
+        r1, c1 = self.my_map.shape
+        if not (r0 <= min(start[0], goal[0]) and max(start[0], goal[0]) < r1 and
+                c0 <= min(start[1], goal[1]) and max(start[1], goal[1]) < c1):
+            r0 = min(r0, start[0] - PLAN_MARGIN, goal[0] - PLAN_MARGIN)
+            c0 = min(c0, start[1] - PLAN_MARGIN, goal[1] - PLAN_MARGIN)
+            r1 = max(r1, start[0] + PLAN_MARGIN + 1, goal[0] + PLAN_MARGIN + 1)
+            c1 = max(c1, start[1] + PLAN_MARGIN + 1, goal[1] + PLAN_MARGIN + 1)
+        blocked = self.blocked_cells((r0, c0, r1, c1))
+        rows, cols = blocked.shape
+        # the search runs in the box's own cells
+        origin = (r0, c0)
+        start = (start[0] - r0, start[1] - c0)
+        goal = (goal[0] - r0, goal[1] - c0)
+        blocked[start] = False
+        blocked[goal] = False
+
+        # open set is a binary heap of (f, g, cell), stale entries are skipped
+        g_score = {start: 0.0}
+        came_from = {}
+        open_set = [(octile(start, goal), 0.0, start)]
+        closed = set()
+        while open_set:
+            _, g, cell = heapq.heappop(open_set)
+            if cell == goal:
+                return self.waypoints(came_from, goal, blocked, origin)
+            if cell in closed:
+                continue
+            closed.add(cell)
+
+            r, c = cell
+            for dr, dc, cost in NEIGHBOURS:
+                nr, nc = r + dr, c + dc
+                if not (0 <= nr < rows and 0 <= nc < cols) or blocked[nr, nc]:
+                    continue
+                # no squeezing diagonally between two blocked cells
+                if dr and dc and (blocked[r, nc] or blocked[nr, c]):
+                    continue
+                neighbour = (nr, nc)
+                new_g = g + cost
+                if new_g < g_score.get(neighbour, float('inf')):
+                    g_score[neighbour] = new_g
+                    came_from[neighbour] = cell
+                    heapq.heappush(open_set, (new_g + octile(neighbour, goal), new_g, neighbour))
+        return None
+
+    def line_of_sight(self, blocked, a, b):
+        """
+        - Check that the straight line between two cell centres only crosses 
+        free cells, sampled every quarter cell
+        :param: blocked cells, cell, cell
+        :return: True if the robot can drive straight from a to b
+        """
+        steps = 4 * max(abs(b[0] - a[0]), abs(b[1] - a[1])) + 1
+        t = np.linspace(0.0, 1.0, steps)
+        r = np.rint(a[0] + t * (b[0] - a[0])).astype(int)
+        c = np.rint(a[1] + t * (b[1] - a[1])).astype(int)
+        return not blocked[r, c].any()
+
+    def waypoints(self, came_from, goal, blocked, origin=(0, 0)):
+        """
+        - Walk the A* tree back from the goal, then only keep the cells the 
+        robot has to turn at: from every waypoint drive straight to the 
+        furthest cell of the path that is still in line of sight
+        :param: dictionary of cell -> parent cell, goal cell, blocked cells, 
+        cell of my_map the cells of blocked start at
+        :return: list of waypoints in map coordinates
+        """
+        cells = [goal]
+        while cells[-1] in came_from:
+            cells.append(came_from[cells[-1]])
+        cells.reverse()
+
+        points = []
+        i = 0
+        while i < len(cells) - 1:
+            j = i + 1
+            while j < len(cells) - 1 and self.line_of_sight(blocked, cells[i], cells[j + 1]):
+                j += 1
+            points.append(self.gridToMap((cells[j][0] + origin[0], cells[j][1] + origin[1])))
+            i = j
+        return points
+
+    def positionToGrid(self, position):
+        """
+        turn EKF positions in meters into fractional my_map cells, takes a 
+        single (x, y) or arrays of x and y
+        (x, y) -> (r, c)
+        """
+        return self.frames.convert(position[0], position[1], 'world', 'grid')
+
+    def depth_rays(self, depth, position, orientation):
+        """
+        - Turn a depth frame into rays on the grid: the closest return in 
+        every `fusion_stride`th column of the horizon band
+        :param: depth image (m), EKF position and orientation when it was taken
+        :return: (start cell, end rows, end cols, whether each ray hit something)
+        """
+        band = depth[FUSION_ROWS[0]:FUSION_ROWS[1], ::self.fusion_stride]
+        # fmin skips the NaNs the camera gives for no return
+        z = np.fmin.reduce(band, axis=0)
+        u = np.arange(0, depth.shape[1], self.fusion_stride, dtype=float)
+        with np.errstate(invalid='ignore'):
+            valid = z >= MIN_RANGE
+        z, u = z[valid], u[valid]
+        hit = z <= MAX_RANGE
+        z = np.minimum(z, MAX_RANGE)
+
+        # camera frame (forward, left) to the grid, through the robot pose
+        forward = z
+        left = z * (DEPTH_CX - u) / DEPTH_FX
+        to_grid = self.frames.get('world', 'grid') * frame_script.pose(position, orientation) * \
+            self.frames.get('camera', 'robot')
+        start = frame_script.to_cells(*to_grid.apply(0.0, 0.0))
+        end_r, end_c = frame_script.to_cells(*to_grid.apply(forward, left))
+        return start, end_r, end_c, hit
+
+    def trace_rays(self, start, end_r, end_c):
+        """
+        - Cells every ray passes through before its end cell, all rays at once:
+        each ray takes max(|dr|, |dc|) steps and rounds to the nearest cell, 
+        which gives the same cells as Bresenham's line
+        :param: start cell, arrays of end rows and end cols
+        :return: (rows, cols) of the traversed cells, repeats included
+        """
+        dr = end_r - start[0]
+        dc = end_c - start[1]
+        steps = np.maximum(np.abs(dr), np.abs(dc))
+        if len(steps) == 0 or steps.max() == 0:
+            return np.zeros(0, int), np.zeros(0, int)
+        k = np.arange(steps.max())
+        # fraction of the way along each ray, only steps before the end cell are kept
+        t = k[None, :] / np.maximum(steps, 1)[:, None].astype(float)
+        keep = k[None, :] < steps[:, None]
+        rows = np.rint(start[0] + t * dr[:, None])[keep].astype(int)
+        cols = np.rint(start[1] + t * dc[:, None])[keep].astype(int)
+        return rows, cols
+
+    def update_from_depth(self, depth, position, orientation):
+        """
+        - Fuse a depth frame into the map: cells rays pass through become more 
+        likely free, cells rays end in more likely occupied. Each cell (each 
+        value of a coarse tile) is updated at most once per frame
+        - my_map is then brought up to date (through set_cells, so planners hear 
+        about it) and the column stride is adapted to keep to FUSION_BUDGET
+        :param: depth image (m), EKF position and orientation
+        :return: None
+        """
+        began = time.time()
+        start, end_r, end_c, hit = self.depth_rays(depth, position, orientation)
+        free_r, free_c = self.trace_rays(start, end_r, end_c)
+        # rays that end short of the camera's range leave their last cell free
+        free_r = np.concatenate((free_r, end_r[~hit]))
+        free_c = np.concatenate((free_c, end_c[~hit]))
+        rows, cols = self.tiles.update(free_r, free_c, end_r[hit], end_c[hit], L_FREE, L_OCC, L_MIN, L_MAX)
+
+        # only cells updated this frame can change value
+        shape = self.my_map.shape
+        inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+        self.update_outside(rows[~inside], cols[~inside])
+        rows, cols = rows[inside], cols[inside]
+        keep = ~self.pinned[rows, cols]
+        rows, cols = rows[keep], cols[keep]
+        log_odds = self.tiles.value(rows, cols)
+        new_values = np.where(log_odds > OCC_THRESH, 1, np.where(log_odds < FREE_THRESH, 0, -1))
+        changed = new_values != self.my_map[rows, cols]
+        for value in (-1, 0, 1):
+            pick = changed & (new_values == value)
+            if pick.any():
+                self.set_cells(zip(rows[pick].tolist(), cols[pick].tolist()), value)
+
+        self.fusion_cost = time.time() - began
+        if self.fusion_cost > FUSION_BUDGET:
+            self.fusion_stride = min(self.fusion_stride * 2, MAX_STRIDE)
+        elif self.fusion_cost < FUSION_BUDGET / 2:
+            self.fusion_stride = max(self.fusion_stride // 2, MIN_STRIDE)
+
+    def update_outside(self, rows, cols):
+        """
+        - Bring the occupied cells beyond my_map up to date with the tiles and 
+        tell the listeners about the ones that flipped
+        :param: arrays of rows and cols updated in the tiles, all beyond my_map
+        :return: list of the cells that flipped
+        """
+        if len(rows) == 0:
+            return []
+        occupied = self.tiles.value(rows, cols) > OCC_THRESH
+        if not self.outside and not occupied.any():
+            return []
+        flipped = [cell for cell, occ in zip(zip(rows.tolist(), cols.tolist()), occupied.tolist())
+                   if occ != (cell in self.outside)]
+        for cell in flipped:
+            if cell in self.outside:
+                self.outside.remove(cell)
+            else:
+                self.outside.add(cell)
+        if flipped:
+            for listener in self.change_listeners:
+                listener(flipped)
+        return flipped
+
+    def showMap(self, position, orientation):
+        """
+        - Display my_map with the robot on it, creating the MapDrawer on first use
+        :param: EKF position and orientation
+        :return: None
+        """
+        if self.mapObj is None:
+            self.mapObj = mp.MapDrawer(self.positionToGrid, self.my_map.shape)
+        self.mapObj.UpdateMapDisplay(self.my_map, position, orientation)
@@ -6,28 +6,38 @@ Package for drawing the generated map of the world for Pset 4 of CS 189.
 
 from math import *
 import numpy as np
-import cv2
+
+import lazy_util
+
+cv2 = lazy_util.lazy('cv2')
 
 class MapDrawer:
     """
     A class for incrementally updating the displayed image of the generated map,
     and saving the image to file.  The map must be an occupancy grid of shape
-    (30, 40).
+    `map_size`, (40, 30) unless given.
     """
 
-    def __init__(self, positionToMap):
+    def __init__(self, positionToMap, map_size=(40, 30)):
         """
         Creates a new MapDrawer object where `positionToMap`is a function that
         takes in a world position (in meters) and outputs the corresponding map
         coordinates. `positionToMap` must define a right-handed coordinate
-        system.
+        system. `map_size` is the shape of the maps that will be drawn.
         """
-        self.map_size = (40,30)
+        self.map_size = tuple(map_size)
         self.draw_scale = 16
         self.map = -np.ones(self.map_size).astype(int)
-        self.drawn_map = np.zeros((640,480,3))
-        self.map_colors = [[0, 0, 0], [1, 1, 1], [1, 0, 0]]
+        image_shape = (self.map_size[0] * self.draw_scale, self.map_size[1] * self.draw_scale, 3)
+        # map cells only, painted in place as cells change
+        self.drawn_map = np.zeros(image_shape, np.uint8)
+        # drawn_map plus the robot markers, this is what gets displayed
+        self.frame = np.zeros(image_shape, np.uint8)
+        # colours for unknown, free and occupied cells
+        self.map_colors = np.array([[0, 0, 0], [255, 255, 255], [255, 0, 0]], np.uint8)
         self.positionToMap = positionToMap
+        # pixel rectangles (r0, r1, c0, c1) of the frame covered by the markers last drawn
+        self.marker_rects = []
 
         origin = positionToMap((0, 0))
         x_axis = positionToMap((1, 0))
@@ -38,6 +48,74 @@ class MapDrawer:
         angle_xy = np.unwrap([0, axis_test - self.axis_orientation])[1]
         assert angle_xy > 0, "positionToMap does not define a right-handed coordinate system"
 
+    def PaintMap(self, new_map):
+        """
+        Paints the cells of `new_map` that differ from the stored map into
+        `drawn_map`. Changed cells are found with one comparison and only the
+        rectangle bounding them is repainted, by scaling the colour of every
+        cell up to draw_scale x draw_scale pixels.
+        Returns the repainted pixel rectangle (r0, r1, c0, c1) or None.
+        """
+        new_map = new_map.astype(int)
+        changed = np.nonzero(self.map != new_map)
+        if len(changed[0]) == 0:
+            return None
+        r0, r1 = changed[0].min(), changed[0].max() + 1
+        c0, c1 = changed[1].min(), changed[1].max() + 1
+        self.map[r0:r1, c0:c1] = new_map[r0:r1, c0:c1]
+
+        s = self.draw_scale
+        colors = self.map_colors[self.map[r0:r1, c0:c1] + 1]
+        rect = (r0*s, r1*s, c0*s, c1*s)
+        self.drawn_map[rect[0]:rect[1], rect[2]:rect[3]] = colors.repeat(s, axis=0).repeat(s, axis=1)
+        return rect
+
+    def DrawMarkers(self, img, position, orientation=None):
+        """
+        Draws the initial position of the robot, (0,0), and the current
+        position of the robot (`position`) onto `img`, with arrows for their
+        orientation if `orientation` is supplied.
+        Returns the pixel rectangles (r0, r1, c0, c1) the markers cover.
+        """
+        arrow_size = 10
+        rects = []
+        poses = [((0, 0), self.axis_orientation, [0, 255, 0]),
+                 (position, None if orientation is None else self.axis_orientation + orientation, [0, 0, 255])]
+        for pos, marker_orientation, color in poses:
+            pos = self.positionToMap(pos)
+            pos = (int(self.draw_scale*pos[1]), int(self.draw_scale*pos[0]))
+            cv2.circle(img, pos, self.draw_scale - 2, color, -1)
+
+            if orientation is not None:
+                arrow_start = (int(pos[0] - arrow_size*cos(marker_orientation)),
+                               int(pos[1] + arrow_size*sin(marker_orientation)))
+                arrow_end = (int(pos[0] + arrow_size*cos(marker_orientation)),
+                             int(pos[1] - arrow_size*sin(marker_orientation)))
+                cv2.line(img, arrow_start, arrow_end, [0, 0, 0], 1)
+
+            reach = self.draw_scale
+            rects.append((max(pos[1] - reach, 0), max(pos[1] + reach + 1, 0),
+                          max(pos[0] - reach, 0), max(pos[0] + reach + 1, 0)))
+        return rects
+
+    def RenderMap(self, new_map, position, orientation=None):
+        """
+        Brings `frame` up to date with `new_map` and the robot markers without
+        redrawing the whole image: the repainted map rectangle and the
+        rectangles under the old markers are copied over from `drawn_map`,
+        then the markers are drawn again.
+        Returns `frame`, which is reused by the next call.
+        """
+        assert new_map.shape == self.map_size, "New map size doesn't match old map size"
+        rects = self.marker_rects
+        painted = self.PaintMap(new_map)
+        if painted is not None:
+            rects = rects + [painted]
+        for r0, r1, c0, c1 in rects:
+            self.frame[r0:r1, c0:c1] = self.drawn_map[r0:r1, c0:c1]
+        self.marker_rects = self.DrawMarkers(self.frame, position, orientation)
+        return self.frame
+
     def UpdateMapDisplay(self, new_map, position, orientation=None, extra_img=None):
         """
         Updates the internally stored map image using `new_map` and displays
@@ -46,49 +124,16 @@ class MapDrawer:
         is supplied, the initial and current orientation will also be
         displayed.  If `extra_image` is supplied, the image will be displayed
         alongside the map.
-        `new_map` must be the same size as the original map (30, 40).
-        `extra_image` must be None or have shape (480, 640, 3).
+        `new_map` must be the same size as the original map (`map_size`).
+        `extra_image` must be None or have the shape of the map image, either uint8 or
+        floats from 0 to 1.
         """
-        assert new_map.shape == self.map_size, "New map size doesn't match old map size"
-        assert extra_img is None or extra_img.shape == self.drawn_map.shape, "Extra image must be shape (480, 640, 3)"
-        for ii in np.ndindex(self.map_size):
-            if self.map[ii] == int(new_map[ii]):
-                continue
-            self.map[ii] = int(new_map[ii])
-            pt1 = (int(self.draw_scale*ii[1]), int(self.draw_scale*ii[0]))
-            pt2 = (int(self.draw_scale*(ii[1]+ 1)), int(self.draw_scale*(ii[0] + 1)))
-            color = self.map_colors[self.map[ii] + 1]
-            cv2.rectangle(self.drawn_map, pt1, pt2, color, -1)
-
-        img = np.copy(self.drawn_map)
-        arrow_size = 10
-
-        start_pos = self.positionToMap((0,0))
-        start_pos = (int(self.draw_scale*start_pos[1]),
-                     int(self.draw_scale*start_pos[0]))
-        cv2.circle(img, start_pos, self.draw_scale - 2, [0, 1, 0], -1)
-
-        if orientation is not None:
-            arrow_start = (int(start_pos[0] - arrow_size*cos(self.axis_orientation)),
-                           int(start_pos[1] + arrow_size*sin(self.axis_orientation)))
-            arrow_end = (int(start_pos[0] + arrow_size*cos(self.axis_orientation)),
-                         int(start_pos[1] - arrow_size*sin(self.axis_orientation)))
-            cv2.line(img, arrow_start, arrow_end, [0, 0, 0], 1)
-
-        current_pos = self.positionToMap(position)
-        current_pos = (int(self.draw_scale*current_pos[1]),
-                       int(self.draw_scale*current_pos[0]))
-        cv2.circle(img, current_pos, self.draw_scale - 2, [0, 0, 1], -1)
-
-        if orientation is not None:
-            current_oriention = self.axis_orientation + orientation
-            arrow_start = (int(current_pos[0] - arrow_size*cos(current_oriention)),
-                            int(current_pos[1] + arrow_size*sin(current_oriention)))
-            arrow_end = (int(current_pos[0] + arrow_size*cos(current_oriention)),
-                          int(current_pos[1] - arrow_size*sin(current_oriention)))
-            cv2.line(img, arrow_start, arrow_end, [0, 0, 0], 1)
+        assert extra_img is None or extra_img.shape == self.drawn_map.shape, "Extra image must be the shape of the map image"
+        img = self.RenderMap(new_map, position, orientation)
 
         if extra_img is not None:
+            if extra_img.dtype != np.uint8:
+                extra_img = (np.clip(extra_img, 0, 1) * 255).astype(np.uint8)
             img = np.hstack((img, extra_img))
 
         cv2.imshow('Map', img)
@@ -102,33 +147,7 @@ class MapDrawer:
         current orientation will also be included in the saved image.
         """
         img = np.copy(self.drawn_map)
-        arrow_size = 10
-
-        start_pos = self.positionToMap((0,0))
-        start_pos = (int(self.draw_scale*start_pos[1]),
-                     int(self.draw_scale*start_pos[0]))
-        cv2.circle(img, start_pos, self.draw_scale - 2, [0, 1, 0], -1)
-
-        if orientation is not None:
-            arrow_start = (int(start_pos[0] - arrow_size*cos(self.axis_orientation)),
-                           int(start_pos[1] + arrow_size*sin(self.axis_orientation)))
-            arrow_end = (int(start_pos[0] + arrow_size*cos(self.axis_orientation)),
-                         int(start_pos[1] - arrow_size*sin(self.axis_orientation)))
-            cv2.line(img, arrow_start, arrow_end, [0, 0, 0], 1)
-
-        current_pos = self.positionToMap(position)
-        current_pos = (int(self.draw_scale*current_pos[1]),
-                       int(self.draw_scale*current_pos[0]))
-        cv2.circle(img, current_pos, self.draw_scale - 2, [0, 0, 1], -1)
-
-        if orientation is not None:
-            current_oriention = self.axis_orientation + orientation
-            arrow_start = (int(current_pos[0] - arrow_size*cos(current_oriention)),
-                           int(current_pos[1] + arrow_size*sin(current_oriention)))
-            arrow_end = (int(current_pos[0] + arrow_size*cos(current_oriention)),
-                         int(current_pos[1] - arrow_size*sin(current_oriention)))
-            cv2.line(img, arrow_start, arrow_end, [0, 0, 0], 1)
-
+        self.DrawMarkers(img, position, orientation)
         cv2.imwrite(filename, img)
 
 
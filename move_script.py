@@ -4,6 +4,8 @@ Helper functions that return Twist objects that are used to direct the robot
 import math
 from math import radians, degrees
 import cool_math as cm
+import dwa_script
+import frame_script
 from geometry_msgs.msg import Twist
 
 # constants for movement
@@ -13,8 +15,246 @@ ROT_SPEED_2 = math.radians(45)  # 45 deg/s in radians/s
 ROT_K = 2.5  # Constant for proportional angular velocity control
 LIN_K = 0.5  # Constant for proportional linear velocity control
 
+# path following (pure pursuit)
+PATH_SPEED = 2 * LIN_SPEED  # m/s, cruising speed along a path
+PATH_ROT_SPEED = ROT_SPEED_2  # rad/s, fastest turn while following
+PATH_ACCEL = 0.3  # m/s^2
+PATH_ROT_ACCEL = math.radians(120)  # rad/s^2
+LAT_ACCEL = 0.15  # m/s^2, sideways acceleration allowed in curves (v^2 * curvature)
+LOOKAHEAD = 0.4  # m, distance along the path to the point that is steered at
+LOOKAHEAD_TIME = 1.0  # s, the lookahead grows by this much travel at the current speed
+TURN_IN_PLACE = math.radians(20)  # point further off the heading than this: turn on the spot first
+END_SPEED = LIN_SPEED / 2  # m/s, slowest speed when arriving at the end of the path
+RESTART_GAP = 0.5  # s without a command() call after which the robot is assumed stopped
+PATH_PERIOD = 0.2  # s, control tick, how long the first command after a stop has to speed up
+
+# moves and turns of a known distance or angle (Profile), None for no jerk limit
+MOVE_SPEED = PATH_SPEED  # m/s
+MOVE_ACCEL = PATH_ACCEL  # m/s^2
+MOVE_JERK = 2.0  # m/s^3
+TURN_SPEED = PATH_ROT_SPEED  # rad/s
+TURN_ACCEL = math.radians(90)  # rad/s^2, under the velocity smoother's 2 rad/s^2
+TURN_JERK = math.radians(720)  # rad/s^3
+PROFILE_K = 1.5  # 1/s, how hard a profile move catches up with where it should be
+PROFILE_ACC = 0.01  # m or rad, close enough to the end of a profile move
+PROFILE_SETTLE = 1.0  # s, a profile move is given up this long after it should have finished
     
 
+def clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+class PathFollower:
+    """
+    Pure pursuit along a polyline: steer on the arc through the point LOOKAHEAD
+    further along the path, as fast as the arc's curvature, the end of the path
+    and the acceleration limits allow. Linear and angular velocity are
+    commanded together, the robot only turns on the spot when the path is
+    well off its heading (TURN_IN_PLACE), so it sees what it drives into.
+    """
+    def __init__(self, max_speed=PATH_SPEED, max_rot_speed=PATH_ROT_SPEED, accel=PATH_ACCEL,
+                 rot_accel=PATH_ROT_ACCEL, lat_accel=LAT_ACCEL, lookahead=LOOKAHEAD):
+        self.max_speed = max_speed
+        self.max_rot_speed = max_rot_speed
+        self.accel = accel
+        self.rot_accel = rot_accel
+        self.lat_accel = lat_accel
+        self.lookahead = lookahead
+        # path as (x, y) points (m), the first one where the robot started from
+        self.path = []
+        # index of the path segment the robot is on
+        self.segment = 0
+        # last commanded (v, w) and when
+        self.v = 0.0
+        self.w = 0.0
+        self.last_time = None
+
+    def set_path(self, start, path):
+        """
+        - Follow a new path
+        :param: (x, y) where the robot is, list of (x, y) waypoints, in m
+        :return: None
+        """
+        self.path = [tuple(start[:2])] + [tuple(p[:2]) for p in path]
+        self.segment = 0
+
+    def remaining(self, pos):
+        """
+        - Distance (m) left along the path from the robot's projection on it
+        """
+        if not self.path:
+            return 0.0
+        total = cm.dist_btwn(pos, self.path[self.segment + 1]) if self.segment + 1 < len(self.path) else 0.0
+        for a, b in zip(self.path[self.segment + 1:-1], self.path[self.segment + 2:]):
+            total += cm.dist_btwn(a, b)
+        return total
+
+    def project(self, pos):
+        """
+        - Move on to the segment closest to the robot (never back), and where
+        along it the robot is
+        :return: fraction of the current segment covered (0..1)
+        """
+        best, best_t, best_d = self.segment, 0.0, float('inf')
+        for i in range(self.segment, len(self.path) - 1):
+            (ax, ay), (bx, by) = self.path[i], self.path[i + 1]
+            dx, dy = bx - ax, by - ay
+            length2 = dx * dx + dy * dy
+            t = clamp(((pos[0] - ax) * dx + (pos[1] - ay) * dy) / length2, 0, 1) if length2 else 1.0
+            d = math.hypot(ax + t * dx - pos[0], ay + t * dy - pos[1])
+            if d < best_d:
+                best, best_t, best_d = i, t, d
+        self.segment = best
+        return best_t
+
+    def target(self, pos, lookahead):
+        """
+        - Point `lookahead` further along the path than the robot, or its end
+        :return: (x, y)
+        """
+        if len(self.path) < 2:
+            return self.path[-1] if self.path else tuple(pos[:2])
+        t = self.project(pos)
+        (ax, ay), (bx, by) = self.path[self.segment], self.path[self.segment + 1]
+        point = (ax + t * (bx - ax), ay + t * (by - ay))
+        left = lookahead
+        for nxt in self.path[self.segment + 1:]:
+            step = cm.dist_btwn(point, nxt)
+            if step >= left:
+                f = left / step
+                return (point[0] + f * (nxt[0] - point[0]), point[1] + f * (nxt[1] - point[1]))
+            left -= step
+            point = nxt
+        return self.path[-1]
+
+    def command(self, pos, heading, now):
+        """
+        - Velocities to follow the path for one control tick
+        :param: robot (x, y) and heading (rad), time (s)
+        :return: (linear m/s, angular rad/s)
+        """
+        if self.last_time is None or now - self.last_time > RESTART_GAP:
+            self.v, self.w = 0.0, 0.0
+            dt = PATH_PERIOD
+        else:
+            dt = now - self.last_time
+        self.last_time = now
+
+        goal = self.target(pos, self.lookahead + LOOKAHEAD_TIME * self.v)
+        dx, dy = goal[0] - pos[0], goal[1] - pos[1]
+        # goal in the robot's frame, x ahead and y to the left
+        ahead, left = frame_script.pose(pos, heading).inverse()(goal)
+        alpha = math.atan2(left, ahead)
+        dist2 = dx * dx + dy * dy
+
+        if abs(alpha) > TURN_IN_PLACE or dist2 < 1e-6:
+            # path is well off to the side or behind: stop, then turn towards it
+            v = 0.0
+            w = cm.sign(alpha) * min(self.max_rot_speed, ROT_K * abs(alpha))
+        else:
+            # arc through the goal point, slow enough for its curvature and to
+            # arrive at the end of the path
+            curvature = 2 * left / dist2
+            v = self.max_speed
+            if curvature != 0:
+                v = min(v, math.sqrt(self.lat_accel / abs(curvature)), self.max_rot_speed / abs(curvature))
+            v = min(v, max(END_SPEED, math.sqrt(2 * self.accel * self.remaining(pos))))
+            w = v * curvature
+
+        # acceleration limits, keeping to the arc while speeding up or slowing down
+        limited = clamp(v, self.v - self.accel * dt, self.v + self.accel * dt)
+        if v != 0:
+            w *= limited / v
+        v = limited
+        w = clamp(w, self.w - self.rot_accel * dt, self.w + self.rot_accel * dt)
+        self.v, self.w = v, w
+        return v, w
+
+
+class Profile:
+    """
+    Time-optimal rest-to-rest motion over a distance (or an angle) under speed,
+    acceleration and, optionally, jerk limits: trapezoidal velocity without a
+    jerk limit, an S-curve (jerk +J, 0, -J, cruise, -J, 0, +J) with one. Limits
+    that a short move can't reach are lowered, so the profile is always the
+    fastest one that stops exactly at the end, and duration() is when.
+    """
+    def __init__(self, distance, max_speed, accel, jerk=None):
+        self.distance = distance
+        self.sign = -1 if distance < 0 else 1
+        d, v, a = abs(distance), max_speed, accel
+        if d == 0:
+            phases = []
+        elif jerk is None:
+            v = min(v, math.sqrt(a * d))
+            ta = v / a
+            tc = (d - v * ta) / v if v > 0 else 0.0
+            phases = [(ta, a, 0.0), (tc, 0.0, 0.0), (ta, -a, 0.0)]
+        else:
+            j = jerk
+            # full acceleration is only reached if the speed limit is high enough
+            a = min(a, math.sqrt(v * j))
+            # distance to speed up to v and slow down again is v * (v / a + a / j)
+            if v * (v / a + a / j) > d:
+                v = a / 2 * (-a / j + math.sqrt((a / j)**2 + 4 * d / a))
+                if v < a * a / j:
+                    # too short to reach full acceleration either
+                    tj = (d / (2 * j))**(1 / 3.0)
+                    a, v = j * tj, j * tj * tj
+            tj = a / j
+            ta = max(v / a - tj, 0.0)
+            tc = max(d - v * (v / a + a / j), 0.0) / v if v > 0 else 0.0
+            phases = [(tj, 0.0, j), (ta, a, 0.0), (tj, a, -j), (tc, 0.0, 0.0),
+                      (tj, 0.0, -j), (ta, -a, 0.0), (tj, -a, j)]
+        # (start time, duration, position, speed, acceleration, jerk) of every phase
+        self.phases = []
+        t = s = v = 0.0
+        for T, a0, j in phases:
+            if T <= 0:
+                continue
+            self.phases.append((t, T, s, v, a0, j))
+            s += v * T + a0 * T**2 / 2 + j * T**3 / 6
+            v += a0 * T + j * T**2 / 2
+            t += T
+        self.total = t
+
+    def duration(self):
+        """
+        - Seconds the move takes
+        """
+        return self.total
+
+    def state(self, t):
+        """
+        - Where the move should be t seconds after it started
+        :return: (position, speed, acceleration), signed like the distance
+        """
+        if not self.phases or t >= self.total:
+            return (self.distance, 0.0, 0.0)
+        t = max(t, 0.0)
+        for start, T, s, v, a0, j in self.phases:
+            if t < start + T:
+                break
+        dt = t - start
+        return (self.sign * (s + v * dt + a0 * dt**2 / 2 + j * dt**3 / 6),
+                self.sign * (v + a0 * dt + j * dt**2 / 2),
+                self.sign * (a0 + j * dt))
+
+
+def move_time(distance):
+    """
+    - Seconds a profile move of `distance` m takes (MoveMaker.start_move)
+    """
+    return Profile(distance, MOVE_SPEED, MOVE_ACCEL, MOVE_JERK).duration()
+
+
+def turn_time(angle):
+    """
+    - Seconds a profile turn of `angle` rad takes (MoveMaker.start_turn)
+    """
+    return Profile(angle, TURN_SPEED, TURN_ACCEL, TURN_JERK).duration()
+
+
 class MoveMaker:
     def __init__(self):
         # movement command that will be sent to robot 
@@ -23,6 +263,13 @@ class MoveMaker:
         self.orientation = 0
         self.AR_close = False
         self.handle_AR_step = 0
+        # tracks the waypoint path in go_to_pos
+        self.follower = PathFollower()
+        # move or turn of a known distance or angle in progress: its Profile,
+        # when it started and whether it turns, see start_move/start_turn
+        self.profile = None
+        self.profile_start = None
+        self.profile_turn = False
 
     #--------Simple Moves ------#
     def back_out(self):
@@ -75,6 +322,16 @@ class MoveMaker:
         self.move_cmd.linear.x = 0
         return self.move_cmd
     
+    def drive(self, v, w):
+        """
+        - Make the robot move with velocities computed elsewhere, e.g. by dock_script.DockPlanner
+        :param: linear velocity (m/s), angular velocity (rad/s)
+        :return: Twist Object
+        """
+        self.move_cmd.linear.x = v
+        self.move_cmd.angular.z = w
+        return self.move_cmd
+
     def bumped(self):
         """
         - Robot should back up when bumped 
@@ -96,6 +353,60 @@ class MoveMaker:
         return self.move_cmd
 
 
+    # --------- Profile Moves -------------
+    def start_move(self, distance, now):
+        """
+        - Begin driving `distance` straight (backwards if negative), see profile_step
+        :param: distance (m), time (s)
+        :return: seconds it should take
+        """
+        self.profile = Profile(distance, MOVE_SPEED, MOVE_ACCEL, MOVE_JERK)
+        self.profile_start = now
+        self.profile_turn = False
+        return self.profile.duration()
+
+    def start_turn(self, angle, now):
+        """
+        - Begin turning `angle` on the spot (CCW +), see profile_step
+        :param: angle (rad), time (s)
+        :return: seconds it should take
+        """
+        self.profile = Profile(angle, TURN_SPEED, TURN_ACCEL, TURN_JERK)
+        self.profile_start = now
+        self.profile_turn = True
+        return self.profile.duration()
+
+    def profile_step(self, done, now):
+        """
+        - One tick of the move or turn: the profile's speed, corrected by how far 
+        ahead or behind it the robot is, never faster than it can still stop
+        from before the end, a control tick (PATH_PERIOD) after the command
+        :param: distance (m) or angle (rad) covered since it started, time (s)
+        :return: Twist Object
+        """
+        s, v, _ = self.profile.state(now - self.profile_start)
+        v += PROFILE_K * (s - done)
+        left = self.profile.distance - done
+        a = TURN_ACCEL if self.profile_turn else MOVE_ACCEL
+        # v * PATH_PERIOD + v^2 / (2 a) = |left|
+        stop = math.sqrt((a * PATH_PERIOD)**2 + 2 * a * abs(left)) - a * PATH_PERIOD
+        v = clamp(v, -stop, stop)
+        if self.profile_turn:
+            self.move_cmd.linear.x, self.move_cmd.angular.z = 0, v
+        else:
+            self.move_cmd.linear.x, self.move_cmd.angular.z = v, 0
+        return self.move_cmd
+
+    def profile_done(self, done, now):
+        """
+        - Whether the move or turn is over: at its end, or well past its duration
+        :param: distance (m) or angle (rad) covered since it started, time (s)
+        """
+        if self.profile is None:
+            return True
+        return abs(self.profile.distance - done) <= PROFILE_ACC or \
+            now - self.profile_start > self.profile.duration() + PROFILE_SETTLE
+
     # --------- Not So Simple Moves -------------
     def go_to_pos(self, str, my_pos, my_orr):
         """
@@ -116,6 +427,31 @@ class MoveMaker:
             self.move_cmd.angular.z = -ROT_SPEED_2
             self.move_cmd.linear.x = 0
         return self.move_cmd
+
+    def set_path(self, my_pos, path):
+        """
+        - Give follow_path a new path
+        :param: current position, list of (x, y) waypoints, in m (odometry frame)
+        :return: None
+        """
+        self.follower.set_path(my_pos, path)
+
+    def follow_path(self, my_pos, my_orr, now, local_planner=None):
+        """
+        - Drive along the path from set_path, turning and moving at once, 
+        around obstacles with a local planner (dwa_script.DWAPlanner)
+        :param: current position (m), current orientation (rad), time (s), local planner
+        :return: Twist Object
+        """
+        self.position = my_pos
+        self.orientation = my_orr
+        v, w = self.follower.command(my_pos, my_orr, now)
+        if local_planner is not None:
+            # the follower speeds up and slows down from what was actually commanded
+            goal = self.follower.target(my_pos, dwa_script.GOAL_LOOKAHEAD)
+            v, w = self.follower.v, self.follower.w = local_planner.command(my_pos, my_orr, (v, w), goal, now)
+        self.move_cmd.linear.x, self.move_cmd.angular.z = v, w
+        return self.move_cmd
     
     
    
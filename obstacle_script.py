@@ -0,0 +1,257 @@
+"""
+Obstacle detection on depth frames.
+
+Every detector looks at the same region of interest in front of the robot and
+reports the largest blob of depth pixels inside the obstacle range as an
+Obstacle (side, size, distance). The backends only differ in how they find
+that blob:
+    - ContourDetector: the original findContours / contourArea path
+    - ColumnHistogramDetector: counts occupied pixels per column of the ROI
+    - PyramidDetector: runs the contour path on a downsampled frame
+    - BlobDetector: connected components of the mask, see blob_features
+"""
+import numpy as np
+
+import lazy_util
+
+cv2 = lazy_util.lazy('cv2')
+
+# sides an obstacle can be on, same values as main.py
+LEFT = -1
+RIGHT = 1
+
+# range of depths (m) that count as an obstacle
+NEAR_DEPTH = 0.1
+FAR_DEPTH = 0.5
+
+# region of the 640x480 depth image directly in front of the robot
+ROI_COLS = (180, 460)
+ROI_ROWS = (0, 230)
+
+# column (full image) to the left of which an obstacle is on the LEFT
+SIDE_SPLIT = 220
+
+# bounding box area (pixels of the full image) needed to call it an obstacle
+MIN_SIZE = 400
+
+# one row per blob of a mask: bounding box, pixel area, centroid, and extent
+# (area / bounding box area, 1 for a filled rectangle)
+BLOB_DTYPE = np.dtype([('x', np.int32), ('y', np.int32), ('w', np.int32), ('h', np.int32),
+                       ('area', np.int32), ('cx', np.float32), ('cy', np.float32),
+                       ('extent', np.float32)])
+
+
+class Obstacle:
+    """
+    Result of a detection, all pixel values are in full image coordinates
+    """
+    def __init__(self, x, y, w, h, distance):
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        # size of the bounding box in pixels
+        self.size = w * h
+        # closest depth inside the bounding box (m)
+        self.distance = distance
+        self.side = LEFT if x < SIDE_SPLIT else RIGHT
+
+    def __repr__(self):
+        return "Obstacle(side=%d, size=%d, distance=%.2f, box=(%d, %d, %d, %d))" % (
+            self.side, self.size, self.distance, self.x, self.y, self.w, self.h)
+
+
+class ObstacleDetector:
+    """
+    Common part of the detection backends. Every backend defines
+    find_box(roi): the (x, y, w, h) bounding box, relative to the roi, of the
+    largest blob in the cropped depth image (m), or None
+    """
+    name = 'base'
+
+    def __init__(self, near=NEAR_DEPTH, far=FAR_DEPTH, roi_cols=ROI_COLS,
+                 roi_rows=ROI_ROWS, min_size=MIN_SIZE):
+        self.near = near
+        self.far = far
+        self.roi_cols = roi_cols
+        self.roi_rows = roi_rows
+        self.min_size = min_size
+
+    def roi(self, depth):
+        """
+        - Crop the depth image to the region in front of the robot (no copy)
+        :param: depth image (m)
+        :return: view of the depth image
+        """
+        return depth[self.roi_rows[0]:self.roi_rows[1], self.roi_cols[0]:self.roi_cols[1]]
+
+    def detect(self, depth):
+        """
+        - Look for an obstacle in a depth frame
+        :param: depth image (m), shape (480, 640)
+        :return: Obstacle or None
+        """
+        roi = self.roi(depth)
+        box = self.find_box(roi)
+        if box is None:
+            return None
+        x, y, w, h = box
+        if w * h <= self.min_size:
+            return None
+
+        # closest point of the obstacle, ignoring everything out of range
+        patch = roi[y:y + h, x:x + w]
+        in_range = patch[self.mask(patch) > 0]
+        distance = float(in_range.min()) if in_range.size else self.far
+        return Obstacle(x + self.roi_cols[0], y + self.roi_rows[0], w, h, distance)
+
+    def mask(self, roi):
+        """
+        - Threshold the roi to the obstacle depth range, NaNs are never in range
+        :param: cropped depth image (m)
+        :return: uint8 mask, 255 where there is an obstacle
+        """
+        return cv2.inRange(roi, self.near, self.far)
+
+
+def largest_contour_box(mask):
+    """
+    - Bounding box of the contour with the largest area
+    :param: uint8 mask
+    :return: (x, y, w, h) or None
+    """
+    # [-2] keeps this working with both the 2 and 3 value versions of findContours
+    contours = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    if len(contours) == 0:
+        return None
+    areas = [cv2.contourArea(c) for c in contours]
+    return cv2.boundingRect(contours[int(np.argmax(areas))])
+
+
+def blob_features(mask, connectivity=8, min_area=1):
+    """
+    - Features of every blob (connected component) of a mask in one pass over
+    it, instead of a contour trace plus contourArea, moments and boundingRect
+    per contour
+    :param: uint8 mask, 4 or 8 connected pixels, smallest area (pixels) to keep
+    :return: BLOB_DTYPE array, largest area first
+    """
+    count, _, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=connectivity)
+    # label 0 is the background
+    stats, centroids = stats[1:], centroids[1:]
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+    stats, centroids = stats[keep], centroids[keep]
+    blobs = np.empty(len(stats), BLOB_DTYPE)
+    blobs['x'] = stats[:, cv2.CC_STAT_LEFT]
+    blobs['y'] = stats[:, cv2.CC_STAT_TOP]
+    blobs['w'] = stats[:, cv2.CC_STAT_WIDTH]
+    blobs['h'] = stats[:, cv2.CC_STAT_HEIGHT]
+    blobs['area'] = stats[:, cv2.CC_STAT_AREA]
+    blobs['cx'] = centroids[:, 0]
+    blobs['cy'] = centroids[:, 1]
+    blobs['extent'] = blobs['area'] / (blobs['w'] * blobs['h']).astype(np.float32)
+    return blobs[np.argsort(-blobs['area'], kind='mergesort')]
+
+
+class ContourDetector(ObstacleDetector):
+    """
+    The original bound_object path: largest contour by area, then its bounding box
+    """
+    name = 'contour'
+
+    def find_box(self, roi):
+        return largest_contour_box(self.mask(roi))
+
+
+class ColumnHistogramDetector(ObstacleDetector):
+    """
+    Counts in-range pixels in every column of the roi. The obstacle is the run of
+    adjacent occupied columns holding the most pixels, its height is the row
+    extent of those pixels. No contour tracing is needed.
+    """
+    name = 'histogram'
+
+    def __init__(self, min_column=10, **kwargs):
+        ObstacleDetector.__init__(self, **kwargs)
+        # pixels a column needs before it counts as occupied, keeps speckle out
+        self.min_column = min_column
+
+    def find_box(self, roi):
+        mask = self.mask(roi)
+        counts = cv2.reduce(mask, 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S)[0] // 255
+        occupied = counts >= self.min_column
+        if not occupied.any():
+            return None
+
+        # start and end (exclusive) of every run of occupied columns
+        edges = np.diff(np.concatenate(([0], occupied.astype(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+
+        # pick the run with the most pixels in it
+        cumulative = np.concatenate(([0], np.cumsum(counts)))
+        totals = cumulative[ends] - cumulative[starts]
+        best = int(np.argmax(totals))
+        x0, x1 = starts[best], ends[best]
+
+        rows = np.flatnonzero(cv2.reduce(mask[:, x0:x1], 1, cv2.REDUCE_MAX)[:, 0])
+        return (int(x0), int(rows[0]), int(x1 - x0), int(rows[-1] - rows[0] + 1))
+
+
+class PyramidDetector(ObstacleDetector):
+    """
+    Runs the contour path on a frame decimated by `factor` in both directions, then
+    scales the box back up. Decimation (instead of cv2.pyrDown) keeps NaNs from
+    bleeding into their neighbours.
+    """
+    name = 'pyramid'
+
+    def __init__(self, factor=4, **kwargs):
+        ObstacleDetector.__init__(self, **kwargs)
+        self.factor = factor
+
+    def find_box(self, roi):
+        f = self.factor
+        box = largest_contour_box(self.mask(roi[::f, ::f]))
+        if box is None:
+            return None
+        x, y, w, h = box
+        return (x * f, y * f, w * f, h * f)
+
+
+class BlobDetector(ObstacleDetector):
+    """
+    The contour path with blob_features: largest blob by pixel area (a blob's
+    holes don't count, unlike contourArea) and its bounding box
+    """
+    name = 'blobs'
+
+    def find_box(self, roi):
+        blobs = blob_features(self.mask(roi))
+        if len(blobs) == 0:
+            return None
+        largest = blobs[0]
+        return (int(largest['x']), int(largest['y']), int(largest['w']), int(largest['h']))
+
+
+BACKENDS = {
+    ContourDetector.name: ContourDetector,
+    ColumnHistogramDetector.name: ColumnHistogramDetector,
+    PyramidDetector.name: PyramidDetector,
+    BlobDetector.name: BlobDetector,
+}
+
+# the backend Main2 uses: the original contour path, the others are picked
+# explicitly (see bench_obstacles.py for how often they agree with it)
+DEFAULT_BACKEND = ContourDetector.name
+
+
+def make_detector(name=DEFAULT_BACKEND, **kwargs):
+    """
+    - Build a detector by backend name
+    :param: one of BACKENDS, keyword arguments for the detector
+    :return: ObstacleDetector
+    """
+    if name not in BACKENDS:
+        raise ValueError("unknown obstacle backend %r, choose from %s" % (name, sorted(BACKENDS)))
+    return BACKENDS[name](**kwargs)
@@ -0,0 +1,186 @@
+"""
+Queue of fetch orders and the tours that serve them
+
+Orders name the dispenser (ARTag) to fetch from and can come in at any time.
+Instead of a round trip from home per order, the robot takes a batch of them:
+the dispensers of the oldest orders are visited in the order that makes the
+shortest tour from where the robot is back to home, then the next batch is started.
+The tour is exact (Held-Karp dynamic programming) for the few dispensers there
+are, and nearest neighbour improved with 2-opt when there are many.
+"""
+import itertools
+
+# dispensers visited per trip before going home (what the bowl holds)
+TRIP_STOPS = 4
+# the tour is planned exactly up to this many stops, heuristically above
+EXACT_STOPS = 10
+
+
+def tour_cost(start, stops, end, cost):
+    """
+    - Cost of driving start -> stops in order -> end
+    :param: start, list of stops, end, function(a, b) giving the cost of a -> b
+    :return: float
+    """
+    points = [start] + list(stops) + [end]
+    return sum(cost(a, b) for a, b in zip(points[:-1], points[1:]))
+
+
+def exact_tour(start, stops, end, cost):
+    """
+    - Shortest order to visit every stop going from start to end, with the
+    Held-Karp dynamic programming over subsets of stops, O(2^n n^2)
+    :param: start, list of stops, end, function(a, b) giving the cost of a -> b
+    :return: list of the stops in visiting order
+    """
+    n = len(stops)
+    if n == 0:
+        return []
+    # best[mask][i]: cheapest way to leave start, visit the stops in mask and end at stop i
+    best = [[float('inf')] * n for _ in range(1 << n)]
+    parent = [[-1] * n for _ in range(1 << n)]
+    for i in range(n):
+        best[1 << i][i] = cost(start, stops[i])
+    for mask in range(1, 1 << n):
+        for i in range(n):
+            here = best[mask][i]
+            if here == float('inf') or not mask & (1 << i):
+                continue
+            for j in range(n):
+                if mask & (1 << j):
+                    continue
+                nxt = mask | (1 << j)
+                c = here + cost(stops[i], stops[j])
+                if c < best[nxt][j]:
+                    best[nxt][j] = c
+                    parent[nxt][j] = i
+
+    full = (1 << n) - 1
+    last = min(range(n), key=lambda i: best[full][i] + cost(stops[i], end))
+    order = []
+    mask = full
+    while last != -1:
+        order.append(stops[last])
+        last, mask = parent[mask][last], mask & ~(1 << last)
+    return order[::-1]
+
+
+def heuristic_tour(start, stops, end, cost):
+    """
+    - Good order to visit every stop going from start to end: nearest
+    neighbour, then 2-opt (reversing stretches of the tour) until nothing improves
+    :param: start, list of stops, end, function(a, b) giving the cost of a -> b
+    :return: list of the stops in visiting order
+    """
+    left = list(stops)
+    order = []
+    here = start
+    while left:
+        here = min(left, key=lambda s: cost(here, s))
+        left.remove(here)
+        order.append(here)
+
+    improved = True
+    while improved:
+        improved = False
+        for i, j in itertools.combinations(range(len(order)), 2):
+            candidate = order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+            if tour_cost(start, candidate, end, cost) < tour_cost(start, order, end, cost) - 1e-9:
+                order = candidate
+                improved = True
+    return order
+
+
+def plan_tour(start, stops, end, cost):
+    """
+    - Order to visit the stops in, exact when there are few of them
+    :param: start, list of stops, end, function(a, b) giving the cost of a -> b
+    :return: list of the stops in visiting order
+    """
+    if len(stops) <= EXACT_STOPS:
+        return exact_tour(start, stops, end, cost)
+    return heuristic_tour(start, stops, end, cost)
+
+
+class OrderQueue:
+    def __init__(self, cost, trip_stops=TRIP_STOPS, keep_order=False):
+        """
+        :param: function(a, b) giving the cost of driving from ARTag a to b
+        (RouteTable.length), dispensers visited per trip, whether trips visit the
+        dispensers in the order the orders came in (the fleet coordinator's ETA order)
+        """
+        self.cost = cost
+        self.trip_stops = trip_stops
+        self.keep_order = keep_order
+        # ARTag of every order not picked up yet, oldest first
+        self.pending = []
+        # ARTags left to visit on the current trip, in order
+        self.trip = []
+        # orders picked up on the current trip and orders brought home
+        self.picked = 0
+        self.delivered = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, tag):
+        """
+        - Take a new order
+        :param: ARTag of the dispenser
+        :return: None
+        """
+        self.pending.append(tag)
+
+    def start_trip(self, start, home):
+        """
+        - Plan the next trip: the dispensers of the oldest orders, as many as fit
+        in a trip, in the order of the shortest tour from start back home (or
+        in the order they came in with keep_order)
+        :param: ARTag the robot is at, ARTag of home
+        :return: list of ARTags to visit, empty if there are no orders
+        """
+        stops = []
+        for tag in self.pending:
+            if tag not in stops:
+                stops.append(tag)
+            if len(stops) == self.trip_stops:
+                break
+        self.trip = stops if self.keep_order else plan_tour(start, stops, home, self.cost)
+        return list(self.trip)
+
+    def next_stop(self):
+        """
+        - The next ARTag of the current trip, None when the trip is done
+        """
+        return self.trip[0] if self.trip else None
+
+    def picked_up(self, tag):
+        """
+        - The robot parked at a dispenser, every order for it is picked up
+        :param: ARTag of the dispenser
+        :return: number of orders picked up
+        """
+        if tag in self.trip:
+            self.trip.remove(tag)
+        count = self.pending.count(tag)
+        self.pending = [t for t in self.pending if t != tag]
+        self.picked += count
+        return count
+
+    def arrived_home(self):
+        """
+        - The robot is back home, everything picked up is delivered
+        :return: number of orders delivered
+        """
+        count = self.picked
+        self.delivered += count
+        self.picked = 0
+        return count
+
+    def cancel(self):
+        """
+        - Drop every order, picked up ones included, and the current trip
+        """
+        self.pending = []
+        self.trip = []
+        self.picked = 0
@@ -0,0 +1,235 @@
+"""
+Timing of the callbacks and the control loop
+
+Profiler keeps a latency histogram per callback and per state of the control
+loop, counts control ticks that overran their period or their state's time
+budget, and how long the robot stayed in each state. Histograms are HDR style:
+exact below 64 us, then 32 buckets per power of two (about 3% error) up to
+hours, so recording is a few integer operations whatever the value.
+
+Main2 writes the summary to PROFILE_FILE every DUMP_PERIOD seconds and on
+shutdown; print it with
+
+usage: python profile_script.py [profile file]
+"""
+import os
+import sys
+import json
+import time
+import numpy as np
+
+# where Main2 dumps the profile, and how often (s)
+PROFILE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profile.json')
+DUMP_PERIOD = 30.0
+
+# histogram resolution: 2^SUB_BITS buckets per power of two
+SUB_BITS = 5
+SUB = 1 << SUB_BITS
+# largest power of two above 2 * SUB that is recorded, 2^40 us is about 12 days
+MAX_SHIFT = 40
+
+# time (s) a control tick may spend in a state when it has no budget of its own
+DEFAULT_BUDGET = 0.02
+
+# percentiles shown by the summary
+PERCENTILES = [50, 90, 99]
+
+
+def bucket(us):
+    """
+    - Histogram bucket of a value in microseconds
+    """
+    if us < 2 * SUB:
+        return max(us, 0)
+    shift = min(us.bit_length() - SUB_BITS - 1, MAX_SHIFT)
+    return (shift + 1) * SUB + min((us >> shift) - SUB, SUB - 1)
+
+
+def bucket_value(index):
+    """
+    - Value (us) in the middle of a histogram bucket
+    """
+    if index < 2 * SUB:
+        return float(index)
+    shift = index // SUB - 1
+    return float(((index % SUB + SUB) << shift) + (1 << shift) / 2.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = np.zeros((MAX_SHIFT + 2) * SUB, np.int64)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, secs):
+        """
+        - Add a duration
+        :param: seconds
+        :return: None
+        """
+        us = int(secs * 1e6)
+        self.counts[bucket(us)] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        """
+        - Duration (s) below which p percent of the recorded ones are
+        """
+        if self.count == 0:
+            return 0.0
+        rank = int(np.ceil(p / 100.0 * self.count))
+        index = int(np.searchsorted(np.cumsum(self.counts), max(rank, 1)))
+        return min(bucket_value(index), self.max) / 1e6
+
+    def mean(self):
+        return self.total / 1e6 / self.count if self.count else 0.0
+
+    def summary(self):
+        """
+        - Dictionary of count, mean, percentiles and max, durations in ms
+        """
+        stats = {'count': self.count, 'mean_ms': 1000 * self.mean(), 'max_ms': self.max / 1000.0}
+        for p in PERCENTILES:
+            stats['p%d_ms' % p] = 1000 * self.percentile(p)
+        return stats
+
+
+class Profiler:
+    def __init__(self, period, budgets=None, filename=PROFILE_FILE, clock=time.time):
+        """
+        :param: period of the control loop (s), dictionary of state -> time (s) a
+        tick may spend in it, file the summary is dumped to, function giving the
+        loop's clock (rospy.get_time on the robot so simulated time works too)
+        """
+        self.period = period
+        self.budgets = dict(budgets or {})
+        self.filename = filename
+        self.clock = clock
+        # name -> Histogram of callbacks and states (state:<name>)
+        self.histograms = {}
+        # control loop: ticks, ticks that ran over their period, time of the last tick
+        self.ticks = 0
+        self.overruns = 0
+        self.last_tick = None
+        # state -> ticks over its budget
+        self.over_budget = {}
+        # state the loop is in, since when, and 'a->b' -> number of transitions
+        self.state = None
+        self.state_since = None
+        self.transitions = {}
+        self.last_dump = None
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def timed(self, name, callback):
+        """
+        - Wrap a callback so every call is timed under `name`
+        :param: name, function(msg)
+        :return: function(msg)
+        """
+        histogram = self.histogram(name)
+
+        def timed_callback(msg):
+            began = time.time()
+            try:
+                return callback(msg)
+            finally:
+                histogram.record(time.time() - began)
+        return timed_callback
+
+    def tick(self, state, began, ended):
+        """
+        - Record one control tick: its time in `state` against the state's budget,
+        the period since the last tick (loop jitter) and state transitions
+        :param: state name, time.time() when the tick's work began and ended
+        :return: None
+        """
+        spent = ended - began
+        self.histogram('state:' + state).record(spent)
+        if spent > self.budgets.get(state, DEFAULT_BUDGET):
+            self.over_budget[state] = self.over_budget.get(state, 0) + 1
+
+        now = self.clock()
+        if self.last_tick is not None:
+            period = now - self.last_tick
+            self.histogram('loop period').record(period)
+            if period > 1.5 * self.period:
+                self.overruns += 1
+        self.last_tick = now
+        self.ticks += 1
+
+        if state != self.state:
+            if self.state is not None:
+                self.histogram('dwell:' + self.state).record(now - self.state_since)
+                key = '%s->%s' % (self.state, state)
+                self.transitions[key] = self.transitions.get(key, 0) + 1
+            self.state, self.state_since = state, now
+
+        if self.last_dump is None:
+            self.last_dump = now
+        elif now - self.last_dump >= DUMP_PERIOD:
+            self.dump()
+            self.last_dump = now
+
+    def summary(self):
+        """
+        - Everything recorded, as a dictionary that can be written as JSON
+        """
+        return {'time': time.time(),
+                'period_s': self.period,
+                'ticks': self.ticks,
+                'overruns': self.overruns,
+                'over_budget': self.over_budget,
+                'budgets_s': dict((state, self.budgets.get(state, DEFAULT_BUDGET))
+                                  for state in self.over_budget),
+                'transitions': self.transitions,
+                'timers': dict((name, h.summary()) for name, h in self.histograms.items())}
+
+    def dump(self, filename=None):
+        """
+        - Write the summary to the profile file (replaced atomically)
+        """
+        filename = filename or self.filename
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.summary(), f, indent=1, sort_keys=True)
+        os.rename(tmp, filename)
+
+
+def format_summary(summary):
+    """
+    - Table of a Profiler summary, slowest timers (by p99) first
+    :return: string
+    """
+    lines = ["%d control ticks of %.0f ms, %d overran (over 1.5x the period)" % (
+        summary['ticks'], 1000 * summary['period_s'], summary['overruns'])]
+    for state, count in sorted(summary['over_budget'].items()):
+        lines.append("  %-24s %6d ticks over its %.0f ms budget" % (
+            state, count, 1000 * summary['budgets_s'][state]))
+    lines.append("")
+    columns = ['count', 'mean_ms'] + ['p%d_ms' % p for p in PERCENTILES] + ['max_ms']
+    lines.append("%-28s" % "timer" + "".join("%10s" % c for c in columns))
+    timers = sorted([item for item in summary['timers'].items() if item[1]['count'] > 0],
+                    key=lambda item: -item[1]['p99_ms'])
+    for name, stats in timers:
+        lines.append("%-28s%10d" % (name, stats['count']) +
+                     "".join("%10.2f" % stats[c] for c in columns[1:]))
+    if summary['transitions']:
+        lines.append("")
+        lines.append("transitions")
+        for key, count in sorted(summary['transitions'].items(), key=lambda item: -item[1]):
+            lines.append("  %-40s %6d" % (key, count))
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else PROFILE_FILE
+    with open(filename) as f:
+        print format_summary(json.load(f))
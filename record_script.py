@@ -0,0 +1,498 @@
+"""
+Recording and replaying the robot's sensor streams
+
+Recorder saves depth frames, AlvarMarkers, EKF poses and bump events to one
+file while the robot runs. Callbacks only hand the message to a queue; a
+writer thread converts and writes them, dropping messages (and counting the
+drops) rather than ever making a callback wait.
+
+The file is a header, then chunks, then an index of the chunks:
+    chunk:   CHUNK_HEADER, receive times (float64 x count), data
+    data:    depth as uint16 mm frames (count x height x width), raw or zlib,
+             other streams as records of float64 (see DTYPES)
+    index:   one INDEX_DTYPE row per chunk, then the index offset and INDEX_MAGIC
+Raw chunks are read straight out of a memory map, and a file whose index is
+missing (the robot died while recording) is indexed by walking the chunks.
+
+Recording's replay drives Main2 itself: ReplayWorld plays the role of the
+simulator's world for sim_util, delivering the recorded messages at their
+times, in real time or as fast as possible.
+
+usage: python record_script.py info <file>
+       python record_script.py play <file> <ARTag> [home ARTag] [--fast] [--verbose]
+"""
+import os
+import sys
+import zlib
+import mmap
+import heapq
+import struct
+import threading
+import time
+import Queue
+import numpy as np
+
+MAGIC = b'FCREC001'
+INDEX_MAGIC = b'FCRECIDX'
+# kind, codec, number of messages, frame height and width, first and last
+# receive time, bytes of times + data
+CHUNK_HEADER = struct.Struct('<4sBxxxIHHddQ')
+TRAILER = struct.Struct('<Q8s')
+INDEX_DTYPE = np.dtype([('kind', 'S4'), ('codec', 'u1'), ('count', '<u4'), ('height', '<u2'),
+                        ('width', '<u2'), ('t_first', '<f8'), ('t_last', '<f8'),
+                        ('offset', '<u8'), ('length', '<u8')])
+RAW = 0
+ZLIB = 1
+
+# streams: kind -> topic Main2 subscribes to
+DEPTH = b'DPTH'
+MARKERS = b'MARK'
+EKF = b'EKF_'
+BUMP = b'BUMP'
+TOPICS = {DEPTH: '/camera/depth/image',
+          MARKERS: '/ar_pose_marker',
+          EKF: '/robot_pose_ekf/odom_combined',
+          BUMP: 'mobile_base/events/bumper'}
+
+# one record per marker (id -1 for a message without markers), pose and bump
+MARKER_DTYPE = np.dtype([('stamp', '<f8'), ('id', '<f8'), ('x', '<f8'), ('y', '<f8'), ('z', '<f8'),
+                         ('qx', '<f8'), ('qy', '<f8'), ('qz', '<f8'), ('qw', '<f8')])
+EKF_DTYPE = np.dtype([('stamp', '<f8'), ('x', '<f8'), ('y', '<f8'), ('z', '<f8'),
+                      ('qx', '<f8'), ('qy', '<f8'), ('qz', '<f8'), ('qw', '<f8'),
+                      ('cov', '<f8', (36,))])
+BUMP_DTYPE = np.dtype([('bumper', '<f8'), ('state', '<f8')])
+DTYPES = {MARKERS: MARKER_DTYPE, EKF: EKF_DTYPE, BUMP: BUMP_DTYPE}
+
+# a chunk is written once it holds this many depth frames or spans this long (s)
+CHUNK_FRAMES = 30
+CHUNK_SECONDS = 1.0
+# messages waiting for the writer thread before new ones are dropped
+QUEUE_SIZE = 120
+# zlib level for compressed depth, 1 is fast and already halves typical frames
+ZLIB_LEVEL = 1
+
+
+def stamp_of(msg, default):
+    """
+    - Header time stamp of a message (s), `default` when it has none
+    """
+    header = getattr(msg, 'header', None)
+    if header is None:
+        return default
+    return header.stamp.to_sec() or default
+
+
+def depth_to_mm(depth):
+    """
+    - Depth frame in m (float, NaN where unknown) as uint16 mm (0 where unknown)
+    """
+    if depth.dtype == np.uint16:
+        return depth
+    with np.errstate(invalid='ignore'):
+        mm = np.nan_to_num(np.asarray(depth, np.float32) * 1000.0)
+    return np.clip(mm, 0, 65535).astype(np.uint16)
+
+
+def mm_to_depth(mm):
+    """
+    - uint16 mm frame back to float32 m with NaN where unknown, as the camera gives it
+    """
+    depth = mm.astype(np.float32) / 1000.0
+    depth[mm == 0] = np.nan
+    return depth
+
+
+class Recorder:
+    def __init__(self, filename, depth_image, compress=False, queue_size=QUEUE_SIZE):
+        """
+        :param: file to record to, function(Image message) giving the depth array
+        (CvBridge.imgmsg_to_cv2), zlib the depth frames, messages that may wait
+        """
+        self.filename = filename
+        self.depth_image = depth_image
+        self.codec = ZLIB if compress else RAW
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.written = 0
+
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC)
+        # INDEX_DTYPE rows of the chunks written so far
+        self.index = []
+        # kind -> (receive times, converted items) waiting to become a chunk
+        self.pending = {}
+
+        self.thread = threading.Thread(target=self.write_loop, name='recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, kind, msg, now):
+        """
+        - Record a message, called from the callbacks: never blocks, and
+        drops the message if the writer has fallen behind
+        :param: stream kind, message, receive time (s)
+        :return: None
+        """
+        try:
+            self.queue.put_nowait((kind, now, msg))
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        - Write what is left and the index, and close the file
+        """
+        if not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+
+    # ---- writer thread ----
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, now, msg = item
+            times, items = self.pending.setdefault(kind, ([], []))
+            times.append(now)
+            items.append(self.convert(kind, msg, now))
+            if (kind == DEPTH and len(times) >= CHUNK_FRAMES) or now - times[0] >= CHUNK_SECONDS:
+                self.write_chunk(kind)
+        for kind in list(self.pending):
+            self.write_chunk(kind)
+        self.write_index()
+        self.file.close()
+
+    def convert(self, kind, msg, now):
+        """
+        - A message as what gets stored: a uint16 frame, or a list of records
+        """
+        if kind == DEPTH:
+            return depth_to_mm(self.depth_image(msg))
+        if kind == MARKERS:
+            rows = []
+            for marker in msg.markers:
+                p, q = marker.pose.pose.position, marker.pose.pose.orientation
+                rows.append((stamp_of(marker, now), marker.id, p.x, p.y, p.z, q.x, q.y, q.z, q.w))
+            return rows or [(stamp_of(msg, now), -1, 0, 0, 0, 0, 0, 0, 1)]
+        if kind == EKF:
+            p, q = msg.pose.pose.position, msg.pose.pose.orientation
+            return [(stamp_of(msg, now), p.x, p.y, p.z, q.x, q.y, q.z, q.w, tuple(msg.pose.covariance))]
+        return [(msg.bumper, msg.state)]
+
+    def write_chunk(self, kind):
+        times, items = self.pending.pop(kind, ([], []))
+        if not times:
+            return
+        height = width = 0
+        codec = RAW
+        if kind == DEPTH:
+            frames = np.stack(items)
+            height, width = frames.shape[1:]
+            data = frames.tobytes()
+            codec = self.codec
+            if codec == ZLIB:
+                data = zlib.compress(data, ZLIB_LEVEL)
+        else:
+            # markers can have several records per message, with the message's time each
+            times = [t for t, rows in zip(times, items) for _ in rows]
+            data = np.array([row for rows in items for row in rows], DTYPES[kind]).tobytes()
+        stamps = np.array(times, '<f8').tobytes()
+        offset = self.file.tell()
+        self.file.write(CHUNK_HEADER.pack(kind, codec, len(times), height, width,
+                                          times[0], times[-1], len(stamps) + len(data)))
+        self.file.write(stamps)
+        self.file.write(data)
+        self.index.append((kind, codec, len(times), height, width, times[0], times[-1],
+                           offset, len(stamps) + len(data)))
+        self.written += len(items)
+
+    def write_index(self):
+        offset = self.file.tell()
+        self.file.write(np.array(self.index, INDEX_DTYPE).tobytes())
+        self.file.write(TRAILER.pack(offset, INDEX_MAGIC))
+
+
+class Recording:
+    def __init__(self, filename):
+        """
+        :param: file written by a Recorder
+        """
+        self.file = open(filename, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise IOError("%s is not a recording" % filename)
+        self.index = self.read_index()
+
+    def read_index(self):
+        """
+        - The chunk index from the end of the file, or rebuilt by walking the
+        chunks when the recording was cut short
+        :return: INDEX_DTYPE array sorted by time
+        """
+        if len(self.data) >= len(MAGIC) + TRAILER.size:
+            offset, magic = TRAILER.unpack_from(self.data, len(self.data) - TRAILER.size)
+            if magic == INDEX_MAGIC:
+                count = (len(self.data) - TRAILER.size - offset) // INDEX_DTYPE.itemsize
+                index = np.frombuffer(self.data, INDEX_DTYPE, count, offset)
+                return np.sort(index, order='t_first')
+        rows = []
+        offset = len(MAGIC)
+        while offset + CHUNK_HEADER.size <= len(self.data):
+            header = CHUNK_HEADER.unpack_from(self.data, offset)
+            length = header[-1]
+            if header[0] not in TOPICS or offset + CHUNK_HEADER.size + length > len(self.data):
+                break
+            rows.append(header[:-1] + (offset, length))
+            offset += CHUNK_HEADER.size + length
+        return np.sort(np.array(rows, INDEX_DTYPE), order='t_first')
+
+    def chunks(self, kind):
+        return self.index[self.index['kind'] == kind]
+
+    def times(self, chunk):
+        """
+        - Receive times of the messages in a chunk, a view of the file
+        """
+        return np.frombuffer(self.data, '<f8', int(chunk['count']),
+                             int(chunk['offset']) + CHUNK_HEADER.size)
+
+    def payload(self, chunk):
+        start = int(chunk['offset']) + CHUNK_HEADER.size + 8 * int(chunk['count'])
+        end = int(chunk['offset']) + CHUNK_HEADER.size + int(chunk['length'])
+        return start, end
+
+    def frames(self, chunk):
+        """
+        - Depth frames (uint16 mm) of a chunk, a view of the file when raw
+        :return: count x height x width array
+        """
+        start, end = self.payload(chunk)
+        shape = (int(chunk['count']), int(chunk['height']), int(chunk['width']))
+        if chunk['codec'] == ZLIB:
+            return np.frombuffer(zlib.decompress(self.data[start:end]), '<u2').reshape(shape)
+        return np.frombuffer(self.data, '<u2', shape[0] * shape[1] * shape[2], start).reshape(shape)
+
+    def records(self, chunk):
+        """
+        - Records of a marker, EKF or bump chunk, a view of the file
+        """
+        start, end = self.payload(chunk)
+        dtype = DTYPES[chunk['kind']]
+        return np.frombuffer(self.data, dtype, (end - start) // dtype.itemsize, start)
+
+    def depth(self, start=None, end=None):
+        """
+        - Depth frames received between two times
+        :return: generator of (receive time, float32 frame in m)
+        """
+        for chunk in self.chunks(DEPTH):
+            if (start is not None and chunk['t_last'] < start) or (end is not None and chunk['t_first'] > end):
+                continue
+            times, frames = self.times(chunk), self.frames(chunk)
+            for i in range(len(times)):
+                if (start is None or times[i] >= start) and (end is None or times[i] <= end):
+                    yield times[i], mm_to_depth(frames[i])
+
+    def stream(self, kind, build):
+        """
+        - One stream as messages in receive order
+        :param: stream kind, function(kind, time, records or frame) -> message
+        :return: generator of (receive time, kind, message)
+        """
+        for chunk in self.chunks(kind):
+            times = self.times(chunk)
+            if kind == DEPTH:
+                frames = self.frames(chunk)
+                for i in range(len(times)):
+                    yield times[i], kind, build(kind, times[i], frames[i])
+                continue
+            records = self.records(chunk)
+            # consecutive records with the same time are one message
+            edges = np.flatnonzero(np.diff(times)) + 1
+            for group in np.split(np.arange(len(times)), edges):
+                yield times[group[0]], kind, build(kind, times[group[0]], records[group])
+
+    def messages(self, build, kinds=None):
+        """
+        - Every stream merged in receive order
+        :param: function(kind, time, records or frame) -> message, kinds to play (all by default)
+        :return: generator of (receive time, kind, message)
+        """
+        kinds = kinds or [kind for kind in TOPICS if len(self.chunks(kind))]
+        return heapq.merge(*[self.stream(kind, build) for kind in kinds])
+
+    def span(self):
+        """
+        - First and last receive time
+        """
+        if len(self.index) == 0:
+            return 0.0, 0.0
+        return float(self.index['t_first'].min()), float(self.index['t_last'].max())
+
+    def info(self):
+        """
+        - Description of the streams, for 'python record_script.py info'
+        """
+        start, end = self.span()
+        lines = ["%.1f s, %d chunks, %.1f MB" % (end - start, len(self.index), len(self.data) / 1e6)]
+        for kind in sorted(TOPICS):
+            chunks = self.chunks(kind)
+            if len(chunks):
+                lines.append("  %-32s %6d messages %8.1f MB" % (
+                    TOPICS[kind], sum(len(np.unique(self.times(c))) for c in chunks),
+                    chunks['length'].sum() / 1e6))
+        return "\n".join(lines)
+
+
+def message_builder():
+    """
+    - Function turning stored records back into the messages Main2's callbacks
+    take, with the message classes currently in sys.modules (ROS or sim_util)
+    """
+    import rospy
+    from geometry_msgs.msg import PoseWithCovarianceStamped
+    from kobuki_msgs.msg import BumperEvent
+    from ar_track_alvar_msgs.msg import AlvarMarker, AlvarMarkers
+    from cv_bridge import CvBridge
+    bridge = CvBridge()
+
+    def set_pose(pose, r):
+        pose.position.x, pose.position.y, pose.position.z = r['x'], r['y'], r['z']
+        pose.orientation.x, pose.orientation.y = r['qx'], r['qy']
+        pose.orientation.z, pose.orientation.w = r['qz'], r['qw']
+
+    def build(kind, t, data):
+        if kind == DEPTH:
+            msg = bridge.cv2_to_imgmsg(mm_to_depth(data))
+            msg.header.stamp = rospy.Time.from_sec(t)
+            return msg
+        if kind == MARKERS:
+            msg = AlvarMarkers()
+            msg.header.stamp = rospy.Time.from_sec(t)
+            for r in data:
+                if r['id'] < 0:
+                    continue
+                marker = AlvarMarker()
+                marker.id = int(r['id'])
+                marker.header.stamp = rospy.Time.from_sec(r['stamp'])
+                set_pose(marker.pose.pose, r)
+                msg.markers.append(marker)
+            return msg
+        if kind == EKF:
+            r = data[0]
+            msg = PoseWithCovarianceStamped()
+            msg.header.stamp = rospy.Time.from_sec(r['stamp'])
+            set_pose(msg.pose.pose, r)
+            msg.pose.covariance = list(r['cov'])
+            return msg
+        msg = BumperEvent()
+        msg.bumper, msg.state = int(data[0]['bumper']), int(data[0]['state'])
+        return msg
+    return build
+
+
+class ReplayWorld:
+    """
+    World for sim_util that delivers a recording instead of simulating: Main2
+    runs unmodified on the recorded messages, its commands go nowhere
+    """
+    def __init__(self, recording, realtime=True, verbose=False):
+        self.recording = recording
+        self.realtime = realtime
+        self.verbose = verbose
+        self.shutdown_callbacks = []
+        self.subscribers = {}
+        self.start, self.end = recording.span()
+        self.time = self.start
+        self.began = None
+        self.messages = None
+        self.next = None
+        self.delivered = 0
+
+    def now(self):
+        return self.time
+
+    def subscribe(self, topic, callback):
+        self.subscribers.setdefault(topic, []).append(callback)
+
+    def publish(self, topic, msg):
+        if topic == '/mobile_base/commands/reset_odometry':
+            # reset messages take a moment to go through
+            self.advance(0.001)
+
+    def is_shutdown(self):
+        return self.time > self.end
+
+    def advance(self, secs):
+        """
+        - Deliver the messages received in the next `secs` seconds of the
+        recording, waiting for them in real time unless playing as fast as possible
+        """
+        if self.messages is None:
+            self.messages = self.recording.messages(message_builder())
+            self.next = next(self.messages, None)
+            self.began = time.time()
+        end = self.time + secs
+        while self.next is not None and self.next[0] <= end:
+            t, kind, msg = self.next
+            self.wait_until(t)
+            self.time = max(self.time, t)
+            for callback in self.subscribers.get(TOPICS[kind], []):
+                callback(msg)
+            self.delivered += 1
+            self.next = next(self.messages, None)
+        self.wait_until(end)
+        self.time = end
+
+    def wait_until(self, t):
+        if self.realtime:
+            delay = (t - self.start) - (time.time() - self.began)
+            if delay > 0:
+                time.sleep(delay)
+
+
+def play(filename, tag, home=1, realtime=True, verbose=False):
+    """
+    - Run Main2 on a recording
+    :return: dictionary with the recorded and wall clock seconds and messages delivered
+    """
+    import sim_util
+    sim_util.install()
+    recording = Recording(filename)
+    world = ReplayWorld(recording, realtime, verbose)
+    sim_util.set_world(world)
+    import main
+
+    argv = sys.argv
+    stdout = sys.stdout
+    # a replay doesn't change the stored map
+    sys.argv = ['main.py', str(tag), str(home), '--world=']
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    began = time.time()
+    try:
+        robot = main.Main2()
+        try:
+            robot.run()
+        except sim_util.ROSInterruptException:
+            pass
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+        sys.stdout = stdout
+        sys.argv = argv
+    return {'recorded': world.end - world.start, 'wall_time': time.time() - began,
+            'messages': world.delivered}
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    if args[0] == 'info':
+        print Recording(args[1]).info()
+    elif args[0] == 'play':
+        result = play(args[1], args[2], int(args[3]) if len(args) > 3 else 1,
+                      realtime='--fast' not in sys.argv, verbose='--verbose' in sys.argv)
+        print "replayed %.1f s of recording (%d messages) in %.1f s" % (
+            result['recorded'], result['messages'], result['wall_time'])
@@ -0,0 +1,220 @@
+"""
+Relocalization of the robot against the ARTags it knows
+
+The EKF pose (robot_pose_ekf) is odometry: it drifts, and nothing pulls it
+back. Relocalizer keeps a corrected pose (x, y, heading) in the world frame
+with its covariance, an extended Kalman filter of its own:
+    predict()   every EKF pose moves the corrected pose by the odometry step,
+                the covariance grows by what the EKF's own covariance grew by
+                (at least by ODOM_POS_NOISE and ODOM_ROT_NOISE)
+    observe()   every detection of an ARTag whose pose is known (the frame
+                ('tag', id) of the MapMaker's frame_script.FrameTree) is fused,
+                weighted by the covariance, unless its innovation is beyond GATE;
+                observe_all() takes those of a whole AlvarMarkers message
+    fix()       the robot is known to be somewhere, at the parking spot of the
+                ARTag it just docked at
+An ARTag whose pose isn't known yet is learned from a detection while the
+pose is certain (position sigma under LEARN_STD): at the home base where the
+odometry starts, and after every docking. What is known of the ARTags is kept
+in the landmark_script.LandmarkTable.
+"""
+import math
+import threading
+import numpy as np
+
+import frame_script
+import ar_script
+
+# sigma of the pose where the odometry was reset (m, rad)
+START_STD = (0.02, 0.02)
+# odometry error, variance added per meter driven (m^2 / m) and per radian turned (rad^2 / rad)
+ODOM_POS_NOISE = 0.05 ** 2
+ODOM_ROT_NOISE = 0.05 ** 2
+# noise of a detection (m) at 0 m plus per meter away, as the ARTag filters have it
+MEAS_POS_NOISE = ar_script.MEAS_POS_NOISE
+MEAS_POS_NOISE_PER_M = ar_script.MEAS_POS_NOISE_PER_M
+# detections further than this (squared Mahalanobis distance, 99% for 2 dof)
+# from where the ARTag should be are rejected; this many in a row and the pose
+# is less certain than the covariance says, which then grows by REJECT_GROWTH
+GATE = 9.21
+MAX_REJECTS = 5
+REJECT_GROWTH = 4.0
+# ARTags are learned while the position sigma (m) is under this
+LEARN_STD = 0.05
+# odometry steps bigger than this (m, rad) are an odometry reset, not motion
+MAX_ODOM_STEP = ar_script.MAX_ODOM_STEP
+
+
+class Relocalizer:
+    def __init__(self, mapper, landmarks):
+        """
+        :param: MapMaker, the ARTag frames are kept in its frames,
+        landmark_script.LandmarkTable, the ARTags learned in earlier runs to begin with
+        """
+        self.mapper = mapper
+        self.landmarks = landmarks
+        # predict() runs on the odometry callback's thread and observe() on the 
+        # ARTag callback's, every method reading or changing the pose holds this
+        self.lock = threading.RLock()
+        for tag in landmarks.learned_ids():
+            mapper.set_tag(tag, landmarks.marker[tag], landmarks.heading[tag])
+        # detections fused and rejected, for the logs
+        self.fused = 0
+        self.rejected = 0
+        self.reset()
+
+    def reset(self, pose=(0.0, 0.0, 0.0)):
+        """
+        - Start again from a pose, when the odometry is reset
+        :param: (x, y, heading) in the world frame
+        :return: None
+        """
+        with self.lock:
+            self.pose = np.array(pose, float)
+            self.cov = np.diag([START_STD[0] ** 2, START_STD[0] ** 2, START_STD[1] ** 2])
+            # last odometry pose and the diagonal of its covariance
+            self.odom = None
+            self.odom_var = None
+            self.rejects = 0
+
+    def add_landmark(self, tag, position, normal, var):
+        """
+        - Know the pose of an ARTag
+        :param: tag id, map coordinates, heading of its normal in the map (rad),
+        variance of the position (m^2)
+        :return: None
+        """
+        with self.lock:
+            self.mapper.set_tag(tag, position, normal)
+            self.landmarks.set_marker(tag, position, normal, var)
+
+    def position(self):
+        """
+        - Corrected position and heading, as Main2.position and Main2.orientation
+        """
+        with self.lock:
+            return (float(self.pose[0]), float(self.pose[1])), float(self.pose[2])
+
+    def position_std(self):
+        """
+        - Sigma (m) of the position, the larger axis
+        """
+        with self.lock:
+            return math.sqrt(max(np.linalg.eigvalsh(self.cov[:2, :2])))
+
+    def predict(self, odom, odom_var):
+        """
+        - Move with the odometry
+        :param: EKF pose (x, y, heading), variances of its x, y and heading
+        :return: None
+        """
+        with self.lock:
+            odom_var = np.asarray(odom_var, float)
+            if self.odom is None:
+                self.odom, self.odom_var = odom, odom_var
+                return
+            # the step in the frame of the last odometry pose
+            c, s = math.cos(self.odom[2]), math.sin(self.odom[2])
+            dx, dy = odom[0] - self.odom[0], odom[1] - self.odom[1]
+            step = (c * dx + s * dy, -s * dx + c * dy)
+            turn = ar_script.wrap(odom[2] - self.odom[2])
+            grown = np.maximum(odom_var - self.odom_var, 0.0)
+            self.odom, self.odom_var = odom, odom_var
+            moved = math.hypot(step[0], step[1])
+            if moved > MAX_ODOM_STEP or abs(turn) > MAX_ODOM_STEP:
+                return
+
+            # the same step from the corrected pose
+            c, s = math.cos(self.pose[2]), math.sin(self.pose[2])
+            world_step = (c * step[0] - s * step[1], s * step[0] + c * step[1])
+            self.pose += (world_step[0], world_step[1], turn)
+            self.pose[2] = ar_script.wrap(self.pose[2])
+            F = np.eye(3)
+            F[0, 2] = -world_step[1]
+            F[1, 2] = world_step[0]
+            Q = np.diag([max(grown[0], ODOM_POS_NOISE * moved), max(grown[1], ODOM_POS_NOISE * moved),
+                         max(grown[2], ODOM_ROT_NOISE * abs(turn))])
+            self.cov = F.dot(self.cov).dot(F.T) + Q
+
+    def observe(self, tag, forward, left, roll):
+        """
+        - A detection of an ARTag: fused into the pose if the ARTag is known,
+        learned if it isn't and the pose is certain enough
+        :param: tag id, marker position in the robot frame (m), roll of the marker orientation (rad)
+        :return: True if the detection was used
+        """
+        with self.lock:
+            sigma = MEAS_POS_NOISE + MEAS_POS_NOISE_PER_M * math.hypot(forward, left)
+            if not self.landmarks.learned(tag):
+                if self.position_std() > LEARN_STD:
+                    return False
+                self.learn(tag, forward, left, roll, sigma ** 2)
+                return True
+
+            marker = self.mapper.frames.get(('tag', tag), 'world')
+            dx, dy = marker.x - self.pose[0], marker.y - self.pose[1]
+            c, s = math.cos(self.pose[2]), math.sin(self.pose[2])
+            expected = np.array([c * dx + s * dy, -s * dx + c * dy])
+            # derivatives of the expected detection by x, y and heading
+            H = np.array([[-c, -s, expected[1]],
+                          [s, -c, -expected[0]]])
+            S = H.dot(self.cov).dot(H.T) + np.eye(2) * (sigma ** 2 + self.landmarks.marker_var[tag])
+            S_inv = np.linalg.inv(S)
+            innovation = np.array([forward, left]) - expected
+            if innovation.dot(S_inv).dot(innovation) > GATE:
+                self.rejected += 1
+                self.rejects += 1
+                if self.rejects >= MAX_REJECTS:
+                    # the detections keep disagreeing: the pose is worse than we thought
+                    self.cov *= REJECT_GROWTH
+                    self.rejects = 0
+                return False
+            self.update(H, S_inv, innovation)
+            self.fused += 1
+            self.rejects = 0
+            return True
+
+    def observe_all(self, tags, forward, left, roll):
+        """
+        - The detections of an AlvarMarkers message, fused one after the other:
+        each moves the pose the next one is checked against
+        :param: arrays of tag ids, marker positions in the robot frame (m) and
+        rolls of the marker orientations (rad)
+        :return: number of detections used
+        """
+        with self.lock:
+            return sum(self.observe(*detection) for detection in
+                       zip(tags.tolist(), forward.tolist(), left.tolist(), roll.tolist()))
+
+    def fix(self, position, var):
+        """
+        - The robot is known to be at a position
+        :param: (x, y) in the world frame, variance (m^2)
+        :return: None
+        """
+        with self.lock:
+            H = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+            S_inv = np.linalg.inv(self.cov[:2, :2] + np.eye(2) * var)
+            self.update(H, S_inv, np.asarray(position, float) - self.pose[:2])
+
+    def update(self, H, S_inv, innovation):
+        """
+        - Kalman update of the pose
+        """
+        K = self.cov.dot(H.T).dot(S_inv)
+        self.pose += K.dot(innovation)
+        self.pose[2] = ar_script.wrap(self.pose[2])
+        self.cov = (np.eye(3) - K.dot(H)).dot(self.cov)
+        self.cov = (self.cov + self.cov.T) / 2
+
+    def learn(self, tag, forward, left, roll, var):
+        """
+        - Place an ARTag in the map from a detection and the current pose
+        """
+        normal = ar_script.marker_normal(forward, left, roll)
+        to_map = self.mapper.frames.get('world', 'map') * frame_script.pose(self.pose[:2], self.pose[2])
+        position = to_map((forward, left))
+        heading = ar_script.wrap(to_map.theta + normal)
+        # the pose's own uncertainty moves the ARTag along with it
+        var += np.trace(self.cov[:2, :2]) / 2 + (forward ** 2 + left ** 2) * self.cov[2, 2]
+        self.add_landmark(tag, position, heading, var)
@@ -0,0 +1,317 @@
+"""
+Precomputed routes between every pair of ARTags
+
+The places the robot drives between (dispensers and home bases, Main2.AR_ids) are
+few and don't move, so the A* paths between all of them are planned once, saved
+to disk and looked up with a dictionary hit during a mission. The cache file is
+keyed by a hash of the map and the tag table, and a change to a map cell only
+invalidates the routes it can affect.
+"""
+import os
+import hashlib
+import pickle
+import numpy as np
+
+import map_script
+
+# where the routes are cached between runs
+DEFAULT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routes.cache')
+
+# bump when the layout of the cache file changes
+CACHE_VERSION = 1
+
+
+def route_samples(start, waypoints, mapper):
+    """
+    - Grid cells the robot drives over following a route, sampled every quarter
+    cell (with repeats)
+    :param: start and waypoints in map coordinates, MapMaker for the grid conversion
+    :return: arrays of rows and cols
+    """
+    points = [mapper.mapToGrid(p) for p in [start] + list(waypoints)]
+    rows, cols = [np.zeros(0, int)], [np.zeros(0, int)]
+    for a, b in zip(points[:-1], points[1:]):
+        steps = 4 * max(abs(b[0] - a[0]), abs(b[1] - a[1])) + 1
+        t = np.linspace(0.0, 1.0, steps)
+        rows.append(np.rint(a[0] + t * (b[0] - a[0])).astype(int))
+        cols.append(np.rint(a[1] + t * (b[1] - a[1])).astype(int))
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def route_bounds(start, waypoints, mapper, reach=map_script.INFLATE_CELLS):
+    """
+    - Box of the cells within `reach` of a route, the ones route_samples
+    gives lie between the cells of its points
+    :param: start and waypoints in map coordinates, MapMaker for the grid conversion, distance in cells
+    :return: (first row, first col, last row, last col)
+    """
+    cells = [mapper.mapToGrid(p) for p in [start] + list(waypoints)]
+    rows, cols = [r for r, _ in cells], [c for _, c in cells]
+    return min(rows) - reach, min(cols) - reach, max(rows) + reach, max(cols) + reach
+
+
+def footprint_mask(start, waypoints, mapper, reach=map_script.INFLATE_CELLS):
+    """
+    - Cells within `reach` of the cells a route drives over (route_samples), as a
+    boolean mask over their bounding box, so a changed cell is tested by indexing into it
+    :param: start and waypoints in map coordinates, MapMaker for the grid conversion, distance in cells
+    :return: (corner (r, c) of the mask, boolean array), None when the route drives over no cells
+    """
+    rows, cols = route_samples(start, waypoints, mapper)
+    if len(rows) == 0:
+        return None
+    corner = np.array([rows.min(), cols.min()]) - reach
+    mask = np.zeros((rows.max() - corner[0] + reach + 1, cols.max() - corner[1] + reach + 1), bool)
+    mask[rows - corner[0], cols - corner[1]] = True
+    # grow it by `reach` along the rows, then along the cols
+    for axis in (0, 1):
+        grown = mask.copy()
+        for d in range(1, reach + 1):
+            if axis == 0:
+                grown[d:] |= mask[:-d]
+                grown[:-d] |= mask[d:]
+            else:
+                grown[:, d:] |= mask[:, :-d]
+                grown[:, :-d] |= mask[:, d:]
+        mask = grown
+    return tuple(corner.tolist()), mask
+
+
+def octile_many(a, b):
+    """
+    - map_script.octile between arrays of cells, broadcast against each other
+    :param: array of cells (..., 2), array of cells (..., 2)
+    :return: array of distances in cells
+    """
+    dr = np.abs(a[..., 0] - b[..., 0])
+    dc = np.abs(a[..., 1] - b[..., 1])
+    return np.maximum(dr, dc) + (map_script.SQRT2 - 1) * np.minimum(dr, dc)
+
+
+def route_length(start, waypoints):
+    """
+    - Length of a route in map cells
+    :param: start and waypoints in map coordinates
+    :return: float
+    """
+    points = np.array([start] + list(waypoints), dtype=float)
+    return float(np.sqrt((np.diff(points, axis=0)**2).sum(axis=1)).sum())
+
+
+class RouteTable:
+    def __init__(self, mapper, places, filename=DEFAULT_FILE):
+        """
+        :param: MapMaker to plan over, dictionary of tag id -> map coordinates, cache file
+        """
+        self.mapper = mapper
+        self.places = dict(places)
+        self.filename = filename
+
+        # (from id, to id) -> list of waypoints, None when there is no path
+        self.routes = {}
+        # (from id, to id) -> length in cells
+        self.lengths = {}
+        # (from id, to id) -> footprint_mask of the cells driven over, and
+        # route_bounds of it, for invalidation
+        self.footprints = {}
+        self.bounds = {}
+
+        self.mapper.change_listeners.append(self.map_changed)
+
+    def key(self):
+        """
+        - Hash of everything the routes depend on: the map, the tag table and planner settings
+        :param: None
+        :return: hex string
+        """
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(self.mapper.my_map >= 1).tobytes())
+        h.update(repr((sorted(self.places.items()), sorted(self.mapper.outside), map_script.GRID_ORIGIN,
+                       map_script.INFLATE_CELLS, CACHE_VERSION)).encode('utf-8'))
+        return h.hexdigest()
+
+    def plan(self, a, b):
+        """
+        - Plan the route a -> b and store it, along with the reverse route b -> a
+        (the grid is symmetric so the same path works backwards)
+        :param: tag id, tag id
+        :return: None
+        """
+        start, goal = self.places[a], self.places[b]
+        path = self.mapper.plan_path(start, goal)
+        for pair, route in [((a, b), path), ((b, a), self.reverse(start, path))]:
+            self.routes[pair] = route
+            self.footprints.pop(pair, None)
+            self.bounds.pop(pair, None)
+            self.lengths[pair] = float('inf') if route is None else route_length(self.places[pair[0]], route)
+            # ready for the next map change, a small cost next to planning
+            self.bound(pair)
+            self.footprint(pair)
+
+    def reverse(self, start, path):
+        """
+        - Turn the waypoints of a -> b into the waypoints of b -> a
+        :param: start of the route, its waypoints (ending at the goal)
+        :return: list of waypoints ending at start, or None
+        """
+        if path is None:
+            return None
+        return list(reversed(path[:-1])) + [start]
+
+    def build(self):
+        """
+        - Plan the routes between every pair of places
+        :param: None
+        :return: None
+        """
+        ids = sorted(self.places)
+        for i, a in enumerate(ids):
+            self.routes[(a, a)] = []
+            self.lengths[(a, a)] = 0.0
+            for b in ids[i + 1:]:
+                self.plan(a, b)
+
+    def save(self, filename=None):
+        """
+        - Write the routes to the cache file, keyed by the current map hash
+        :param: file name, defaults to the table's cache file
+        :return: None
+        """
+        filename = filename or self.filename
+        data = {'key': self.key(), 'routes': self.routes, 'lengths': self.lengths}
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, filename)
+
+    def load(self, filename=None):
+        """
+        - Read the routes from the cache file if it was made for the current map and tags
+        :param: file name, defaults to the table's cache file
+        :return: True if the routes were loaded
+        """
+        filename = filename or self.filename
+        try:
+            with open(filename, 'rb') as f:
+                data = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return False
+        return self.restore(data.get('key'), data['routes'], data['lengths'])
+
+    def restore(self, key, routes, lengths):
+        """
+        - Use routes planned earlier if they were planned for the current map and tags
+        :param: key() they were planned with, dictionaries of (from, to) -> waypoints and lengths
+        :return: True if the routes were used
+        """
+        if key != self.key():
+            return False
+        self.routes = routes
+        self.lengths = lengths
+        # footprints are only needed once a cell changes, see map_changed
+        self.footprints = {}
+        self.bounds = {}
+        return True
+
+    def load_or_build(self):
+        """
+        - Load the cached routes, or plan them all and cache them
+        :param: None
+        :return: None
+        """
+        if not self.load():
+            print "planning routes between all ar tags"
+            self.build()
+            self.save()
+
+    def lookup(self, a, b):
+        """
+        - Route between two places, replanned only if a map change invalidated it
+        :param: tag id, tag id
+        :return: list of waypoints in map coordinates ending at b, or None if there is no path
+        """
+        pair = (a, b)
+        if pair not in self.routes:
+            self.plan(a, b)
+        route = self.routes[pair]
+        return None if route is None else list(route)
+
+    def length(self, a, b):
+        """
+        - Length of the route between two places in map cells (inf if there is no path)
+        """
+        if (a, b) not in self.lengths:
+            self.plan(a, b)
+        return self.lengths[(a, b)]
+
+    def bound(self, pair):
+        """
+        - route_bounds of a route, None when there is no path, computed on first use
+        """
+        if pair not in self.bounds:
+            route = self.routes[pair]
+            self.bounds[pair] = None if route is None else \
+                route_bounds(self.places[pair[0]], route, self.mapper)
+        return self.bounds[pair]
+
+    def footprint(self, pair):
+        """
+        - footprint_mask of a route, for the routes loaded from disk computed on
+        first use: only the routes a changed cell comes near need one
+        """
+        if pair not in self.footprints:
+            route = self.routes[pair]
+            self.footprints[pair] = None if route is None else \
+                footprint_mask(self.places[pair[0]], route, self.mapper)
+        return self.footprints[pair]
+
+    def map_changed(self, cells):
+        """
+        - Drop only the routes a change of map cells can affect:
+            - a cell that became an obstacle affects routes passing within
+            INFLATE_CELLS of it
+            - a cell that became free affects routes that could get shorter by
+            going through it (and routes that had no path at all)
+        - dropped routes are planned again on their next lookup
+        :param: list of (r, c) cells whose value changed, my_map (and MapMaker.outside) already updated
+        :return: list of the (from, to) pairs that were dropped
+        """
+        pairs = [pair for pair in self.routes if pair[0] != pair[1]]
+        if not pairs or not cells:
+            return []
+        occupied = np.array([self.mapper.occupied(cell) for cell in cells], bool)
+        cells = np.array(cells, int).reshape(-1, 2)
+        blocked, freed = cells[occupied], cells[~occupied]
+        hits = np.zeros(len(pairs), bool)
+
+        if len(freed):
+            # lower bound on a route through each freed cell, every pair at once
+            grid = dict((tag, self.mapper.mapToGrid(spot)) for tag, spot in self.places.items())
+            starts = np.array([grid[a] for a, _ in pairs])[:, None]
+            goals = np.array([grid[b] for _, b in pairs])[:, None]
+            lengths = np.array([self.lengths[pair] for pair in pairs])
+            through = octile_many(starts, freed[None]) + octile_many(freed[None], goals)
+            hits = (through < lengths[:, None]).any(axis=1)
+
+        if len(blocked):
+            (r0, c0), (r1, c1) = blocked.min(axis=0).tolist(), blocked.max(axis=0).tolist()
+            for i, pair in enumerate(pairs):
+                bound = None if hits[i] else self.bound(pair)
+                # most changes are nowhere near most routes
+                if bound is None or r1 < bound[0] or c1 < bound[1] or r0 > bound[2] or c0 > bound[3]:
+                    continue
+                footprint = self.footprint(pair)
+                if footprint is None:
+                    continue
+                corner, mask = footprint
+                rc = blocked - corner
+                inside = (rc >= 0).all(axis=1) & (rc < mask.shape).all(axis=1)
+                hits[i] = mask[rc[inside, 0], rc[inside, 1]].any()
+
+        dropped = [pair for pair, hit in zip(pairs, hits.tolist()) if hit]
+        for pair in dropped:
+            del self.routes[pair]
+            del self.lengths[pair]
+            self.footprints.pop(pair, None)
+            self.bounds.pop(pair, None)
+        return dropped
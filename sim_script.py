@@ -0,0 +1,397 @@
+"""
+Headless simulation of the robot for running Main2 faster than real time
+
+SimWorld moves a unicycle robot around the ARTag layout from Main2.AR_ids and
+feeds Main2's callbacks with synthetic EKF poses, AlvarMarkers, depth images and
+bump events on a simulated clock. sim_util stands in for rospy and friends, so
+main.py and move_script.py run unmodified: every rate.sleep() or
+rospy.sleep() just moves the simulated clock forward.
+
+usage: python sim_script.py <ARTag>[,<ARTag>...] [home ARTag] [--verbose] [--record=<file> [--compress]]
+       [--park=sequence] [--reloc=off]
+"""
+import sys
+import os
+import math
+import time
+import numpy as np
+
+import sim_util
+
+# ---- robot ----
+# radius of the TurtleBot base (m), used for bumps
+ROBOT_RADIUS = 0.18
+# limits of the yocs velocity smoother (smoother.yaml defaults)
+SPEED_LIM_V = 0.8
+SPEED_LIM_W = 5.4
+ACCEL_LIM_V = 1.0
+ACCEL_LIM_W = 2.0
+# the robot stops if no velocity command arrives for this long (s)
+CMD_TIMEOUT = 0.6
+
+# ---- world ----
+# meters per map coordinate, same as map_script.world_map_ratio
+MAP_RATIO = 0.2
+# distance (m) from the parking spot in AR_ids to the ARTag itself
+TAG_OFFSET = 0.25
+
+# ---- sensors ----
+# how often (Hz) each sensor publishes
+EKF_RATE = 10.0
+MARKER_RATE = 10.0
+DEPTH_RATE = 5.0
+# field of view and range of the camera, for the ARTags and depth
+CAMERA_HFOV = math.radians(58)
+MARKER_RANGE = 3.5
+# ARTags can't be read from further than this off their normal
+MARKER_MAX_ANGLE = math.radians(75)
+DEPTH_FX = 570.3
+DEPTH_CX = 319.5
+DEPTH_SHAPE = (480, 640)
+DEPTH_RANGE = 4.0
+
+# physics step (s)
+DT = 0.02
+
+# topics Main2 talks to
+CMD_TOPIC = 'wanderer_velocity_smoother/raw_cmd_vel'
+RESET_TOPIC = '/mobile_base/commands/reset_odometry'
+EKF_TOPIC = '/robot_pose_ekf/odom_combined'
+MARKER_TOPIC = '/ar_pose_marker'
+DEPTH_TOPIC = '/camera/depth/image'
+BUMP_TOPIC = 'mobile_base/events/bumper'
+
+
+def wrap(angle):
+    """
+    - Wrap an angle to -pi..pi
+    """
+    return (angle + math.pi) % (2 * math.pi) - math.pi
+
+
+class SimWorld:
+    def __init__(self, obstacles=None, time_limit=600.0, odom_drift=0.0, marker_noise=0.0,
+                 depth_rate=DEPTH_RATE, seed=189, verbose=False):
+        """
+        :param: obstacles as (x, y, radius) cylinders in meters, simulated seconds
+        before giving up, odometry drift (m per m driven), ARTag position noise (m),
+        depth frames per second (0 turns depth off), random seed, print ros logs
+        """
+        self.obstacles = list(obstacles or [])
+        self.time_limit = time_limit
+        self.odom_drift = odom_drift
+        self.marker_noise = marker_noise
+        self.verbose = verbose
+        self.rng = np.random.RandomState(seed)
+
+        self.time = 0.0
+        # true pose in the world frame (the odom frame at start)
+        self.pose = [0.0, 0.0, 0.0]
+        # error the odometry has built up
+        self.drift = [0.0, 0.0]
+        # pose the odometry was last reset at
+        self.odom_origin = (0.0, 0.0, 0.0)
+        # commanded and actual (v, w)
+        self.cmd = (0.0, 0.0)
+        self.cmd_time = -1.0
+        self.velocity = [0.0, 0.0]
+
+        # tag id -> (marker x, y, normal heading)
+        self.tags = {}
+        self.subscribers = {}
+        self.shutdown_callbacks = []
+        self.stop_condition = None
+        self.shutdown = False
+
+        self.bumped = False
+        self.bumps = 0
+        self.distance = 0.0
+        # (time, x, y, heading) after every physics step, to tell where the robot was
+        self.trace = []
+
+        self.periods = {EKF_TOPIC: 1.0 / EKF_RATE, MARKER_TOPIC: 1.0 / MARKER_RATE}
+        if depth_rate > 0:
+            self.periods[DEPTH_TOPIC] = 1.0 / depth_rate
+        self.next_publish = dict((topic, 0.0) for topic in self.periods)
+
+    # ---- layout ----
+    def set_layout(self, AR_ids, home, headings=None):
+        """
+        - Place the ARTags. AR_ids coordinates are the spots the robot parks at
+        (map coordinates, home at the world origin facing +x); each ARTag sits
+        TAG_OFFSET beyond its spot, facing back at it. Unless given in
+        `headings` (tag id -> radians) a spot faces away from the middle of the
+        room, like dispensers standing along the walls
+        :param: Main2.AR_ids, home ARTag, optional headings
+        :return: None
+        """
+        headings = dict(headings or {})
+        headings.setdefault(home, 0.0)
+        origin = AR_ids[home][0]
+        spots = dict((tag, ((c[0][0] - origin[0]) * MAP_RATIO, (c[0][1] - origin[1]) * MAP_RATIO))
+                     for tag, c in AR_ids.items())
+        middle = np.mean(list(spots.values()), axis=0)
+        for tag, (x, y) in spots.items():
+            heading = headings.get(tag, math.atan2(y - middle[1], x - middle[0]))
+            self.tags[tag] = (x + TAG_OFFSET * math.cos(heading),
+                              y + TAG_OFFSET * math.sin(heading),
+                              wrap(heading + math.pi))
+
+    # ---- interface used by sim_util ----
+    def now(self):
+        return self.time
+
+    def subscribe(self, topic, callback):
+        self.subscribers.setdefault(topic, []).append(callback)
+
+    def publish(self, topic, msg):
+        if topic == CMD_TOPIC:
+            self.cmd = (msg.linear.x, msg.angular.z)
+            self.cmd_time = self.time
+        elif topic == RESET_TOPIC:
+            self.odom_origin = tuple(self.pose)
+            self.drift = [0.0, 0.0]
+            # reset messages take a moment to go through
+            self.advance(0.001)
+
+    def is_shutdown(self):
+        if not self.shutdown:
+            self.shutdown = self.time >= self.time_limit or \
+                (self.stop_condition is not None and self.stop_condition())
+        return self.shutdown
+
+    def advance(self, secs):
+        """
+        - Run the world forward, publishing sensor messages when they are due
+        :param: seconds
+        :return: None
+        """
+        end = self.time + secs
+        while self.time < end - 1e-9:
+            step = min(DT, end - self.time)
+            self.move(step)
+            self.time += step
+            self.trace.append((self.time, self.pose[0], self.pose[1], self.pose[2]))
+            for topic, period in self.periods.items():
+                if self.time >= self.next_publish[topic]:
+                    self.next_publish[topic] = self.time + period
+                    self.deliver(topic, self.sense(topic))
+
+    def deliver(self, topic, msg):
+        for callback in self.subscribers.get(topic, []):
+            callback(msg)
+
+    # ---- physics ----
+    def move(self, dt):
+        """
+        - Unicycle step with the smoother's speed and acceleration limits, the
+        robot stops against obstacles and the bumper reports it
+        """
+        v_goal, w_goal = self.cmd
+        if self.time - self.cmd_time > CMD_TIMEOUT:
+            v_goal, w_goal = 0.0, 0.0
+        v_goal = max(-SPEED_LIM_V, min(SPEED_LIM_V, v_goal))
+        w_goal = max(-SPEED_LIM_W, min(SPEED_LIM_W, w_goal))
+        v, w = self.velocity
+        v += max(-ACCEL_LIM_V * dt, min(ACCEL_LIM_V * dt, v_goal - v))
+        w += max(-ACCEL_LIM_W * dt, min(ACCEL_LIM_W * dt, w_goal - w))
+        self.velocity = [v, w]
+
+        x, y, th = self.pose
+        nx = x + v * math.cos(th) * dt
+        ny = y + v * math.sin(th) * dt
+        hit = self.colliding(nx, ny)
+        if hit:
+            nx, ny = x, y
+            self.velocity[0] = 0.0
+        if hit != self.bumped:
+            self.bumped = hit
+            self.bumps += hit
+            state = sim_util.BumperEvent.PRESSED if hit else sim_util.BumperEvent.RELEASED
+            self.deliver(BUMP_TOPIC, sim_util.BumperEvent(state=state))
+
+        step = math.hypot(nx - x, ny - y)
+        self.distance += step
+        if self.odom_drift > 0 and step > 0:
+            self.drift[0] += self.rng.randn() * self.odom_drift * step
+            self.drift[1] += self.rng.randn() * self.odom_drift * step
+        self.pose = [nx, ny, wrap(th + w * dt)]
+
+    def pose_at(self, t):
+        """
+        - True pose (x, y, heading) at time t, from the trace
+        """
+        times = [step[0] for step in self.trace]
+        i = min(int(np.searchsorted(times, t - 1e-9)), len(self.trace) - 1)
+        return self.trace[i][1:] if self.trace else tuple(self.pose)
+
+    def dock_error(self, tag, pose):
+        """
+        - How far a pose is off an ARTag's normal: lateral (m, positive to the
+        ARTag's left) and heading (rad, 0 facing straight at it)
+        """
+        tx, ty, normal = self.tags[tag]
+        dx, dy = pose[0] - tx, pose[1] - ty
+        return (-math.sin(normal) * dx + math.cos(normal) * dy,
+                wrap(pose[2] - normal - math.pi))
+
+    def colliding(self, x, y):
+        for ox, oy, r in self.obstacles:
+            if math.hypot(x - ox, y - oy) < r + ROBOT_RADIUS:
+                return True
+        return False
+
+    # ---- sensors ----
+    def sense(self, topic):
+        if topic == EKF_TOPIC:
+            return self.ekf_msg()
+        if topic == MARKER_TOPIC:
+            return self.marker_msg()
+        return self.depth_msg()
+
+    def odom_pose(self):
+        """
+        - Pose the odometry reports: true pose relative to the last reset, plus drift
+        """
+        ox, oy, oth = self.odom_origin
+        dx, dy = self.pose[0] - ox, self.pose[1] - oy
+        c, s = math.cos(-oth), math.sin(-oth)
+        return (c * dx - s * dy + self.drift[0], s * dx + c * dy + self.drift[1],
+                wrap(self.pose[2] - oth))
+
+    def ekf_msg(self):
+        x, y, th = self.odom_pose()
+        msg = sim_util.PoseWithCovarianceStamped(stamp=sim_util.Time(self.time))
+        msg.pose.pose.position = sim_util.Point(x, y, 0.0)
+        msg.pose.pose.orientation = sim_util.Quaternion(*sim_util.quaternion_from_euler(0, 0, th))
+        covariance = [0.0] * 36
+        covariance[0] = covariance[7] = covariance[35] = 1e-3 + self.odom_drift
+        msg.pose.covariance = covariance
+        return msg
+
+    def marker_msg(self):
+        """
+        - Every ARTag in view, in the camera optical frame (z forward, x right). The
+        roll of the orientation encodes which side of the ARTag the robot is on,
+        the way park() reads it: |pi - |roll|| is the angle off the ARTag's normal,
+        negative roll when the robot is left of the normal looking at the ARTag
+        """
+        x, y, th = self.pose
+        markers = []
+        for tag, (tx, ty, normal) in self.tags.items():
+            dx, dy = tx - x, ty - y
+            forward = math.cos(th) * dx + math.sin(th) * dy
+            left = -math.sin(th) * dx + math.cos(th) * dy
+            if forward <= 0.05 or math.hypot(forward, left) > MARKER_RANGE:
+                continue
+            if abs(math.atan2(left, forward)) > CAMERA_HFOV / 2:
+                continue
+            off_normal = wrap(math.atan2(-dy, -dx) - normal)
+            if abs(off_normal) > MARKER_MAX_ANGLE:
+                continue
+            if self.marker_noise > 0:
+                forward += self.rng.randn() * self.marker_noise
+                left += self.rng.randn() * self.marker_noise
+            roll = math.copysign(math.pi - abs(off_normal), off_normal)
+            marker = sim_util.AlvarMarker(id=tag, stamp=sim_util.Time(self.time))
+            marker.pose.pose.position = sim_util.Point(-left, 0.0, forward)
+            marker.pose.pose.orientation = sim_util.Quaternion(*sim_util.quaternion_from_euler(roll, 0, 0))
+            markers.append(marker)
+        return sim_util.AlvarMarkers(markers, stamp=sim_util.Time(self.time))
+
+    def depth_msg(self):
+        """
+        - Depth image of the obstacles: every column is a ray from the camera,
+        cylinders fill the whole column, NaN where nothing is in range
+        """
+        x, y, th = self.pose
+        u = np.arange(DEPTH_SHAPE[1])
+        # bearing of each column, left positive
+        bearing = np.arctan((DEPTH_CX - u) / DEPTH_FX)
+        dirs = np.stack([np.cos(th + bearing), np.sin(th + bearing)], axis=1)
+        ranges = np.full(DEPTH_SHAPE[1], np.inf)
+        for ox, oy, r in self.obstacles:
+            # ray / circle intersection, nearest positive root
+            cx, cy = ox - x, oy - y
+            along = dirs[:, 0] * cx + dirs[:, 1] * cy
+            disc = along**2 - (cx * cx + cy * cy - r * r)
+            with np.errstate(invalid='ignore'):
+                t = along - np.sqrt(disc)
+                t[(disc < 0) | (t <= 0)] = np.inf
+            ranges = np.minimum(ranges, t)
+        # depth images hold the distance along the optical axis
+        depth = (ranges * np.cos(bearing)).astype(np.float32)
+        depth[depth > DEPTH_RANGE] = np.nan
+        image = np.empty(DEPTH_SHAPE, np.float32)
+        image[:] = depth
+        return sim_util.Image(image, stamp=sim_util.Time(self.time))
+
+
+def run_mission(tag, home=1, world=None, options=(), **kwargs):
+    """
+    - Run main.Main2 on a simulated robot fetching from ARTags and returning home
+    :param: ARTag to fetch from (or a list of them), home ARTag, SimWorld (or
+    keyword arguments for one), Main2 options such as '--record=<file>'
+    :return: dictionary with the simulated mission time, whether it finished,
+    wall clock time, bumps, distance driven, times parking gave up and every parking as (ARTag,
+    seconds to park, true lateral error (m), true heading error (rad), lateral
+    error Main2 estimated (m))
+    """
+    sim_util.install()
+    world = world or SimWorld(**kwargs)
+    sim_util.set_world(world)
+    import main
+
+    argv = sys.argv
+    stdout = sys.stdout
+    tags = tag if isinstance(tag, (list, tuple)) else [tag]
+    # every simulated mission starts from what Main2 knows without a store, unless given one
+    if not any(option.startswith('--world=') for option in options):
+        options = list(options) + ['--world=']
+    sys.argv = ['main.py', ','.join(str(t) for t in tags), str(home)] + list(options)
+    if not world.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    began = time.time()
+    try:
+        robot = main.Main2()
+        world.set_layout(robot.AR_ids, home)
+        start = world.now()
+        world.stop_condition = lambda: robot.AR_curr == -1 and robot.state == 'wait' and \
+            len(robot.orders) == 0
+        try:
+            robot.run()
+        except sim_util.ROSInterruptException:
+            pass
+        # the simulation never runs Main2.shutdown()
+        if robot.recorder is not None:
+            robot.recorder.close()
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+        sys.stdout = stdout
+        sys.argv = argv
+
+    return {'sim_time': world.now() - start,
+            'completed': world.now() < world.time_limit,
+            'wall_time': time.time() - began,
+            'bumps': world.bumps,
+            'distance': world.distance,
+            'park_failures': robot.park_failures,
+            'docks': [(docked, secs) + world.dock_error(docked, world.pose_at(t)) + (lateral,)
+                      for docked, t, secs, lateral in robot.docks]}
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    tag = [int(t) for t in args[0].split(',')]
+    home = int(args[1]) if len(args) > 1 else 1
+    result = run_mission(tag, home, verbose='--verbose' in sys.argv,
+                         options=[a for a in sys.argv[1:] if a.startswith('--record=') or
+                                  a.startswith('--world=') or a in ('--compress', '--park=sequence', '--reloc=off')])
+    print "fetch %s -> home %d: %s in %.1f s simulated, %.1f s wall (%.0fx real time), %d bumps, %.1f m" % (
+        args[0], home, "done" if result['completed'] else "NOT DONE", result['sim_time'],
+        result['wall_time'], result['sim_time'] / max(result['wall_time'], 1e-9),
+        result['bumps'], result['distance'])
+    for dock in result['docks']:
+        print "parked at %d in %.1f s, %.3f m and %.1f deg off the normal (estimated %.3f m)" % (
+            dock[0], dock[1], dock[2], math.degrees(dock[3]), dock[4])
@@ -0,0 +1,385 @@
+"""
+Stand-ins for the ROS modules main.py imports, driven by a simulated world
+instead of a robot. install() puts them in sys.modules so main.py, move_script.py
+and the rest import them unmodified; every publisher, subscriber, clock and sleep
+then goes through the world set with set_world (see sim_script.SimWorld).
+
+The world has to provide:
+    now()                   simulated time in seconds
+    advance(seconds)        run the simulation forward, delivering messages
+    publish(topic, msg)     handle a message published by the node
+    subscribe(topic, cb)    register a callback for a topic
+    is_shutdown()           True once the simulation should end
+"""
+import sys
+import math
+import types
+
+# world every stand-in talks to
+_world = None
+
+
+def set_world(world):
+    """
+    - Point the stand-ins at a new world, used for every new simulation
+    :param: world object, see the module docstring
+    :return: None
+    """
+    global _world
+    _world = world
+
+
+def get_world():
+    return _world
+
+
+# ------------- rospy -------------
+
+class ROSInterruptException(Exception):
+    pass
+
+
+class Duration:
+    def __init__(self, secs=0, nsecs=0):
+        self.secs = secs + nsecs * 1e-9
+
+    def to_sec(self):
+        return self.secs
+
+    def __lt__(self, other):
+        return self.secs < other.secs
+
+    def __le__(self, other):
+        return self.secs <= other.secs
+
+    def __gt__(self, other):
+        return self.secs > other.secs
+
+    def __ge__(self, other):
+        return self.secs >= other.secs
+
+    def __add__(self, other):
+        return Duration(self.secs + other.secs)
+
+    def __repr__(self):
+        return "Duration(%.3f)" % self.secs
+
+
+class Time:
+    def __init__(self, secs=0, nsecs=0):
+        self.secs = secs + nsecs * 1e-9
+
+    @staticmethod
+    def now():
+        return Time(_world.now())
+
+    @staticmethod
+    def from_sec(secs):
+        return Time(secs)
+
+    def to_sec(self):
+        return self.secs
+
+    def __sub__(self, other):
+        if isinstance(other, Duration):
+            return Time(self.secs - other.secs)
+        return Duration(self.secs - other.secs)
+
+    def __add__(self, other):
+        return Time(self.secs + other.secs)
+
+    def __lt__(self, other):
+        return self.secs < other.secs
+
+    def __gt__(self, other):
+        return self.secs > other.secs
+
+    def __repr__(self):
+        return "Time(%.3f)" % self.secs
+
+
+class Rate:
+    def __init__(self, hz):
+        self.period = 1.0 / hz
+        self.last = None
+
+    def sleep(self):
+        """
+        - Like rospy.Rate.sleep: sleep whatever is left of the period since
+        the last call, raise ROSInterruptException once shut down
+        """
+        now = _world.now()
+        if self.last is None:
+            self.last = now
+        _sleep(self.last + self.period - now)
+        self.last += self.period
+        if now - self.last > 2 * self.period:
+            self.last = now
+
+
+def _sleep(secs):
+    if _world.is_shutdown():
+        raise ROSInterruptException("simulation shut down")
+    _world.advance(max(secs, 0.0))
+    if _world.is_shutdown():
+        raise ROSInterruptException("simulation shut down")
+
+
+def sleep(duration):
+    if isinstance(duration, Duration):
+        duration = duration.secs
+    _sleep(duration)
+
+
+class Publisher:
+    def __init__(self, topic, msg_type, queue_size=None, latch=False):
+        self.topic = topic
+        self.msg_type = msg_type
+
+    def publish(self, msg):
+        _world.publish(self.topic, msg)
+
+
+class Subscriber:
+    def __init__(self, topic, msg_type, callback, queue_size=None, buff_size=None):
+        self.topic = topic
+        _world.subscribe(topic, callback)
+
+
+def init_node(name, anonymous=False, **kwargs):
+    pass
+
+
+def on_shutdown(callback):
+    _world.shutdown_callbacks.append(callback)
+
+
+def is_shutdown():
+    return _world.is_shutdown()
+
+
+def get_time():
+    return _world.now()
+
+
+def _log(msg, *args):
+    if _world.verbose:
+        print msg % args if args else msg
+
+
+# call site -> simulated time it last logged, for the throttled logs
+_throttle_times = {}
+
+
+def _log_throttle(period, msg, *args):
+    caller = sys._getframe(1)
+    site = (caller.f_code.co_filename, caller.f_lineno)
+    if _world.now() - _throttle_times.get(site, -float('inf')) >= period:
+        _throttle_times[site] = _world.now()
+        _log(msg, *args)
+
+
+# ------------- messages -------------
+
+class Msg(object):
+    """
+    Plain attribute container standing in for a ROS message
+    """
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join(
+            "%s=%r" % item for item in sorted(self.__dict__.items())))
+
+
+class Vector3(Msg):
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        Msg.__init__(self, x=x, y=y, z=z)
+
+
+class Point(Vector3):
+    pass
+
+
+class Quaternion(Msg):
+    def __init__(self, x=0.0, y=0.0, z=0.0, w=1.0):
+        Msg.__init__(self, x=x, y=y, z=z, w=w)
+
+
+class Twist(Msg):
+    def __init__(self):
+        Msg.__init__(self, linear=Vector3(), angular=Vector3())
+
+
+class Pose(Msg):
+    def __init__(self, position=None, orientation=None):
+        Msg.__init__(self, position=position or Point(), orientation=orientation or Quaternion())
+
+
+class PoseStamped(Msg):
+    def __init__(self, pose=None, stamp=None):
+        Msg.__init__(self, pose=pose or Pose(), header=Msg(stamp=stamp or Time(0)))
+
+
+class PoseWithCovariance(Msg):
+    def __init__(self, pose=None, covariance=None):
+        Msg.__init__(self, pose=pose or Pose(), covariance=covariance or [0.0] * 36)
+
+
+class PoseWithCovarianceStamped(Msg):
+    def __init__(self, pose=None, stamp=None):
+        Msg.__init__(self, pose=pose or PoseWithCovariance(), header=Msg(stamp=stamp or Time(0)))
+
+
+class PointStamped(Msg):
+    def __init__(self, point=None):
+        Msg.__init__(self, point=point or Point())
+
+
+class AlvarMarker(Msg):
+    def __init__(self, id=0, pose=None, stamp=None):
+        Msg.__init__(self, id=id, pose=pose or PoseStamped(stamp=stamp),
+                     header=Msg(stamp=stamp or Time(0)))
+
+
+class AlvarMarkers(Msg):
+    def __init__(self, markers=None, stamp=None):
+        Msg.__init__(self, markers=markers or [], header=Msg(stamp=stamp or Time(0)))
+
+
+class Image(Msg):
+    """
+    Carries the depth array itself, CvBridge hands it straight back
+    """
+    def __init__(self, data=None, stamp=None):
+        Msg.__init__(self, data=data, header=Msg(stamp=stamp or Time(0)))
+
+
+class Empty(Msg):
+    pass
+
+
+class Int32(Msg):
+    def __init__(self, data=0):
+        Msg.__init__(self, data=data)
+
+
+class String(Msg):
+    def __init__(self, data=''):
+        Msg.__init__(self, data=data)
+
+
+class BumperEvent(Msg):
+    LEFT = 0
+    CENTER = 1
+    RIGHT = 2
+    RELEASED = 0
+    PRESSED = 1
+
+    def __init__(self, bumper=CENTER, state=RELEASED):
+        Msg.__init__(self, bumper=bumper, state=state)
+
+
+class CliffEvent(Msg):
+    pass
+
+
+class WheelDropEvent(Msg):
+    pass
+
+
+class Sound(Msg):
+    ON = 0
+    OFF = 1
+    RECHARGE = 2
+    BUTTON = 3
+    ERROR = 4
+    CLEANINGSTART = 5
+    CLEANINGEND = 6
+
+
+# ------------- tf / cv_bridge -------------
+
+def euler_from_quaternion(quaternion):
+    """
+    - Static xyz Euler angles of a quaternion (x, y, z, w), same as tf.transformations
+    :return: (roll, pitch, yaw)
+    """
+    x, y, z, w = quaternion
+    roll = math.atan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = math.asin(max(-1.0, min(1.0, 2 * (w * y - z * x))))
+    yaw = math.atan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    return (roll, pitch, yaw)
+
+
+def quaternion_from_euler(roll, pitch, yaw):
+    """
+    - Quaternion (x, y, z, w) of static xyz Euler angles, same as tf.transformations
+    """
+    cr, sr = math.cos(roll / 2), math.sin(roll / 2)
+    cp, sp = math.cos(pitch / 2), math.sin(pitch / 2)
+    cy, sy = math.cos(yaw / 2), math.sin(yaw / 2)
+    return (sr * cp * cy - cr * sp * sy,
+            cr * sp * cy + sr * cp * sy,
+            cr * cp * sy - sr * sp * cy,
+            cr * cp * cy + sr * sp * sy)
+
+
+class CvBridgeError(Exception):
+    pass
+
+
+class CvBridge:
+    def imgmsg_to_cv2(self, msg, desired_encoding=None):
+        return msg.data
+
+    def cv2_to_imgmsg(self, image, encoding='passthrough'):
+        return Image(image)
+
+
+# ------------- sys.modules -------------
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+def install():
+    """
+    - Put the stand-ins in sys.modules in place of the ROS packages. Call before
+    importing main.py (or anything else that imports rospy)
+    :param: None
+    :return: None
+    """
+    rospy = _module('rospy', ROSInterruptException=ROSInterruptException, Duration=Duration,
+                    Time=Time, Rate=Rate, sleep=sleep, Publisher=Publisher, Subscriber=Subscriber,
+                    init_node=init_node, on_shutdown=on_shutdown, is_shutdown=is_shutdown,
+                    get_time=get_time, loginfo=_log, logwarn=_log, logerr=_log, logdebug=_log,
+                    loginfo_throttle=_log_throttle, logwarn_throttle=_log_throttle)
+    geometry_msgs = _module('geometry_msgs')
+    geometry_msgs.msg = _module('geometry_msgs.msg', Twist=Twist, Vector3=Vector3, Point=Point,
+                                Quaternion=Quaternion, Pose=Pose, PoseStamped=PoseStamped,
+                                PoseWithCovariance=PoseWithCovariance,
+                                PoseWithCovarianceStamped=PoseWithCovarianceStamped,
+                                PointStamped=PointStamped)
+    kobuki_msgs = _module('kobuki_msgs')
+    kobuki_msgs.msg = _module('kobuki_msgs.msg', BumperEvent=BumperEvent, CliffEvent=CliffEvent,
+                              WheelDropEvent=WheelDropEvent, Sound=Sound)
+    sensor_msgs = _module('sensor_msgs')
+    sensor_msgs.msg = _module('sensor_msgs.msg', Image=Image)
+    std_msgs = _module('std_msgs')
+    std_msgs.msg = _module('std_msgs.msg', Empty=Empty, Int32=Int32, String=String)
+    ar_track_alvar_msgs = _module('ar_track_alvar_msgs')
+    ar_track_alvar_msgs.msg = _module('ar_track_alvar_msgs.msg', AlvarMarker=AlvarMarker,
+                                      AlvarMarkers=AlvarMarkers)
+    tf = _module('tf')
+    tf.transformations = _module('tf.transformations', euler_from_quaternion=euler_from_quaternion,
+                                 quaternion_from_euler=quaternion_from_euler)
+    cv_bridge = _module('cv_bridge', CvBridge=CvBridge, CvBridgeError=CvBridgeError)
+
+    for module in [rospy, geometry_msgs, geometry_msgs.msg, kobuki_msgs, kobuki_msgs.msg,
+                   sensor_msgs, sensor_msgs.msg, std_msgs, std_msgs.msg, ar_track_alvar_msgs,
+                   ar_track_alvar_msgs.msg, tf, tf.transformations, cv_bridge]:
+        sys.modules[module.__name__] = module
@@ -0,0 +1,276 @@
+"""
+Sparse multi-resolution occupancy map
+
+TileMap keeps log-odds occupancy in TILE x TILE cell tiles that are only
+allocated once something is seen in them, so memory and query time follow the
+explored floor rather than its bounding box. A tile is fine (one value per map
+cell, world_map_ratio m) within FINE_RADIUS cells of a fine point (the
+dispensers and home bases, where the robot parks) and coarse elsewhere (one
+value per COARSE x COARSE cells, for corridors); a coarse tile is refined when
+a fine point is added near it.
+
+The tiles of each resolution live in one pool array, a row per tile, and a
+sorted array of tile keys finds the row of any cell with a binary search, so
+every query and update is a handful of NumPy calls however many tiles there are:
+    value(rows, cols)       point query, log-odds (0 where nothing was seen)
+    update(...)             a frame of free and occupied cells
+    region(r0, c0, r1, c1)  dense log-odds of a rectangle
+    raycast(start, end)     first occupied cell on a line
+Cells are the (r, c) cells of MapMaker.my_map, extended without bounds in
+every direction.
+"""
+import numpy as np
+
+# cells per tile side, and cells per coarse value side
+TILE = 16
+COARSE = 2
+# tiles closer than this (cells) to a fine point are kept at full resolution
+FINE_RADIUS = 10
+# tile rows and cols are packed into one integer with this offset, far beyond any floor
+KEY_OFFSET = 2 ** 20
+# log-odds are stored as float32, half the memory of the dense grid
+DTYPE = np.float32
+
+# resolutions: index into TileMap.pools, cells per value side and values per tile side
+COARSE_LEVEL = 0
+FINE_LEVEL = 1
+SCALES = (COARSE, 1)
+SIDES = (TILE // COARSE, TILE)
+
+
+def tile_of(rows, cols):
+    """
+    - Tile keys (tile row, tile col) of cells, negative cells included
+    :param: arrays of rows and cols
+    :return: arrays of tile rows and tile cols
+    """
+    return np.floor_divide(rows, TILE), np.floor_divide(cols, TILE)
+
+
+def key_code(tile_rows, tile_cols):
+    """
+    - One integer per tile key, ordered so the keys can be binary searched
+    """
+    return (np.asarray(tile_rows, np.int64) + KEY_OFFSET) * (2 * KEY_OFFSET) + \
+        (np.asarray(tile_cols, np.int64) + KEY_OFFSET)
+
+
+class TileMap:
+    def __init__(self, fine_points=()):
+        """
+        :param: cells around which tiles are fine
+        """
+        # per resolution: log-odds of the tiles, a row of SIDES[level]**2 values
+        # each, the tile key of every row and how many rows are in use
+        self.pools = [np.zeros((0, side * side), DTYPE) for side in SIDES]
+        self.owners = [np.zeros((0, 2), int) for side in SIDES]
+        self.used = [0, 0]
+        # rows given back by refined tiles, used again first
+        self.spare = [[], []]
+        # tile key -> (level, row)
+        self.keys = {}
+        # sorted key codes with the level and row of each, rebuilt after tiles are added
+        self.lookup = None
+        self.fine_points = []
+        for cell in fine_points:
+            self.add_fine_point(cell)
+
+    def load(self, pools, keys):
+        """
+        - Use tiles kept from an earlier run, refined where the fine points call for it
+        :param: coarse and fine pool arrays, dictionary of tile key -> (level, row)
+        :return: None
+        """
+        self.pools = list(pools)
+        self.keys = dict(keys)
+        self.used = [len(pool) for pool in self.pools]
+        self.owners = [np.zeros((len(pool), 2), int) for pool in self.pools]
+        for key, (level, row) in self.keys.items():
+            self.owners[level][row] = key
+        in_use = [set(row for lvl, row in self.keys.values() if lvl == level) for level in (0, 1)]
+        self.spare = [sorted(set(range(self.used[level])) - in_use[level]) for level in (0, 1)]
+        self.lookup = None
+        points, self.fine_points = self.fine_points, []
+        for cell in points:
+            self.add_fine_point(cell)
+
+    def is_fine(self, key):
+        """
+        - Whether a tile (allocated or not) is within FINE_RADIUS of a fine point
+        """
+        r0, c0 = key[0] * TILE, key[1] * TILE
+        for r, c in self.fine_points:
+            # distance from the point to the tile's rectangle
+            dr = max(r0 - r, 0, r - (r0 + TILE - 1))
+            dc = max(c0 - c, 0, c - (c0 + TILE - 1))
+            if dr * dr + dc * dc <= FINE_RADIUS * FINE_RADIUS:
+                return True
+        return False
+
+    def add_fine_point(self, cell):
+        """
+        - Keep the tiles around a cell at full resolution, refining the coarse
+        ones already allocated there
+        :param: (r, c) cell
+        :return: None
+        """
+        self.fine_points.append((int(cell[0]), int(cell[1])))
+        for key, (level, row) in list(self.keys.items()):
+            if level == COARSE_LEVEL and self.is_fine(key):
+                side = SIDES[COARSE_LEVEL]
+                values = self.pools[COARSE_LEVEL][row].reshape(side, side)
+                values = np.repeat(np.repeat(values, COARSE, axis=0), COARSE, axis=1)
+                self.spare[COARSE_LEVEL].append(row)
+                del self.keys[key]
+                self.pools[FINE_LEVEL][self.allocate(key)] = values.ravel()
+
+    def allocate(self, key):
+        """
+        - Give a tile a row of its pool, unknown (0), at the resolution its place calls for
+        :param: tile key
+        :return: the row
+        """
+        level = FINE_LEVEL if self.is_fine(key) else COARSE_LEVEL
+        if self.spare[level]:
+            row = self.spare[level].pop()
+        else:
+            row = self.used[level]
+            if row == len(self.pools[level]):
+                # grow by doubling, so adding tiles stays cheap on average
+                grow = max(len(self.pools[level]), 16)
+                self.pools[level] = np.concatenate((self.pools[level], np.zeros((grow, SIDES[level]**2), DTYPE)))
+                self.owners[level] = np.concatenate((self.owners[level], np.zeros((grow, 2), int)))
+            self.used[level] += 1
+        self.pools[level][row] = 0
+        self.owners[level][row] = key
+        self.keys[key] = (level, row)
+        self.lookup = None
+        return row
+
+    def locate(self, rows, cols, allocate=False):
+        """
+        - Where the values of cells are stored
+        :param: arrays of rows and cols, whether to allocate the tiles not seen yet
+        :return: (found, level, pool row, index in the row) arrays, the others
+        are only meaningful where found
+        """
+        tr, tc = tile_of(rows, cols)
+        codes = key_code(tr, tc)
+        if allocate:
+            for code in np.unique(codes):
+                key = (int(code // (2 * KEY_OFFSET) - KEY_OFFSET), int(code % (2 * KEY_OFFSET) - KEY_OFFSET))
+                if key not in self.keys:
+                    self.allocate(key)
+        if not self.keys:
+            nothing = np.zeros(len(codes), int)
+            return nothing.astype(bool), nothing, nothing, nothing
+        if self.lookup is None:
+            keys = sorted(self.keys)
+            info = np.array([self.keys[k] for k in keys], int)
+            self.lookup = (key_code([k[0] for k in keys], [k[1] for k in keys]), info[:, 0], info[:, 1])
+        sorted_codes, levels, pool_rows = self.lookup
+        i = np.minimum(np.searchsorted(sorted_codes, codes), len(sorted_codes) - 1)
+        found = sorted_codes[i] == codes
+        level = levels[i]
+        scale = np.where(level == FINE_LEVEL, 1, COARSE)
+        index = ((rows - tr * TILE) // scale) * (TILE // scale) + (cols - tc * TILE) // scale
+        return found, level, pool_rows[i], index
+
+    def value(self, rows, cols):
+        """
+        - Log-odds of cells, 0 in tiles never seen
+        :param: arrays of rows and cols
+        :return: array of log-odds
+        """
+        rows, cols = np.asarray(rows, int), np.asarray(cols, int)
+        shape = rows.shape
+        rows, cols = rows.ravel(), cols.ravel()
+        out = np.zeros(len(rows), DTYPE)
+        found, level, pool_row, index = self.locate(rows, cols)
+        for lvl in (COARSE_LEVEL, FINE_LEVEL):
+            pick = found & (level == lvl)
+            out[pick] = self.pools[lvl][pool_row[pick], index[pick]]
+        return out.reshape(shape)
+
+    def update(self, free_rows, free_cols, occ_rows, occ_cols, l_free, l_occ, l_min, l_max):
+        """
+        - Fuse a frame: every stored value a free cell falls in gets l_free
+        added, every one an occupied cell falls in l_occ, each at most once and
+        occupied winning over free, then clamped to l_min..l_max
+        :param: arrays of free and occupied rows and cols, log-odds increments and limits
+        :return: (rows, cols) of every cell whose stored value changed (all
+        COARSE x COARSE cells of a coarse value)
+        """
+        rows = np.concatenate((free_rows, occ_rows)).astype(int)
+        cols = np.concatenate((free_cols, occ_cols)).astype(int)
+        occupied = np.arange(len(rows)) >= len(free_rows)
+        _, level, pool_row, index = self.locate(rows, cols, allocate=True)
+        changed_r, changed_c = [], []
+        for lvl in (COARSE_LEVEL, FINE_LEVEL):
+            pick = level == lvl
+            if not pick.any():
+                continue
+            size = SIDES[lvl] ** 2
+            flat = pool_row[pick] * size + index[pick]
+            occ = np.unique(flat[occupied[pick]])
+            free = np.setdiff1d(flat[~occupied[pick]], occ)
+            values = self.pools[lvl].ravel()
+            values[free] += l_free
+            values[occ] += l_occ
+            touched = np.concatenate((free, occ))
+            values[touched] = np.clip(values[touched], l_min, l_max)
+
+            # every cell the updated values cover
+            owner = self.owners[lvl][touched // size]
+            local = touched % size
+            scale = SCALES[lvl]
+            r = owner[:, 0] * TILE + (local // SIDES[lvl]) * scale
+            c = owner[:, 1] * TILE + (local % SIDES[lvl]) * scale
+            dr, dc = np.mgrid[0:scale, 0:scale]
+            changed_r.append((r[:, None] + dr.ravel()).ravel())
+            changed_c.append((c[:, None] + dc.ravel()).ravel())
+        if not changed_r:
+            return np.zeros(0, int), np.zeros(0, int)
+        return np.concatenate(changed_r), np.concatenate(changed_c)
+
+    def region(self, r0, c0, r1, c1):
+        """
+        - Log-odds of the cells of a rectangle, 0 where nothing was seen
+        :param: first row and col, end row and col (exclusive)
+        :return: array of shape (r1 - r0, c1 - c0)
+        """
+        rows, cols = np.mgrid[r0:r1, c0:c1]
+        return self.value(rows, cols)
+
+    def raycast(self, start, end, threshold):
+        """
+        - First cell on the line from start to end with log-odds above a
+        threshold, sampled like MapMaker.trace_rays
+        :param: (r, c) cells, log-odds threshold
+        :return: (r, c) cell, or None if the line is clear
+        """
+        steps = max(abs(end[0] - start[0]), abs(end[1] - start[1]))
+        t = np.linspace(0.0, 1.0, steps + 1)
+        r = np.rint(start[0] + t * (end[0] - start[0])).astype(int)
+        c = np.rint(start[1] + t * (end[1] - start[1])).astype(int)
+        hits = np.flatnonzero(self.value(r, c) > threshold)
+        if len(hits) == 0:
+            return None
+        return int(r[hits[0]]), int(c[hits[0]])
+
+    def memory(self):
+        """
+        - Bytes of log-odds stored, spare rows of the pools included
+        """
+        return sum(pool.nbytes for pool in self.pools)
+
+    def bounds(self):
+        """
+        - Cells spanned by the allocated tiles, (r0, c0, r1, c1) with r1 and c1
+        exclusive, None when nothing was seen
+        """
+        if not self.keys:
+            return None
+        keys = np.array(list(self.keys))
+        return (int(keys[:, 0].min()) * TILE, int(keys[:, 1].min()) * TILE,
+                (int(keys[:, 0].max()) + 1) * TILE, (int(keys[:, 1].max()) + 1) * TILE)
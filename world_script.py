@@ -0,0 +1,282 @@
+"""
+Persistent store of what the robot knows about the floor
+
+The map (my_map, its pinned cells and the log-odds tiles of
+tile_script.TileMap), the ARTag table with which ARTags are home bases and
+where the ARTags learned by reloc_script are, and the precomputed routes
+between them are kept in one versioned binary file:
+    header:   HEADER, see below
+    sections: my_map, pinned, TILE_DTYPE rows, the coarse and fine tile pools,
+              TAG_DTYPE rows, ROUTE_DTYPE rows and route waypoints, each
+              starting on an 8 byte boundary (see layout)
+At startup the file is memory-mapped copy-on-write and the grids and tiles are used in
+place, so a restarted node knows the floor in milliseconds instead of
+relearning it, and the routes come back without running A*. The stored ARTag
+table is only used while main.AR_IDS and HOME_IDS are what they were when it
+was saved, see tags_key. Changes to the map
+mark the store dirty and it is saved at most every SAVE_PERIOD seconds (and at
+shutdown), written to a temporary file and renamed over the old one so a crash
+never leaves half a store behind.
+"""
+import os
+import mmap
+import struct
+import hashlib
+import numpy as np
+
+import map_script
+import tile_script
+import landmark_script
+
+# where the store is kept between runs
+DEFAULT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'world.store')
+
+MAGIC = b'FCWORLD_'
+# bump when the layout of the file changes, older files are then ignored
+VERSION = 4
+# magic, version, grid rows and cols, GRID_ORIGIN, number of tiles, coarse and
+# fine pool rows, tags, routes and waypoints, route_script.RouteTable.key() the
+# routes were planned for, tags_key() of the ARTags the tag table started from
+HEADER = struct.Struct('<8sIHHhhIIIIII44s40s')
+# tile of the map: its key, resolution (tile_script.COARSE_LEVEL or FINE_LEVEL)
+# and row of that resolution's pool
+TILE_DTYPE = np.dtype([('row', '<i4'), ('col', '<i4'), ('level', '<i4'), ('slot', '<i4')])
+TILE_VALUE_DTYPE = np.dtype('<f4')
+# ARTag table: id, whether it is a home base, map coordinates of its parking
+# spot, heading of its normal (rad), how close (m) the robot needs to get, and
+# the map coordinates of the ARTag itself with their variance (m^2), the last
+# three NaN until the ARTag is learned (see reloc_script)
+TAG_DTYPE = np.dtype([('id', '<i4'), ('home', '<i4'), ('x', '<f8'), ('y', '<f8'),
+                      ('heading', '<f8'), ('reach', '<f8'), ('marker_x', '<f8'), ('marker_y', '<f8'),
+                      ('marker_var', '<f8')])
+# route from -> to: its waypoints[first:first + count] (count -1 when there is
+# no path) and length in cells
+ROUTE_DTYPE = np.dtype([('from', '<i4'), ('to', '<i4'), ('first', '<i4'), ('count', '<i4'),
+                        ('length', '<f8')])
+GRID_DTYPE = np.dtype('<f8')
+PINNED_DTYPE = np.dtype('u1')
+WAYPOINT_DTYPE = np.dtype('<i4')
+
+# seconds between saves while the map keeps changing
+SAVE_PERIOD = 5.0
+
+
+def layout(rows, cols, tiles, coarse, fine, tags, routes, points):
+    """
+    - Where every section of the file is
+    :param: grid rows and cols, number of tiles, coarse and fine pool rows, tags, 
+    routes and waypoints
+    :return: list of (name, dtype, count, offset), and the size of the file
+    """
+    sides = tile_script.SIDES
+    sections = [('my_map', GRID_DTYPE, rows * cols), ('pinned', PINNED_DTYPE, rows * cols),
+                ('tiles', TILE_DTYPE, tiles),
+                ('coarse', TILE_VALUE_DTYPE, coarse * sides[tile_script.COARSE_LEVEL]**2),
+                ('fine', TILE_VALUE_DTYPE, fine * sides[tile_script.FINE_LEVEL]**2),
+                ('tags', TAG_DTYPE, tags), ('routes', ROUTE_DTYPE, routes),
+                ('waypoints', WAYPOINT_DTYPE, 2 * points)]
+    out = []
+    offset = HEADER.size
+    for name, dtype, count in sections:
+        out.append((name, dtype, count, offset))
+        offset += -(-dtype.itemsize * count // 8) * 8
+    return out, offset
+
+
+def tags_key(tags, homes):
+    """
+    - Hash of the ARTags a store starts from, a stored tag table is dropped when they change
+    :param: dictionary of tag id -> [map coordinates, reach] (main.AR_IDS), ids of the home bases
+    :return: hex string
+    """
+    places = sorted((tag, tuple(spot), float(reach)) for tag, (spot, reach) in tags.items())
+    return hashlib.sha1(repr((places, sorted(homes))).encode('utf-8')).hexdigest()
+
+
+def pack_routes(table):
+    """
+    - The routes of a RouteTable as ROUTE_DTYPE rows and a waypoint array
+    :param: route_script.RouteTable
+    :return: (routes array, waypoints array of shape (n, 2))
+    """
+    rows, points = [], []
+    for pair in sorted(table.routes):
+        route = table.routes[pair]
+        if route is None:
+            rows.append(pair + (len(points), -1, float('inf')))
+        else:
+            rows.append(pair + (len(points), len(route), table.lengths[pair]))
+            points.extend(route)
+    return np.array(rows, ROUTE_DTYPE), np.array(points, WAYPOINT_DTYPE).reshape(-1, 2)
+
+
+def pack_tiles(tiles):
+    """
+    - The tiles of a TileMap as TILE_DTYPE rows and the rows of its pools in use
+    :param: tile_script.TileMap
+    :return: (tiles array, coarse pool, fine pool)
+    """
+    rows = [key + tiles.keys[key] for key in sorted(tiles.keys)]
+    pools = [pool[:used].astype(TILE_VALUE_DTYPE) for pool, used in zip(tiles.pools, tiles.used)]
+    return (np.array(rows, TILE_DTYPE),) + tuple(pools)
+
+
+class WorldStore:
+    def __init__(self, mapper, tags, homes, filename=DEFAULT_FILE):
+        """
+        :param: MapMaker to keep, dictionary of tag id -> [map coordinates, reach]
+        (main.AR_IDS) and ids of the home bases used when there is no store yet
+        or it was saved for other ones, file of the store (None to keep nothing)
+        """
+        self.mapper = mapper
+        self.filename = filename
+        # the stored tag table is only used if it started from the same ARTags
+        self.tags_key = tags_key(tags, homes)
+        # every ARTag, Main2.landmarks
+        self.tags = landmark_script.LandmarkTable(tags, homes)
+        # RouteTable saved along, and (key, routes, lengths) read from the file for it
+        self.routes = None
+        self.stored_routes = None
+        # the map changed since the last save (nothing is saved yet), and when that was (s)
+        self.dirty = True
+        self.saved_at = None
+        # memory map the grids are views of, kept open while they are in use
+        self.data = None
+
+        self.mapper.change_listeners.append(self.changed)
+        self.tags.change_listeners.append(self.changed)
+
+    def load(self):
+        """
+        - Read the store: the grids and tiles go into the MapMaker (copy-on-write 
+        views of the file, nothing is copied), the ARTag table into self.tags and the
+        routes wait for use_routes(). A file of another version or grid is ignored,
+        and its ARTag table is when main.AR_IDS or HOME_IDS changed since it was saved
+        :param: None
+        :return: True if there was a store to load
+        """
+        if self.filename is None:
+            return False
+        try:
+            with open(self.filename, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (IOError, OSError, ValueError):
+            return False
+        if len(data) < HEADER.size:
+            return False
+        magic, version, rows, cols, origin_r, origin_c, tiles, coarse, fine, tags, routes, points, key, \
+            stored_tags_key = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            return False
+        sections, size = layout(rows, cols, tiles, coarse, fine, tags, routes, points)
+        if len(data) < size or \
+                (origin_r, origin_c) != map_script.GRID_ORIGIN or \
+                (rows, cols) != self.mapper.my_map.shape:
+            return False
+        arrays = dict((name, np.frombuffer(data, dtype, count, offset))
+                      for name, dtype, count, offset in sections)
+
+        sides = tile_script.SIDES
+        pools = (arrays['coarse'].reshape(coarse, sides[tile_script.COARSE_LEVEL]**2),
+                 arrays['fine'].reshape(fine, sides[tile_script.FINE_LEVEL]**2))
+        keys = dict(((int(t['row']), int(t['col'])), (int(t['level']), int(t['slot'])))
+                    for t in arrays['tiles'])
+        self.mapper.restore(arrays['my_map'].reshape(rows, cols), pools, keys,
+                            arrays['pinned'].view(bool).reshape(rows, cols))
+        self.data = data
+        table = arrays['tags']
+        tags_changed = stored_tags_key.rstrip(b'\0').decode('ascii') != self.tags_key
+        if tags_changed:
+            print "ARTags changed since %s was saved, its ARTag table is not used" % self.filename
+        else:
+            self.tags.restore(table['id'], np.column_stack((table['x'], table['y'])), table['reach'],
+                              table['home'] != 0, table['heading'],
+                              np.column_stack((table['marker_x'], table['marker_y'])), table['marker_var'])
+
+        waypoints = arrays['waypoints'].reshape(-1, 2).tolist()
+        stored, lengths = {}, {}
+        for row in arrays['routes']:
+            pair = (int(row['from']), int(row['to']))
+            first, count = int(row['first']), int(row['count'])
+            stored[pair] = None if count < 0 else [tuple(p) for p in waypoints[first:first + count]]
+            lengths[pair] = float(row['length'])
+        self.stored_routes = (key.rstrip(b'\0').decode('ascii'), stored, lengths)
+        self.saved_at = None
+        # a dropped ARTag table is replaced in the file at the next save
+        self.dirty = tags_changed
+        return True
+
+    def use_routes(self, table):
+        """
+        - Keep a RouteTable in the store, giving it the stored routes when they
+        were planned for the current map and ARTags
+        :param: route_script.RouteTable
+        :return: True if the stored routes were used
+        """
+        self.routes = table
+        if self.stored_routes is None:
+            return False
+        used = table.restore(*self.stored_routes)
+        self.stored_routes = None
+        return used
+
+    def changed(self, cells):
+        """
+        - MapMaker and LandmarkTable change listener, the store needs saving
+        """
+        self.dirty = True
+
+    def save(self, now=None):
+        """
+        - Write the store: to a temporary file, then renamed over the old one
+        :param: current time (s)
+        :return: None
+        """
+        if self.filename is None:
+            return
+        rows, cols = self.mapper.my_map.shape
+        t = self.tags
+        ids = np.array(sorted(t.places), int)
+        tags = np.zeros(len(ids), TAG_DTYPE)
+        tags['id'], tags['home'] = ids, t.home[ids]
+        tags['x'], tags['y'] = t.spot[ids, 0], t.spot[ids, 1]
+        tags['heading'], tags['reach'] = t.heading[ids], t.reach[ids]
+        tags['marker_x'], tags['marker_y'] = t.marker[ids, 0], t.marker[ids, 1]
+        tags['marker_var'] = t.marker_var[ids]
+        if self.routes is not None:
+            routes, points = pack_routes(self.routes)
+            key = self.routes.key()
+        else:
+            routes, points, key = np.zeros(0, ROUTE_DTYPE), np.zeros((0, 2), WAYPOINT_DTYPE), ''
+        tiles, coarse, fine = pack_tiles(self.mapper.tiles)
+        sections, size = layout(rows, cols, len(tiles), len(coarse), len(fine), len(tags), len(routes),
+                                len(points))
+        arrays = {'my_map': self.mapper.my_map.astype(GRID_DTYPE),
+                  'pinned': self.mapper.pinned.astype(PINNED_DTYPE),
+                  'tiles': tiles, 'coarse': coarse, 'fine': fine,
+                  'tags': tags, 'routes': routes, 'waypoints': points}
+
+        buf = bytearray(size)
+        HEADER.pack_into(buf, 0, MAGIC, VERSION, rows, cols, map_script.GRID_ORIGIN[0],
+                         map_script.GRID_ORIGIN[1], len(tiles), len(coarse), len(fine), len(tags),
+                         len(routes), len(points), key.encode('ascii'), self.tags_key.encode('ascii'))
+        for name, dtype, count, offset in sections:
+            data = np.ascontiguousarray(arrays[name]).tobytes()
+            buf[offset:offset + len(data)] = data
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(buf)
+        os.rename(tmp, self.filename)
+        self.dirty = False
+        self.saved_at = now
+
+    def save_if_changed(self, now):
+        """
+        - Save when the map changed, at most every SAVE_PERIOD seconds
+        :param: current time (s)
+        :return: True if the store was saved
+        """
+        if not self.dirty or (self.saved_at is not None and now - self.saved_at < SAVE_PERIOD):
+            return False
+        self.save(now)
+        return True